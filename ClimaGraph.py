@@ -1,464 +1,3634 @@
 # Imports
-import openmeteo_requests
-from geopy.geocoders import Nominatim
-import matplotlib.pyplot as plt
-import requests_cache
-import requests
-import pandas as pd
-from retry_requests import retry
-from datetime import datetime
+# Only the standard library is imported up front so that the query and
+# export commands start quickly, heavy libraries load on first use
+from datetime import datetime, date, timedelta
+import importlib.util
 import warnings
-from matplotlib.font_manager import FontProperties
 import sqlite3
 import csv
 import time  # Added for time.sleep() usage
 import re
+import itertools
+import threading
+import os
+import calendar
+import json
+import argparse
+import sys
+import collections
+import collections.abc
+import io
+import queue
+from urllib.parse import quote
+from contextlib import contextmanager
+
+
+# Returns a module that is only executed the first time
+# one of its attributes is used
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+
+# Guards the clients created on first use by worker threads
+init_lock = threading.RLock()
+
+openmeteo = None
+
 
 # Setup the Open-Meteo API client with cache and retry on error
-cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-openmeteo = openmeteo_requests.Client(session=retry_session)
+def get_openmeteo():
+    global openmeteo
+    with init_lock:
+        if openmeteo is None:
+            import openmeteo_requests
+            from retry_requests import retry
+
+            cache_session = get_http_cache().session
+            retry_session = retry(
+                cache_session, retries=5, backoff_factor=0.2)
+            openmeteo = openmeteo_requests.Client(session=retry_session)
+    return openmeteo
+
+
+# Per-stage timers and counters of a run, shared by every thread
+# Stages and counters are created on first use, so instrumenting a
+# new step is one `with metrics.timer(...)` or `metrics.count(...)`
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # stage -> [calls, total seconds, longest call in seconds]
+            self.timers = {}
+            self.counters = collections.Counter()
+            self.gauges = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def add_time(self, stage, seconds, calls=1, longest=None):
+        with self.lock:
+            timer = self.timers.setdefault(stage, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds if longest is None else longest)
+
+    # Times the block under stage, failed calls included
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    # Adds the numbers of a snapshot taken elsewhere, like a worker process
+    def merge(self, snapshot):
+        for stage, timer in snapshot['stages'].items():
+            self.add_time(stage, timer['seconds'], timer['calls'],
+                          timer['max_seconds'])
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        for name, value in snapshot['gauges'].items():
+            self.gauge(name, value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {
+                    stage: {
+                        'calls': calls, 'seconds': round(seconds, 6),
+                        'max_seconds': round(longest, 6)
+                    }
+                    for stage, (calls, seconds, longest)
+                    in sorted(self.timers.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+                'gauges': dict(sorted(self.gauges.items())),
+            }
+
+
+metrics = Metrics()
+
+# Formats metrics can be written in
+METRICS_FORMATS = ('json', 'prometheus')
+
+
+# Escapes a Prometheus label value
+def prometheus_label(value):
+    return (
+        str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+# Formats (labels, snapshot) pairs, one per run or batch job
+def format_metrics(runs, metrics_format='json'):
+    if metrics_format == 'json':
+        return json.dumps([
+            dict(labels, **snapshot) for labels, snapshot in runs
+        ], indent=2) + "\n"
+    if metrics_format != 'prometheus':
+        raise ValueError(f"Unknown metrics format: {metrics_format}")
+
+    # Prometheus text format, every family declared once
+    families = {}
+
+    def sample(family, kind, help_text, labels, value):
+        text = ",".join(
+            f'{key}="{prometheus_label(label)}"'
+            for key, label in labels.items())
+        families.setdefault(family, (kind, help_text, []))[2].append(
+            f"{family}{{{text}}} {value}" if text else f"{family} {value}")
+
+    for labels, snapshot in runs:
+        for stage, timer in snapshot['stages'].items():
+            stage_labels = dict(labels, stage=stage)
+            sample("climagraph_stage_seconds_total", "counter",
+                   "Time spent in a pipeline stage.", stage_labels,
+                   timer['seconds'])
+            sample("climagraph_stage_calls_total", "counter",
+                   "Times a pipeline stage ran.", stage_labels,
+                   timer['calls'])
+            sample("climagraph_stage_max_seconds", "gauge",
+                   "Longest single run of a pipeline stage.", stage_labels,
+                   timer['max_seconds'])
+        for name, value in snapshot['counters'].items():
+            sample(f"climagraph_{name}_total", "counter",
+                   f"Pipeline counter {name}.", labels, value)
+        for name, value in snapshot['gauges'].items():
+            sample(f"climagraph_{name}", "gauge",
+                   f"Pipeline gauge {name}.", labels, value)
+
+    lines = []
+    for family, (kind, help_text, samples) in families.items():
+        lines.append(f"# HELP {family} {help_text}")
+        lines.append(f"# TYPE {family} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+# Writes formatted metrics to path, or stderr without one so they do
+# not mix with data printed on stdout
+def write_metrics(runs, metrics_format='json', path=None):
+    text = format_metrics(runs, metrics_format)
+    if path:
+        with open(path, 'w') as file:
+            file.write(text)
+    else:
+        sys.stderr.write(text)
+
+
+# Optionally profiles the block with cProfile, saving the stats to
+# cpu_profile, and traces allocations with tracemalloc, recording the
+# peak in the memory_peak_bytes gauge
+# cProfile only sees the calling thread, worker threads are not profiled
+@contextmanager
+def profiling(cpu_profile=None, trace_memory=False):
+    profiler = None
+    if cpu_profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cpu_profile)
+        if trace_memory:
+            metrics.gauge(
+                'memory_peak_bytes', tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+
+# Local database holding every fetched city
+DATABASE_FILE = 'weather_data.db'
+
+# Where series are stored: 'sqlite' for the observations table,
+# 'columnar' for memory-mapped float32 files under COLUMNAR_DIR
+STORAGE_BACKEND = 'sqlite'
+COLUMNAR_DIR = 'weather_columns'
+
+# Days this close to today can still be revised by the API,
+# so they are always downloaded again
+PROVISIONAL_DAYS = 5
+
+# Daily variables with a column in the observations table,
+# others get a column added the first time they are written
+OBSERVATION_VARIABLES = [
+    "temperature_2m_max", "temperature_2m_min", "temperature_2m_mean",
+    "uv_index_max", "precipitation_sum", "wind_speed_10m_max",
+    "shortwave_radiation_sum"]
+
+# Tables of the normalized schema
+SCHEMA_TABLES = {
+    'locations', 'observations', 'coverage', 'rollups', 'climatology',
+    'data_version', 'hourly', 'aliases', 'weeks'}
+
+# Stored in PRAGMA user_version once one-table-per-city tables from
+# older versions were migrated, so the migration runs once per database
+SCHEMA_VERSION = 1
+
+# Rollup periods, with the NumPy datetime unit of each
+ROLLUP_PERIODS = {'month': 'M', 'year': 'Y'}
+
+# Percentiles of the daily values kept for every period, as pNN columns
+ROLLUP_PERCENTILES = (10, 50, 90)
+
+# Levels long ranges are read at for overviews, finest first, with the
+# mean length of their periods in days
+# Weeks are kept in their own table, months and years are the rollups
+# and quarters are summed from the monthly rollups
+PYRAMID_LEVELS = {
+    'week': 7, 'month': 30.44, 'quarter': 91.31, 'year': 365.25}
+
+# Columns of the rows read_pyramid returns
+PYRAMID_COLUMNS = ['date', 'mean', 'min', 'max', 'days']
+
+# Periods per city drawn on a graph, one per pixel column of the
+# 12 inch wide figures render_graph saves at 100 dpi
+GRAPH_PERIODS = 1200
+
+# Reference years anomalies are measured against (WMO 1991-2020 normals)
+BASELINE_START = 1991
+BASELINE_END = 2020
+
+# Name of the time column of daily and hourly dataframes
+TIME_COLUMNS = {'daily': 'date', 'hourly': 'time'}
+
+# Coverage of hourly variables is recorded under this prefix,
+# apart from daily variables of the same name
+HOURLY_COVERAGE = 'hourly:'
+
+# Days of hourly values decoded per batch when querying
+HOURLY_READ_DAYS = 366
+
+# Statistics hourly values can be bucketed with
+BUCKET_STATS = ('mean', 'min', 'max', 'sum')
+
+# Size in degrees of the grid cells archive locations are snapped to
+# 0.1 is the finest grid behind Open-Meteo's archive (ERA5-Land),
+# cities within one cell get the same values from the API
+# Forecast models have finer grids, so forecast locations are not merged
+GRID_CELL_DEGREES = 0.1
+
+
+# Connection settings for bulk loads: with WAL, synchronous=NORMAL only
+# syncs at checkpoints and stays crash safe, and a 64 MB page cache and
+# in-memory temp tables keep index updates off the disk
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+
+# Opens the database in WAL mode with the normalized schema,
+# converting databases written by older versions on the way
+# A connection can be handed over to a StoreWriter thread
+def connect_database(path=None):
+    conn = sqlite3.connect(path or DATABASE_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+    ensure_schema(conn.cursor())
+    if conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+        migrate_legacy_tables(conn.cursor())
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    conn.commit()
+    return conn
+
+
+# Turns a date column (strings or timestamps) into a datetime64[D] array,
+# or datetime64[h] with unit='h'
+def day_dates(column, unit='D'):
+    days = pd.to_datetime(column, utc=True, cache=False)
+    if isinstance(days, pd.Series):
+        days = days.dt.tz_localize(None)
+    else:
+        days = days.tz_localize(None)
+    return days.to_numpy().astype(f'datetime64[{unit}]')
+
+
+# Turns a date column into 'YYYY-MM-DD' strings with one NumPy cast
+# instead of formatting every timestamp
+def day_strings(column):
+    return day_dates(column).astype(str)
+
+
+# One row per location plus one observations row per location and day
+# observations is a WITHOUT ROWID table clustered on (location_id, date),
+# so the primary key is a covering index and a date-range query for a
+# location is a single index seek followed by a sequential scan
+def ensure_schema(c):
+    # version is bumped whenever stored data of the location changes,
+    # so results cached per location can tell they are out of date
+    c.execute('''CREATE TABLE IF NOT EXISTS locations (
+                    location_id INTEGER PRIMARY KEY,
+                    name TEXT UNIQUE,
+                    latitude REAL,
+                    longitude REAL,
+                    cell TEXT,
+                    version INTEGER NOT NULL DEFAULT 0)''')
+    location_columns = [
+        row[1] for row in c.execute("PRAGMA table_info(locations)")]
+    if 'cell' not in location_columns:
+        c.execute("ALTER TABLE locations ADD COLUMN cell TEXT")
+    if 'version' not in location_columns:
+        c.execute("ALTER TABLE locations "
+                  "ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS locations_cell ON locations (cell)")
+
+    # Other names of a location, cities that fall in its grid cell
+    # and share its stored series
+    c.execute('''CREATE TABLE IF NOT EXISTS aliases (
+                    name TEXT PRIMARY KEY,
+                    location_id INTEGER REFERENCES locations)
+                    WITHOUT ROWID''')
+
+    columns = ",\n".join(
+        f"{variable} REAL" for variable in OBSERVATION_VARIABLES)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS observations (
+                    location_id INTEGER REFERENCES locations,
+                    date TEXT,
+                    {columns},
+                    PRIMARY KEY (location_id, date)) WITHOUT ROWID''')
+
+    # Coverage is per location and variable, as merged date intervals
+    coverage_columns = [
+        row[1] for row in c.execute("PRAGMA table_info(coverage)")]
+    if 'city_table' in coverage_columns:
+        c.execute("ALTER TABLE coverage RENAME TO legacy_coverage")
+    c.execute('''CREATE TABLE IF NOT EXISTS coverage (
+                    location_id INTEGER REFERENCES locations,
+                    variable TEXT,
+                    start_date TEXT,
+                    end_date TEXT)''')
+    c.execute('''CREATE INDEX IF NOT EXISTS coverage_location
+                 ON coverage (location_id, variable)''')
+
+    # Aggregates of the daily values per month and year, kept up to date
+    # at ingest, with the mean of each calendar month (or of the years)
+    # over the baseline in climatology
+    percentiles = "".join(
+        f"p{percentile} REAL,\n" for percentile in ROLLUP_PERCENTILES)
+    c.execute(f'''CREATE TABLE IF NOT EXISTS rollups (
+                    location_id INTEGER REFERENCES locations,
+                    variable TEXT,
+                    period TEXT,
+                    period_start TEXT,
+                    days INTEGER,
+                    mean REAL,
+                    min REAL,
+                    max REAL,
+                    sum REAL,
+                    {percentiles}
+                    anomaly REAL,
+                    PRIMARY KEY (location_id, variable, period, period_start))
+                    WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS climatology (
+                    location_id INTEGER REFERENCES locations,
+                    variable TEXT,
+                    period TEXT,
+                    slot TEXT,
+                    mean REAL,
+                    years INTEGER,
+                    PRIMARY KEY (location_id, variable, period, slot))
+                    WITHOUT ROWID''')
+
+    # Mean, min and max of the daily values per week, from Monday, kept
+    # up to date with the rollups, so with them a long range can be
+    # read at a level with about as many periods as there are points
+    c.execute('''CREATE TABLE IF NOT EXISTS weeks (
+                    location_id INTEGER REFERENCES locations,
+                    variable TEXT,
+                    week_start TEXT,
+                    days INTEGER,
+                    mean REAL,
+                    min REAL,
+                    max REAL,
+                    PRIMARY KEY (location_id, variable, week_start))
+                    WITHOUT ROWID''')
+
+    # Hourly values as one blob of 24 little-endian float32 per location,
+    # variable and UTC day, NaN where an hour is missing, so a year of
+    # a variable is about 35 KB and a date-range read is one index seek
+    # that only decodes the days asked for
+    c.execute('''CREATE TABLE IF NOT EXISTS hourly (
+                    location_id INTEGER REFERENCES locations,
+                    variable TEXT,
+                    date TEXT,
+                    hours BLOB,
+                    PRIMARY KEY (location_id, variable, date))
+                    WITHOUT ROWID''')
+
+    # A single counter bumped by every transaction that changes stored
+    # data, so readers can tell whether what they cached is still current
+    c.execute('''CREATE TABLE IF NOT EXISTS data_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 0),
+                    version INTEGER NOT NULL)''')
+
+
+# Adds a column to observations for every variable that lacks one
+def ensure_columns(c, variables):
+    existing = [
+        row[1] for row in c.execute("PRAGMA table_info(observations)")]
+    for variable in variables:
+        if variable not in existing:
+            c.execute(f"ALTER TABLE observations ADD COLUMN {variable} REAL")
+
+
+# Moves one-table-per-city data from older versions into observations
+# to_sql stored local midnight as a UTC timestamp, rounding to the
+# nearest day recovers the local date for offsets up to +11 hours
+# Only tables named by legacy_table_name, holding a date column and
+# daily variables, are taken for city tables, other tables are kept
+def migrate_legacy_tables(c):
+    tables = [
+        row[0] for row in c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")
+        if row[0] not in SCHEMA_TABLES and is_legacy_table_name(row[0])
+    ]
+    legacy_coverage = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'legacy_coverage'"
+    ).fetchone()
+
+    for table in tables:
+        columns = [
+            row[1] for row in c.execute(f'PRAGMA table_info("{table}")')]
+        variables = columns[1:]
+        if columns[:1] != ['date'] or not variables or any(
+                variable not in OBSERVATION_VARIABLES
+                for variable in variables):
+            continue
+        ensure_columns(c, variables)
+        location_id = upsert_location(c, table)
+
+        names = ", ".join(variables)
+        updates = ", ".join(
+            f"{variable} = excluded.{variable}" for variable in variables)
+        c.execute(
+            f'''INSERT INTO observations (location_id, date, {names})
+                 SELECT ?, date(date, '+12 hours'), {names} FROM "{table}"
+                 WHERE true
+                 ON CONFLICT (location_id, date) DO UPDATE SET {updates}''',
+            (location_id,)
+        )
+
+        # Keep the coverage recorded for the table, or the span it holds
+        intervals = []
+        if legacy_coverage:
+            intervals = c.execute(
+                '''SELECT variable, start_date, end_date
+                   FROM legacy_coverage WHERE city_table = ?''',
+                (table,)
+            ).fetchall()
+        if not intervals:
+            for variable in variables:
+                start_date, end_date = c.execute(
+                    f'''SELECT MIN(date(date, '+12 hours')),
+                              MAX(date(date, '+12 hours'))
+                       FROM "{table}" WHERE {variable} IS NOT NULL'''
+                ).fetchone()
+                if start_date:
+                    intervals.append((variable, start_date, end_date))
+        for variable, start_date, end_date in intervals:
+            record_coverage(c, location_id, variable, start_date, end_date)
+
+        c.execute(f'DROP TABLE "{table}"')
+
+    if legacy_coverage:
+        c.execute("DROP TABLE legacy_coverage")
+
+
+# True for names legacy_table_name can give, which have none of the
+# characters it removes
+def is_legacy_table_name(name):
+    return (
+        name != 'legacy_coverage' and not name.startswith('sqlite_')
+        and not any(char in name for char in " ,()-':")
+    )
+
+
+# Table name older versions used for a cities_dict key
+# Migrated locations keep it as their name until the city is fetched again
+def legacy_table_name(city):
+    return (
+        city.replace(" ", "_")
+            .replace(",", "")
+            .replace("(", "")
+            .replace(")", "")
+            .replace("User_entered:", "")
+            .replace("-", "_")
+            .replace("__", "_")
+            .replace("'", "")
+    )
+
+
+# Returns the location_id stored for name, or None
+# Names are looked up among locations first, then aliases
+def find_location(c, name):
+    row = c.execute(
+        '''SELECT location_id FROM locations WHERE name IN (?, ?)
+           ORDER BY name = ? DESC LIMIT 1''',
+        (name, legacy_table_name(name), name)
+    ).fetchone()
+    if row is None:
+        row = c.execute(
+            "SELECT location_id FROM aliases WHERE name = ?", (name,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+# Returns the key of the grid cell holding a point, like '40.7,-74.0',
+# or None without coordinates
+def grid_cell(latitude, longitude, degrees=None):
+    if latitude is None or longitude is None:
+        return None
+    degrees = degrees or GRID_CELL_DEGREES
+    digits = len(f"{degrees:g}".partition(".")[2])
+    return ",".join(
+        f"{round(float(value) / degrees) * degrees:.{digits}f}"
+        for value in (latitude, longitude)
+    )
+
+
+# Returns the grid cell a geocoded point shares with others for
+# requests to url, or None when requests to url are not shared
+# The same key is used to plan, fetch and store, so a city found in a
+# stored cell is never fetched and stored a second time
+def location_cell(url, latitude, longitude):
+    if url != ARCHIVE_URL:
+        return None
+    return grid_cell(latitude, longitude)
+
+
+# Returns the location_id of the first location in cell, or None
+def cell_location(c, cell):
+    row = c.execute(
+        '''SELECT location_id FROM locations WHERE cell = ?
+           ORDER BY location_id LIMIT 1''',
+        (cell,)
+    ).fetchone()
+    return row[0] if row else None
+
+
+# Returns the location_id for name, adding the location if needed
+# A new name in the grid cell of a stored location becomes an alias of
+# it instead, so both share one stored series
+def upsert_location(c, name, latitude=None, longitude=None, cell=None):
+    c.execute(
+        "UPDATE OR IGNORE locations SET name = ? WHERE name = ?",
+        (name, legacy_table_name(name))
+    )
+    location_id = find_location(c, name)
+    if location_id is None and cell is not None:
+        location_id = cell_location(c, cell)
+        if location_id is not None:
+            add_alias(c, name, location_id)
+            return location_id
+    elif location_id is not None and c.execute(
+            "SELECT 1 FROM aliases WHERE name = ?", (name,)).fetchone():
+        return location_id
+
+    c.execute(
+        '''INSERT INTO locations (name, latitude, longitude, cell)
+           VALUES (?, ?, ?, ?)
+           ON CONFLICT (name) DO UPDATE SET
+           latitude = coalesce(excluded.latitude, latitude),
+           longitude = coalesce(excluded.longitude, longitude),
+           cell = coalesce(cell, excluded.cell)''',
+        (name, latitude, longitude, cell)
+    )
+    return find_location(c, name)
+
+
+# Makes name another name of a stored location
+def add_alias(c, name, location_id):
+    c.execute(
+        "INSERT OR IGNORE INTO aliases VALUES (?, ?)", (name, location_id))
+    metrics.count('locations_shared')
+
+
+# Adds [start_date, end_date] to the coverage of a location variable,
+# merging it with any interval it overlaps or touches
+def record_coverage(c, location_id, variable, start_date, end_date):
+    intervals = c.execute(
+        '''SELECT start_date, end_date FROM coverage
+           WHERE location_id = ? AND variable = ?''',
+        (location_id, variable)
+    ).fetchall()
+    intervals = merge_intervals(intervals + [(start_date, end_date)])
+
+    c.execute(
+        "DELETE FROM coverage WHERE location_id = ? AND variable = ?",
+        (location_id, variable)
+    )
+    c.executemany(
+        "INSERT INTO coverage VALUES (?, ?, ?, ?)",
+        [(location_id, variable, start, end) for start, end in intervals]
+    )
+
+
+# Marks the stored data as changed, commits with the caller's transaction
+def bump_data_version(c):
+    c.execute(
+        '''INSERT INTO data_version VALUES (0, 1)
+           ON CONFLICT (id) DO UPDATE SET version = version + 1'''
+    )
+
+
+# Returns the version of the stored data, 0 before anything was written
+def data_version(c):
+    row = c.execute("SELECT version FROM data_version").fetchone()
+    return row[0] if row else 0
+
+
+# Marks the stored data of a location as changed
+def bump_location_version(c, location_id):
+    c.execute(
+        "UPDATE locations SET version = version + 1 WHERE location_id = ?",
+        (location_id,)
+    )
+
+
+# Returns the version of every location, in the order given
+def location_versions(c, location_ids):
+    placeholders = ", ".join("?" * len(location_ids))
+    versions = dict(c.execute(
+        f"SELECT location_id, version FROM locations "
+        f"WHERE location_id IN ({placeholders})",
+        list(location_ids)
+    ))
+    return tuple(versions.get(location_id) for location_id in location_ids)
+
+
+# Merges overlapping or adjacent yyyy-mm-dd intervals
+def merge_intervals(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and date.fromisoformat(start) <= (
+                date.fromisoformat(merged[-1][1]) + timedelta(days=1)):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Returns the (start, end) date ranges within [user_start, user_end]
+# that are not yet stored for every one of the variables
+# Provisional days never count as stored
+def missing_ranges(c, location_id, variables, user_start, user_end):
+    last_final = (
+        pd.Timestamp.now().normalize() - pd.Timedelta(days=PROVISIONAL_DAYS)
+    ).strftime("%Y-%m-%d")
+
+    gaps = []
+    for variable in variables:
+        intervals = c.execute(
+            '''SELECT start_date, min(end_date, ?) FROM coverage
+               WHERE location_id = ? AND variable = ?
+               AND end_date >= ? AND start_date <= ?
+               ORDER BY start_date''',
+            (last_final, location_id, variable, user_start, user_end)
+        ).fetchall()
+
+        cursor = pd.Timestamp(user_start)
+        for start, end in intervals:
+            if pd.Timestamp(start) > cursor:
+                gaps.append((
+                    cursor.strftime("%Y-%m-%d"),
+                    (pd.Timestamp(start) - pd.Timedelta(days=1))
+                    .strftime("%Y-%m-%d")
+                ))
+            cursor = max(cursor, pd.Timestamp(end) + pd.Timedelta(days=1))
+        if cursor <= pd.Timestamp(user_end):
+            gaps.append((cursor.strftime("%Y-%m-%d"), user_end))
+
+    return merge_intervals(gaps)
+
+
+# Series rows live in the observations table of the database
+# Rows are upserted on (location, date)
+class SQLiteBackend:
+    name = 'sqlite'
+
+    # Stores the rows of one location's dataframe
+    # Rows are zipped straight from the column arrays: tolist() turns a
+    # whole column into Python floats in C, and SQLite stores NaN as NULL
+    def write(self, c, location_id, dataframe, variables):
+        dates = day_strings(dataframe['date'])
+        rows = zip(
+            itertools.repeat(location_id), dates.tolist(),
+            *(
+                dataframe[variable].to_numpy(dtype='float64').tolist()
+                for variable in variables
+            )
+        )
+        placeholders = ", ".join("?" * (len(variables) + 2))
+        updates = ", ".join(
+            f"{variable} = excluded.{variable}" for variable in variables)
+        c.executemany(
+            f'''INSERT INTO observations
+                 (location_id, date, {", ".join(variables)})
+                 VALUES ({placeholders})
+                 ON CONFLICT (location_id, date) DO UPDATE SET {updates}''',
+            rows
+        )
+
+    # Returns (col_names, row batches) for a location and date range
+    def query(self, c, location_id, variables, user_start, user_end,
+              batch_rows=None):
+        cursor = c.execute(
+            f'''SELECT {", ".join(['date'] + variables)} FROM observations
+                 WHERE location_id = ? AND date BETWEEN ? AND ?
+                 ORDER BY date''',
+            (location_id, user_start, user_end)
+        )
+        col_names = [desc[0] for desc in cursor.description]
+        return col_names, iter_batches(cursor, batch_rows)
+
+    # Returns (col_names, row batches) for several locations and one date
+    # range from a single query, one primary key seek per location
+    # Rows start with the location name and are ordered by location_id,
+    # then by date, which is the primary key order, so nothing is sorted
+    def query_many(self, c, location_ids, variables, user_start, user_end,
+                   batch_rows=None):
+        placeholders = ", ".join("?" * len(location_ids))
+        cursor = c.execute(
+            f'''SELECT locations.name AS location,
+                       {", ".join(['date'] + variables)}
+                FROM observations JOIN locations USING (location_id)
+                WHERE location_id IN ({placeholders})
+                  AND date BETWEEN ? AND ?
+                ORDER BY location_id, date''',
+            list(location_ids) + [user_start, user_end]
+        )
+        col_names = [desc[0] for desc in cursor.description]
+        return col_names, iter_batches(cursor, batch_rows)
+
+    # Returns one float32 array per variable covering [user_start, user_end],
+    # NaN on the days without a value
+    # Rows are decoded one batch at a time straight into the arrays
+    def read_arrays(self, location_id, variables, user_start, user_end,
+                    c=None):
+        first = np.datetime64(user_start, 'D')
+        days = max(0, (np.datetime64(user_end, 'D') - first).astype(int) + 1)
+        arrays = {
+            variable: np.full(days, np.nan, dtype=np.float32)
+            for variable in variables
+        }
+        _, batches = self.query(
+            c, location_id, variables, user_start, user_end)
+        for rows in batches:
+            columns = list(zip(*rows))
+            offsets = (
+                np.array(columns[0], dtype='datetime64[D]') - first
+            ).astype(int)
+            for variable, column in zip(variables, columns[1:]):
+                arrays[variable][offsets] = np.array(column, dtype=np.float64)
+        return arrays
+
+    # Reads the stored rows of a location within [user_start, user_end]
+    def read(self, c, location_id, variables, user_start, user_end):
+        rows = c.execute(
+            f'''SELECT date, {", ".join(variables)} FROM observations
+                 WHERE location_id = ? AND date BETWEEN ? AND ?
+                 ORDER BY date''',
+            (location_id, user_start, user_end)
+        ).fetchall()
+        dataframe = pd.DataFrame(rows, columns=['date'] + variables)
+        dataframe['date'] = pd.to_datetime(dataframe['date'], utc=True)
+        dataframe[variables] = dataframe[variables].astype('float32')
+        return dataframe
+
+
+# Series live in raw float32 files, one per location, year and variable,
+# laid out as <root>/<location_id>/<year>/<variable>.f32
+# Each file holds one value per day of the year, NaN where nothing is
+# stored, so the date of a value is its offset and new days are written
+# in place without touching other partitions
+# Reads memory-map the files instead of decoding rows
+class ColumnarBackend:
+    name = 'columnar'
+
+    def __init__(self, root=None):
+        self.root = root or COLUMNAR_DIR
+
+    def partition_path(self, location_id, year, variable):
+        return os.path.join(
+            self.root, str(location_id), str(year), f"{variable}.f32")
+
+    # Stores the rows of one location's dataframe
+    def write(self, c, location_id, dataframe, variables):
+        dates = pd.DatetimeIndex(pd.to_datetime(dataframe['date']))
+        years = dates.year.to_numpy()
+        days = dates.dayofyear.to_numpy() - 1
+        for year in np.unique(years):
+            in_year = years == year
+            size = 366 if calendar.isleap(year) else 365
+            for variable in variables:
+                path = self.partition_path(location_id, year, variable)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    np.full(size, np.nan, dtype=np.float32).tofile(path)
+                column = np.memmap(path, dtype=np.float32, mode='r+')
+                column[days[in_year]] = (
+                    dataframe[variable].to_numpy(dtype=np.float32)[in_year])
+                column.flush()
+                del column
+
+    # Returns one array per variable covering [user_start, user_end]
+    # A range inside one year is a read-only view of the mapped file
+    def read_arrays(self, location_id, variables, user_start, user_end,
+                    c=None):
+        start = pd.Timestamp(user_start)
+        end = pd.Timestamp(user_end)
+        arrays = {variable: [] for variable in variables}
+        for year in range(start.year, end.year + 1):
+            first = start.dayofyear - 1 if year == start.year else 0
+            last = (
+                end.dayofyear if year == end.year
+                else (366 if calendar.isleap(year) else 365)
+            )
+            for variable in variables:
+                path = self.partition_path(location_id, year, variable)
+                if os.path.exists(path):
+                    column = np.memmap(path, dtype=np.float32, mode='r')
+                    arrays[variable].append(column[first:last])
+                else:
+                    arrays[variable].append(
+                        np.full(last - first, np.nan, dtype=np.float32))
+
+        return {
+            variable: parts[0] if len(parts) == 1 else np.concatenate(parts)
+            for variable, parts in arrays.items()
+        }
+
+    # Reads the stored days of a location within [user_start, user_end]
+    def read(self, c, location_id, variables, user_start, user_end):
+        arrays = self.read_arrays(
+            location_id, variables, user_start, user_end)
+        dates = pd.date_range(user_start, user_end, freq='D', tz='UTC')
+
+        # Days with no variable stored are left out, like missing rows
+        stored = np.zeros(len(dates), dtype=bool)
+        for values in arrays.values():
+            stored |= ~np.isnan(values)
+        dataframe = pd.DataFrame(
+            {variable: values[stored] for variable, values in arrays.items()})
+        dataframe.insert(0, 'date', dates[stored])
+        return dataframe
+
+    # Returns (col_names, row batches) for a location and date range,
+    # one batch per yearly partition
+    def query(self, c, location_id, variables, user_start, user_end,
+              batch_rows=None):
+        def batches():
+            for start, end in split_range(user_start, user_end, 'YS'):
+                dataframe = self.read(c, location_id, variables, start, end)
+                if dataframe.empty:
+                    continue
+                values = dataframe[variables].astype('float64')
+                values = values.astype(object).where(values.notna(), None)
+                yield list(zip(
+                    dataframe['date'].dt.strftime("%Y-%m-%d"),
+                    *(values[variable] for variable in variables)
+                ))
+
+        return ['date'] + variables, batches()
+
+    # Returns (col_names, row batches) for several locations, one
+    # location after the other in location_id order, rows starting with
+    # the location name
+    def query_many(self, c, location_ids, variables, user_start, user_end,
+                   batch_rows=None):
+        def batches():
+            for location_id in sorted(location_ids):
+                name, = c.execute(
+                    "SELECT name FROM locations WHERE location_id = ?",
+                    (location_id,)
+                ).fetchone()
+                _, location_batches = self.query(
+                    c, location_id, variables, user_start, user_end)
+                for rows in location_batches:
+                    yield [(name,) + tuple(row) for row in rows]
+
+        return ['location', 'date'] + variables, batches()
+
+
+storage_backends = {}
+
+
+# Returns the storage backend called name, STORAGE_BACKEND by default
+def get_backend(name=None):
+    name = name or STORAGE_BACKEND
+    if name not in storage_backends:
+        if name == SQLiteBackend.name:
+            storage_backends[name] = SQLiteBackend()
+        elif name == ColumnarBackend.name:
+            storage_backends[name] = ColumnarBackend()
+        else:
+            raise ValueError(f"Unknown storage backend: {name}")
+    return storage_backends[name]
+
+
+# Daily series of several cities on one shared date axis
+# array is a float32 array of shape (city, variable, day), NaN where a
+# city has no value, so the dates are kept once for every city and
+# operations across cities are single NumPy calls on array
+# It reads like the cities_dict of dataframes it replaces: iterating
+# gives the city names and series[city] a dataframe of the days that
+# city has, whose columns are views into array when it has them all
+class CitySeries(collections.abc.Mapping):
+    def __init__(self, days, names, variables, array=None, attrs=None):
+        self.days = np.asarray(days, dtype='datetime64[D]')
+        self.dates = pd.DatetimeIndex(
+            self.days.astype('datetime64[ns]')).tz_localize('UTC')
+        self.names = list(names)
+        self.variables = list(variables)
+        if array is None:
+            array = np.full(
+                (len(self.names), len(self.variables), len(self.days)),
+                np.nan, dtype=np.float32)
+        self.array = array
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        # Per city attributes like the dataframe.attrs they came with
+        self.attrs = attrs or {name: {} for name in self.names}
+
+    # Builds the series of a cities_dict, on the union of its dates
+    # variables defaults to every column of the first dataframe
+    @classmethod
+    def from_frames(cls, cities_dict, variables=None):
+        frames = list(cities_dict.items())
+        if variables is None:
+            variables = [
+                column for column in frames[0][1].columns if column != 'date'
+            ] if frames else []
+        days = [day_dates(frame['date']) for _, frame in frames]
+        axis = np.unique(np.concatenate(days)) if frames else []
+        series = cls(
+            axis, [name for name, _ in frames], variables,
+            attrs={name: dict(frame.attrs) for name, frame in frames}
+        )
+        for i, ((_, frame), frame_days) in enumerate(zip(frames, days)):
+            offsets = np.searchsorted(series.days, frame_days)
+            for v, variable in enumerate(variables):
+                if variable in frame:
+                    series.array[i, v, offsets] = frame[variable].to_numpy(
+                        dtype=np.float32)
+        return series
+
+    def __getitem__(self, name):
+        return self.frame(name)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Days on which a city has a value for any variable
+    def present(self, name):
+        return ~np.isnan(self.array[self.positions[name]]).all(axis=0)
+
+    # Dataframe of the days a city has, with a date column
+    def frame(self, name):
+        i = self.positions[name]
+        present = self.present(name)
+        if present.all():
+            dates, columns = self.dates, self.array[i]
+        else:
+            dates, columns = self.dates[present], self.array[i][:, present]
+        # One block over the transposed slice, so nothing is copied
+        dataframe = pd.DataFrame(columns.T, columns=self.variables, copy=False)
+        dataframe.insert(0, 'date', dates)
+        dataframe.attrs.update(self.attrs[name])
+        return dataframe
+
+    # Dates and values of the days a city has a value for variable,
+    # views of the shared arrays when there is no gap
+    def line(self, name, variable):
+        values = self.array[
+            self.positions[name], self.variables.index(variable)]
+        present = ~np.isnan(values)
+        if present.all():
+            return self.dates, values
+        return self.dates[present], values[present]
+
+    # City x day view of one variable
+    def column(self, variable):
+        return self.array[:, self.variables.index(variable)]
+
+    # Series holding only some of the variables
+    def subset(self, variables):
+        indices = [self.variables.index(variable) for variable in variables]
+        return CitySeries(
+            self.days, self.names, variables, self.array[:, indices],
+            self.attrs)
+
+
+# Returns cities_dict as a CitySeries, converting a dict of dataframes
+# with the given variables
+def to_series(cities_dict, variables=None):
+    if isinstance(cities_dict, CitySeries):
+        return cities_dict
+    return CitySeries.from_frames(cities_dict, variables)
+
+
+# Store data in a database file
+# Locations and coverage always go to the database,
+# the series themselves to the selected storage backend
+# Every city of the call is written in one transaction, on conn when
+# given so that streamed chunks reuse one connection
+# Hourly dataframes (resolution='hourly', with a time column) always go
+# to the hourly table
+def write_to_file(cities_dict, backend=None, conn=None, resolution='daily'):
+    storage = get_backend(backend)
+
+    with metrics.timer('write'):
+        write_cities(cities_dict, storage, backend, conn, resolution)
+
+
+# With commit=False the rows are left in the open transaction and the
+# data version is not bumped, the caller commits them
+def write_cities(cities_dict, storage, backend, conn, resolution='daily',
+                 commit=True):
+    # Create or connect to the database
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_database()
+    c = conn.cursor()
+
+    # Cities sharing a grid cell share one dataframe, written once
+    written = {}
+    time_column = TIME_COLUMNS[resolution]
+    for city, dataframe in cities_dict.items():
+        variables = [col for col in dataframe.columns if col != time_column]
+        if resolution == 'daily':
+            ensure_columns(c, variables)
+        attrs = dataframe.attrs
+        location_id = upsert_location(
+            c, city, attrs.get('latitude'), attrs.get('longitude'),
+            attrs.get('grid_cell'))
+        for alias in attrs.get('aliases', []):
+            add_alias(c, alias, location_id)
+        if dataframe.empty or written.get(location_id) is dataframe:
+            continue
+        written[location_id] = dataframe
+
+        bump_location_version(c, location_id)
+        if resolution == 'hourly':
+            days = write_hourly(c, location_id, dataframe, variables)
+            metrics.count('hours_written', len(dataframe))
+            first, last = str(days.min()), str(days.max())
+            for variable in variables:
+                record_coverage(
+                    c, location_id, HOURLY_COVERAGE + variable, first, last)
+            continue
+
+        storage.write(c, location_id, dataframe, variables)
+        metrics.count('rows_written', len(dataframe))
+
+        dates = day_dates(dataframe['date'])
+        first, last = str(dates.min()), str(dates.max())
+        for variable in variables:
+            record_coverage(c, location_id, variable, first, last)
+        with metrics.timer('rollups'):
+            update_rollups(
+                c, location_id, variables, first, last, backend)
+
+    if commit:
+        bump_data_version(c)
+        conn.commit()
+    if own_conn:
+        conn.close()
+
+
+# Sentinel telling a StoreWriter that nothing more is coming
+STORE_WRITER_STOP = object()
+
+
+# Writes the cities_dicts handed over by put() on a thread of its own,
+# so storing overlaps with fetching
+# Writes are committed once batch_rows rows are pending or the oldest
+# pending write is batch_seconds old, and once more when closed, so a
+# run that stops halfway keeps what it had written. The queue holds at
+# most queue_size cities_dicts, put() waits when the writer falls behind
+# The connection belongs to the writer until it is closed
+class StoreWriter:
+    def __init__(self, conn, backend=None, resolution='daily',
+                 batch_rows=None, batch_seconds=None, queue_size=None):
+        self.conn = conn
+        self.backend = backend
+        self.resolution = resolution
+        self.batch_rows = batch_rows or WRITE_BATCH_ROWS
+        self.batch_seconds = (
+            WRITE_BATCH_SECONDS if batch_seconds is None else batch_seconds)
+        self.queue = queue.Queue(queue_size or WRITE_QUEUE_SIZE)
+        self.error = None
+        self.commits = 0
+        self.thread = threading.Thread(
+            target=self.run, name='store-writer', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    # Whatever was queued is still written when the block raises
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            if exc_type is None:
+                raise
+        return False
+
+    # Queues a cities_dict for writing
+    # Raises the error of an earlier write that failed
+    def put(self, cities_dict):
+        if self.error is not None:
+            raise self.error
+        with metrics.timer('write_queue_wait'):
+            self.queue.put(cities_dict)
+
+    def run(self):
+        storage = get_backend(self.backend)
+        c = self.conn.cursor()
+        pending = 0
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                cities_dict = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # Nothing arrived in time, commit what is pending
+                self.commit(c)
+                pending, deadline = 0, None
+                continue
+            if cities_dict is STORE_WRITER_STOP:
+                break
+            if self.error is not None:
+                continue  # Drained so put() never blocks on a dead writer
+
+            # Each cities_dict is written whole or not at all, inside
+            # the transaction of the batch
+            if not self.conn.in_transaction:
+                c.execute("BEGIN")
+            c.execute("SAVEPOINT store_writer")
+            try:
+                with metrics.timer('write'):
+                    write_cities(cities_dict, storage, self.backend,
+                                 self.conn, self.resolution, commit=False)
+            except Exception as e:
+                c.execute("ROLLBACK TO store_writer")
+                c.execute("RELEASE store_writer")
+                self.error = e
+                continue
+            c.execute("RELEASE store_writer")
+
+            pending += sum(len(frame) for frame in cities_dict.values())
+            deadline = deadline or time.monotonic() + self.batch_seconds
+            if pending >= self.batch_rows or time.monotonic() >= deadline:
+                self.commit(c)
+                pending, deadline = 0, None
+        self.commit(c)
+
+    def commit(self, c):
+        if not self.conn.in_transaction:
+            return
+        with metrics.timer('commit'):
+            bump_data_version(c)
+            self.conn.commit()
+        self.commits += 1
+        metrics.count('write_commits')
+
+    # Waits until everything queued is committed and hands the
+    # connection back, raising the error of a write that failed
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(STORE_WRITER_STOP)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+# Reads the stored rows of a location within [user_start, user_end]
+def read_observations(c, location_id, variables, user_start, user_end,
+                      backend=None):
+    return get_backend(backend).read(
+        c, location_id, variables, user_start, user_end)
+
+
+# Reads the stored days of some cities within [user_start, user_end]
+# into one CitySeries, each city straight into its slice of array
+def read_series(c, cities, variables, user_start, user_end, backend=None):
+    storage = get_backend(backend)
+    cities = list(dict.fromkeys(cities))
+    series = CitySeries(
+        np.arange(np.datetime64(user_start, 'D'),
+                  np.datetime64(user_end, 'D') + 1),
+        cities, variables
+    )
+    for i, city in enumerate(cities):
+        location_id = find_location(c, city)
+        if location_id is None:
+            continue
+        latitude, longitude = c.execute(
+            "SELECT latitude, longitude FROM locations WHERE location_id = ?",
+            (location_id,)
+        ).fetchone()
+        series.attrs[city] = {'latitude': latitude, 'longitude': longitude}
+        arrays = storage.read_arrays(
+            location_id, variables, user_start, user_end, c)
+        for v, variable in enumerate(variables):
+            series.array[i, v] = arrays[variable]
+    return series
+
+
+# Returns the variables stored for a location, in column order
+def stored_variables(c, location_id):
+    return stored_variables_of(c, [location_id])
+
+
+# Returns the variables stored for any of the locations, in column order
+def stored_variables_of(c, location_ids):
+    placeholders = ", ".join("?" * len(location_ids))
+    stored = {
+        row[0] for row in c.execute(
+            f"SELECT DISTINCT variable FROM coverage "
+            f"WHERE location_id IN ({placeholders})",
+            list(location_ids))
+    }
+    columns = [
+        row[1] for row in c.execute("PRAGMA table_info(observations)")]
+    return [column for column in columns if column in stored]
+
+
+# Stores hourly values as one blob per UTC day and variable
+# Days already stored keep the hours the dataframe does not have
+# Returns the days written as a datetime64[D] array
+def write_hourly(c, location_id, dataframe, variables):
+    hours = day_dates(dataframe['time'], 'h').astype('int64')
+    first_day = hours.min() // 24
+    days = np.arange(first_day, hours.max() // 24 + 1).astype(
+        'datetime64[D]')
+    dates = days.astype(str).tolist()
+
+    for variable in variables:
+        grid = np.full(len(days) * 24, np.nan, dtype='<f4')
+        grid[hours - first_day * 24] = dataframe[variable].to_numpy(
+            dtype='float32')
+        grid = grid.reshape(len(days), 24)
+
+        for stored_date, blob in c.execute(
+                '''SELECT date, hours FROM hourly
+                   WHERE location_id = ? AND variable = ?
+                   AND date BETWEEN ? AND ?''',
+                (location_id, variable, dates[0], dates[-1])).fetchall():
+            row = grid[(np.datetime64(stored_date) - days[0]).astype(int)]
+            np.copyto(row, np.frombuffer(blob, dtype='<f4'),
+                      where=np.isnan(row))
+
+        keep = np.flatnonzero(~np.isnan(grid).all(axis=1))
+        c.executemany(
+            '''INSERT INTO hourly VALUES (?, ?, ?, ?)
+               ON CONFLICT (location_id, variable, date)
+               DO UPDATE SET hours = excluded.hours''',
+            zip(
+                itertools.repeat(location_id), itertools.repeat(variable),
+                [dates[i] for i in keep], [grid[i].tobytes() for i in keep]
+            )
+        )
+    return days
+
+
+# Reads the hourly values of a location within [user_start, user_end]
+# Only the blobs of those days are read, joined and decoded at once
+# Returns (hours as datetime64[h], {variable: float32 array}) covering
+# every hour of the range, NaN where nothing is stored
+def read_hourly(c, location_id, variables, user_start, user_end):
+    first = np.datetime64(user_start, 'D')
+    days = max(0, (np.datetime64(user_end, 'D') - first).astype(int) + 1)
+    times = first.astype('datetime64[h]') + np.arange(days * 24)
+
+    arrays = {}
+    for variable in variables:
+        grid = np.full((days, 24), np.nan, dtype='<f4')
+        rows = c.execute(
+            '''SELECT date, hours FROM hourly
+               WHERE location_id = ? AND variable = ?
+               AND date BETWEEN ? AND ?''',
+            (location_id, variable, user_start, user_end)
+        ).fetchall()
+        if rows:
+            dates, blobs = zip(*rows)
+            offsets = (np.array(dates, dtype='datetime64[D]') - first)
+            grid[offsets.astype(int)] = np.frombuffer(
+                b"".join(blobs), dtype='<f4').reshape(-1, 24)
+        arrays[variable] = grid.ravel()
+    return times, arrays
+
+
+# Returns the hourly variables stored for a location
+def stored_hourly_variables(c, location_id):
+    return [
+        row[0][len(HOURLY_COVERAGE):] for row in c.execute(
+            '''SELECT DISTINCT variable FROM coverage
+               WHERE location_id = ? AND substr(variable, 1, ?) = ?
+               ORDER BY variable''',
+            (location_id, len(HOURLY_COVERAGE), HOURLY_COVERAGE))
+    ]
+
+
+# Checks that buckets of bucket_hours start on midnight UTC
+# Buckets must divide a day or be whole days
+def check_bucket(bucket_hours):
+    if bucket_hours < 1 or (24 % bucket_hours and bucket_hours % 24):
+        raise ValueError(
+            "bucket hours must divide 24 or be a multiple of 24")
+
+
+# Aggregates hourly values into buckets of bucket_hours, counted from
+# 1970-01-01T00 UTC, with stat over the hours present in each bucket
+# times must be consecutive hours, as read_hourly returns them
+# Returns (bucket starts as datetime64[h], {variable: float64 array}),
+# NaN for buckets without any value
+def bucket_hourly(times, arrays, bucket_hours=1, stat='mean'):
+    if stat not in BUCKET_STATS:
+        raise ValueError(f"Unknown statistic: {stat}")
+    keys = times.astype('int64') // bucket_hours
+    if not len(keys):
+        return times, {variable: np.array([]) for variable in arrays}
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    buckets = {}
+    for variable, values in arrays.items():
+        values = values.astype('float64')
+        present = ~np.isnan(values)
+        count = np.add.reduceat(present, starts)
+        if stat == 'min':
+            result = np.fmin.reduceat(values, starts)
+        elif stat == 'max':
+            result = np.fmax.reduceat(values, starts)
+        else:
+            result = np.add.reduceat(np.where(present, values, 0), starts)
+            if stat == 'mean':
+                result = result / np.maximum(count, 1)
+            result[count == 0] = np.nan
+        buckets[variable] = result
+    return (keys[starts] * bucket_hours).astype('datetime64[h]'), buckets
+
+
+# Splits [user_start, user_end] into spans of about HOURLY_READ_DAYS
+# days whose boundaries are bucket boundaries, as (start, end) pairs
+def hourly_spans(user_start, user_end, bucket_hours=1):
+    step = max(1, bucket_hours // 24)
+    span = step * max(1, HOURLY_READ_DAYS // step)
+    first = int(np.datetime64(user_start, 'D').astype(int))
+    last = int(np.datetime64(user_end, 'D').astype(int))
+    bounds = list(range((first // span + 1) * span, last + 1, span))
+    return [
+        (str(np.datetime64(start, 'D')), str(np.datetime64(end, 'D')))
+        for start, end in zip(
+            [first] + bounds, [bound - 1 for bound in bounds] + [last])
+    ]
+
+
+# Returns (col_names, row batches) of hourly values of a location,
+# aggregated into buckets of bucket_hours with stat
+# Buckets without any value are left out, like missing rows
+# Each batch decodes one span of the range, so memory does not grow
+# with the length of the range
+def query_hourly(c, location_id, variables, user_start, user_end,
+                 bucket_hours=1, stat='mean'):
+    check_bucket(bucket_hours)
+    if stat not in BUCKET_STATS:
+        raise ValueError(f"Unknown statistic: {stat}")
+
+    def batches():
+        for start, end in hourly_spans(user_start, user_end, bucket_hours):
+            times, arrays = read_hourly(c, location_id, variables, start, end)
+            times, buckets = bucket_hourly(
+                times, arrays, bucket_hours, stat)
+            stored = np.zeros(len(times), dtype=bool)
+            for values in buckets.values():
+                stored |= ~np.isnan(values)
+            if not stored.any():
+                continue
+            columns = [
+                np.where(np.isnan(values), None, values)[stored].tolist()
+                for values in buckets.values()
+            ]
+            yield list(zip(
+                np.datetime_as_string(times[stored], unit='m').tolist(),
+                *columns))
+
+    return ['time'] + variables, batches()
+
+
+# Reads the stored hours of a location within [user_start, user_end]
+# into a dataframe, hours without any value are left out
+def read_hourly_frame(c, location_id, variables, user_start, user_end):
+    times, arrays = read_hourly(
+        c, location_id, variables, user_start, user_end)
+    stored = np.zeros(len(times), dtype=bool)
+    for values in arrays.values():
+        stored |= ~np.isnan(values)
+    dataframe = pd.DataFrame(
+        {variable: values[stored] for variable, values in arrays.items()})
+    dataframe.insert(0, 'time', pd.DatetimeIndex(times[stored], tz='UTC'))
+    return dataframe
+
+
+# Aggregates daily values per period key with NumPy
+# keys must be sorted, as read_observations returns them
+# Each period is padded with NaN to the longest one and sorted, NaN
+# last, so the statistics are reductions along the rows of a 2-D array
+# and percentiles interpolate between two columns of each row, like
+# np.nanpercentile without its loop over the rows
+# Returns (period keys, {statistic: array}) for periods with a value
+def summarize_periods(keys, values):
+    periods, starts, counts = np.unique(
+        keys, return_index=True, return_counts=True)
+    if not len(periods):
+        return periods, {}
+
+    rows = np.repeat(np.arange(len(periods)), counts)
+    offsets = np.arange(len(keys)) - np.repeat(starts, counts)
+    grid = np.full((len(periods), counts.max()), np.nan)
+    grid[rows, offsets] = values
+
+    days = np.count_nonzero(~np.isnan(grid), axis=1)
+    periods, grid, days = periods[days > 0], grid[days > 0], days[days > 0]
+    grid.sort(axis=1)
+    rows = np.arange(len(periods))
+    total = np.nansum(grid, axis=1)
+    stats = {
+        'days': days,
+        'mean': total / np.maximum(days, 1),
+        'min': grid[:, 0],
+        'max': grid[rows, days - 1],
+        'sum': total,
+    }
+    for percentile in ROLLUP_PERCENTILES:
+        position = percentile / 100 * (days - 1)
+        low = np.floor(position).astype(int)
+        high = np.minimum(low + 1, days - 1)
+        stats[f'p{percentile}'] = grid[rows, low] + (
+            grid[rows, high] - grid[rows, low]) * (position - low)
+    return periods, stats
+
+
+# Recomputes the rollups of every month and year touching
+# [start_date, end_date], then the climatology and anomalies, and the
+# weeks touching it
+# Only the touched years, and the weeks across their edges, are read
+# back, so new days cost one pass over their own years whatever the
+# length of the series
+def update_rollups(c, location_id, variables, start_date, end_date,
+                   backend=None):
+    first_year, last_year = str(start_date)[:4], str(end_date)[:4]
+    years = (np.datetime64(f"{first_year}-01-01"),
+             np.datetime64(f"{last_year}-12-31"))
+    weeks = (pyramid_period(start_date, 'week')[0],
+             pyramid_period(end_date, 'week')[1])
+    dataframe = read_observations(
+        c, location_id, variables, str(min(years[0], weeks[0])),
+        str(max(years[1], weeks[1])), backend
+    )
+    days = day_dates(dataframe['date'])
+    in_years = (days >= years[0]) & (days <= years[1])
+    dates = days[in_years]
+    columns = ['days', 'mean', 'min', 'max', 'sum'] + [
+        f'p{percentile}' for percentile in ROLLUP_PERCENTILES]
+
+    for variable in variables:
+        values = dataframe[variable].to_numpy(dtype='float64')
+        update_weeks(c, location_id, variable, days, values, *weeks)
+        values = values[in_years]
+        for period, unit in ROLLUP_PERIODS.items():
+            c.execute(
+                '''DELETE FROM rollups
+                   WHERE location_id = ? AND variable = ? AND period = ?
+                   AND period_start BETWEEN ? AND ?''',
+                (location_id, variable, period, first_year,
+                 f"{last_year}-12")
+            )
+            periods, stats = summarize_periods(
+                dates.astype(f'datetime64[{unit}]'), values)
+            if not len(periods):
+                continue
+            rows = zip(*[
+                stats[column].tolist() for column in columns])
+            c.executemany(
+                f'''INSERT INTO rollups
+                    (location_id, variable, period, period_start,
+                     {", ".join(columns)})
+                    VALUES (?, ?, ?, ?{", ?" * len(columns)})''',
+                [
+                    (location_id, variable, period, key, *row)
+                    for key, row in zip(periods.astype(str).tolist(), rows)
+                ]
+            )
+        update_anomalies(c, location_id, variable)
+
+
+# Rebuilds the baseline means of a location and variable from its
+# rollups, then every anomaly against them
+# Months are compared with the same calendar month of the baseline
+def update_anomalies(c, location_id, variable):
+    slot = "CASE period WHEN 'month' THEN substr(period_start, 6, 2) " \
+        "ELSE '' END"
+    c.execute(
+        "DELETE FROM climatology WHERE location_id = ? AND variable = ?",
+        (location_id, variable)
+    )
+    c.execute(
+        f'''INSERT INTO climatology
+            SELECT location_id, variable, period, {slot},
+                   AVG(mean), COUNT(*)
+            FROM rollups
+            WHERE location_id = ? AND variable = ?
+            AND CAST(substr(period_start, 1, 4) AS INTEGER) BETWEEN ? AND ?
+            GROUP BY period, {slot}''',
+        (location_id, variable, BASELINE_START, BASELINE_END)
+    )
+    c.execute(
+        f'''UPDATE rollups SET anomaly = mean - (
+                SELECT climatology.mean FROM climatology
+                WHERE climatology.location_id = rollups.location_id
+                AND climatology.variable = rollups.variable
+                AND climatology.period = rollups.period
+                AND climatology.slot = {slot})
+            WHERE location_id = ? AND variable = ?''',
+        (location_id, variable)
+    )
+
+
+# Returns (col_names, rows) of the rollups of a location and variable
+# whose period starts within [start_date, end_date]
+# Stored series without rollups yet (older databases) are rolled up
+# first, unless backfill is False as on read-only connections
+def query_rollups(c, location_id, variable, period='month',
+                  start_date=None, end_date=None, backend=None,
+                  backfill=True):
+    start = start_date or '0000'
+    end = end_date or '9999'
+
+    def select():
+        return c.execute(
+            '''SELECT * FROM rollups
+               WHERE location_id = ? AND variable = ? AND period = ?
+               AND period_start BETWEEN substr(?, 1, length(period_start))
+               AND substr(?, 1, length(period_start))
+               ORDER BY period_start''',
+            (location_id, variable, period, start, end)
+        )
+
+    cursor = select()
+    rows = cursor.fetchall()
+    if backfill and not rows and c.execute(
+            "SELECT 1 FROM rollups WHERE location_id = ? AND variable = ?",
+            (location_id, variable)).fetchone() is None:
+        span = c.execute(
+            '''SELECT MIN(start_date), MAX(end_date) FROM coverage
+               WHERE location_id = ? AND variable = ?''',
+            (location_id, variable)
+        ).fetchone()
+        if span[0] is not None:
+            update_rollups(c, location_id, [variable], *span, backend)
+            bump_data_version(c)
+            cursor = select()
+            rows = cursor.fetchall()
+    return [column[0] for column in cursor.description], rows
+
+
+# First day of the pyramid period of each day, as datetime64[D]
+# Weeks start on Mondays, day 4 of the NumPy epoch, and quarters on
+# January, April, July and October
+def pyramid_starts(days, level):
+    days = np.asarray(days, dtype='datetime64[D]')
+    if level == 'week':
+        ordinal = days.astype(np.int64)
+        return (ordinal - (ordinal - 4) % 7).astype('datetime64[D]')
+    if level == 'quarter':
+        months = days.astype('datetime64[M]').astype(np.int64)
+        return (months - months % 3).astype(
+            'datetime64[M]').astype('datetime64[D]')
+    unit = ROLLUP_PERIODS[level]
+    return days.astype(f'datetime64[{unit}]').astype('datetime64[D]')
+
+
+# First and last day of the pyramid period holding day
+def pyramid_period(day, level):
+    start = pyramid_starts([day], level)[0]
+    if level == 'week':
+        return start, start + 6
+    if level == 'year':
+        following = start.astype('datetime64[Y]') + 1
+    else:
+        following = start.astype('datetime64[M]') + (
+            3 if level == 'quarter' else 1)
+    return start, following.astype('datetime64[D]') - 1
+
+
+# Recomputes the weeks of a location variable within [first, last]
+# from the sorted days and values update_rollups read back
+# Weeks are contiguous runs of the days, so each statistic is one
+# ufunc.reduceat over them
+def update_weeks(c, location_id, variable, days, values, first, last):
+    c.execute(
+        '''DELETE FROM weeks
+           WHERE location_id = ? AND variable = ?
+           AND week_start BETWEEN ? AND ?''',
+        (location_id, variable, str(first), str(last))
+    )
+    inside = (days >= first) & (days <= last)
+    weeks, offsets = np.unique(
+        pyramid_starts(days[inside], 'week'), return_index=True)
+    if not len(weeks):
+        return
+    values = values[inside]
+    present = ~np.isnan(values)
+    counts = np.add.reduceat(present.astype(np.int64), offsets)
+    total = np.add.reduceat(np.where(present, values, 0), offsets)
+    kept = counts > 0
+    c.executemany(
+        '''INSERT INTO weeks
+           (location_id, variable, week_start, days, mean, min, max)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        [
+            (location_id, variable, *row)
+            for row in zip(
+                weeks[kept].astype(str).tolist(),
+                counts[kept].tolist(),
+                (total[kept] / counts[kept]).tolist(),
+                np.fmin.reduceat(values, offsets)[kept].tolist(),
+                np.fmax.reduceat(values, offsets)[kept].tolist())
+        ]
+    )
+
+
+# Returns (level, col_names, rows) of a location and variable within
+# [start_date, end_date], in at most points rows where it can: the
+# daily values if they fit, else the finest pyramid level that does,
+# up to years, so decades of days are read as hundreds of rows
+# Rows are (period start, mean, min, max, days), and the periods at
+# the edges include their days outside the range
+# Weeks come from their table, months and years from the rollups and
+# quarters are summed from the monthly rollups
+# Stored series without them yet (older databases) are rolled up
+# first, unless backfill is False as on read-only connections
+def read_pyramid(c, location_id, variable, start_date, end_date, points,
+                 backend=None, backfill=True):
+    span = c.execute(
+        '''SELECT MIN(start_date), MAX(end_date) FROM coverage
+           WHERE location_id = ? AND variable = ?''',
+        (location_id, variable)
+    ).fetchone()
+    if span[0] is None:
+        return 'day', PYRAMID_COLUMNS, []
+    start, end = max(str(start_date), span[0]), min(str(end_date), span[1])
+    if start > end:
+        return 'day', PYRAMID_COLUMNS, []
+
+    days = int((np.datetime64(end, 'D') - np.datetime64(start, 'D')).astype(
+        np.int64)) + 1
+    if days <= points:
+        _, batches = get_backend(backend).query(
+            c, location_id, [variable], start, end)
+        return 'day', PYRAMID_COLUMNS, [
+            (day, value, value, value, 1)
+            for batch in batches for day, value in batch
+            if value is not None
+        ]
+
+    level = next((
+        level for level, length in PYRAMID_LEVELS.items()
+        if days / length <= points), 'year')
+
+    first = str(pyramid_starts([start], level)[0])
+    table = 'weeks' if level == 'week' else 'rollups'
+
+    def select():
+        if level == 'week':
+            return c.execute(
+                '''SELECT week_start, mean, min, max, days FROM weeks
+                   WHERE location_id = ? AND variable = ?
+                   AND week_start BETWEEN ? AND ?
+                   ORDER BY week_start''',
+                (location_id, variable, first, end)
+            ).fetchall()
+        if level == 'quarter':
+            quarter = "printf('%s-%02d-01', substr(period_start, 1, 4), " \
+                "(CAST(substr(period_start, 6, 2) AS INTEGER) - 1) " \
+                "/ 3 * 3 + 1)"
+            return c.execute(
+                f'''SELECT {quarter} AS quarter,
+                          SUM(mean * days) / SUM(days), MIN(min), MAX(max),
+                          SUM(days)
+                   FROM rollups
+                   WHERE location_id = ? AND variable = ?
+                   AND period = 'month' AND period_start BETWEEN ? AND ?
+                   GROUP BY quarter ORDER BY quarter''',
+                (location_id, variable, first[:7], end[:7])
+            ).fetchall()
+        length, suffix = (7, '-01') if level == 'month' else (4, '-01-01')
+        return c.execute(
+            '''SELECT period_start || ?, mean, min, max, days FROM rollups
+               WHERE location_id = ? AND variable = ? AND period = ?
+               AND period_start BETWEEN ? AND ?
+               ORDER BY period_start''',
+            (suffix, location_id, variable, level, first[:length],
+             end[:length])
+        ).fetchall()
+
+    rows = select()
+    if backfill and not rows and c.execute(
+            f"SELECT 1 FROM {table} WHERE location_id = ? AND variable = ?",
+            (location_id, variable)).fetchone() is None:
+        update_rollups(c, location_id, [variable], *span, backend)
+        bump_data_version(c)
+        rows = select()
+    return level, PYRAMID_COLUMNS, rows
+
+
+# Reads one variable of some cities for a graph within
+# [user_start, user_end], through read_pyramid when the range has more
+# days than points: every period becomes its min on its first day and
+# its max halfway through, so the line still spans what it stands for
+def overview_series(c, cities, variable, user_start, user_end,
+                    points=GRAPH_PERIODS, backend=None, backfill=True):
+    days = (np.datetime64(user_end, 'D') - np.datetime64(user_start, 'D')
+            ).astype(np.int64) + 1
+    if days <= points:
+        return read_series(
+            c, cities, [variable], user_start, user_end, backend)
+
+    frames = {}
+    for city in dict.fromkeys(cities):
+        location_id = find_location(c, city)
+        if location_id is None:
+            continue
+        level, _, rows = read_pyramid(
+            c, location_id, variable, user_start, user_end, points,
+            backend, backfill
+        )
+        starts = np.array([row[0] for row in rows], dtype='datetime64[D]')
+        if level == 'day':
+            dates, values = starts, [row[1] for row in rows]
+        else:
+            middle = int(PYRAMID_LEVELS[level] // 2)
+            dates = np.column_stack([starts, starts + middle]).ravel()
+            values = [value for row in rows for value in row[2:4]]
+        frames[city] = pd.DataFrame({
+            'date': dates, variable: np.array(values, dtype=np.float64)})
+        frames[city].attrs.update(dict(zip(
+            ('latitude', 'longitude'),
+            c.execute(
+                '''SELECT latitude, longitude FROM locations
+                   WHERE location_id = ?''',
+                (location_id,)
+            ).fetchone()
+        )))
+    return CitySeries.from_frames(frames, [variable])
+
+
+# File extension written for each export format
+EXPORT_EXTENSIONS = {'csv': 'csv', 'parquet': 'parquet', 'arrow': 'arrow'}
+
+# Rows fetched from the database per export batch
+EXPORT_BATCH_ROWS = 10000
+
+# Results of query_cities up to QUERY_CACHE_MAX_ENTRY rows are kept in
+# memory, QUERY_CACHE_MAX_ROWS rows in total
+QUERY_CACHE_MAX_ROWS = 1000000
+QUERY_CACHE_MAX_ENTRY = 250000
+
+
+# Least recently used cache of query results
+# Every entry keeps the versions of its locations, an entry whose
+# locations have been written to since is dropped when it is next
+# looked up, while the results of other locations stay cached
+class QueryCache:
+    def __init__(self, max_rows=None, max_entry=None):
+        self.max_rows = max_rows or QUERY_CACHE_MAX_ROWS
+        self.max_entry = max_entry or QUERY_CACHE_MAX_ENTRY
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.rows = 0
+
+    # Returns (col_names, rows) stored for key at versions, or None
+    def get(self, key, versions):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != versions:
+                self.drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, versions, col_names, rows):
+        if len(rows) > self.max_entry:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (versions, col_names, rows)
+            self.rows += len(rows)
+            while self.rows > self.max_rows:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.rows -= len(evicted)
+
+    # The caller holds self.lock
+    def drop(self, key):
+        self.rows -= len(self.entries.pop(key)[2])
+
+    # Passes the batches of a query through, and stores the result once
+    # the last one was read if it is not larger than max_entry rows
+    def collect(self, key, versions, col_names, batches):
+        rows = []
+        for batch in batches:
+            if rows is not None:
+                rows.extend(batch)
+                if len(rows) > self.max_entry:
+                    rows = None
+            yield batch
+        if rows is not None:
+            self.put(key, versions, col_names, rows)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.rows = 0
+
+
+query_cache = QueryCache()
+
+
+# Path of the main database file of c, '' for an in-memory database
+def database_file(c):
+    return c.execute("PRAGMA database_list").fetchone()[2]
+
+
+# Queries several locations and variables over one date range
+# Returns (col_names, row batches), rows start with the location name and
+# are ordered by location_id, then by date
+# Results are cached until data of one of the locations is written
+def query_cities(c, location_ids, variables, user_start, user_end,
+                 backend=None):
+    columns = {row[1] for row in c.execute("PRAGMA table_info(observations)")}
+    unknown = [variable for variable in variables if variable not in columns]
+    if unknown:
+        raise ValueError(f"Unknown variables: {', '.join(unknown)}")
+
+    location_ids = sorted(set(location_ids))
+    # Location ids and versions repeat across databases, the file of the
+    # database tells them apart, or the connection for in-memory ones
+    source = database_file(c) or c.connection
+    key = (
+        source, tuple(location_ids), tuple(variables), user_start, user_end,
+        backend or STORAGE_BACKEND
+    )
+    versions = location_versions(c, location_ids)
+    cached = query_cache.get(key, versions)
+    if cached is not None:
+        metrics.count('query_cache_hits')
+        col_names, rows = cached
+        return col_names, (
+            rows[n:n + EXPORT_BATCH_ROWS]
+            for n in range(0, len(rows), EXPORT_BATCH_ROWS)
+        )
+
+    metrics.count('query_cache_misses')
+    col_names, batches = get_backend(backend).query_many(
+        c, location_ids, variables, user_start, user_end)
+    return col_names, query_cache.collect(key, versions, col_names, batches)
+
+
+# Drops the location column of a query_cities result,
+# for the columns of a single-city export
+def without_location(col_names, batches):
+    return col_names[1:], ([row[1:] for row in rows] for rows in batches)
+
+
+# Finds a stored location whose name, or one of its aliases, contains
+# the user input
+# Names migrated from older versions use underscores for spaces
+def match_location(c, user_input_city):
+    row = c.execute(
+        '''SELECT location_id FROM (
+               SELECT location_id, name FROM locations
+               UNION ALL SELECT location_id, name FROM aliases)
+           WHERE instr(name, ?) > 0 OR instr(name, ?) > 0
+           ORDER BY location_id LIMIT 1''',
+        (user_input_city, user_input_city.replace(" ", "_"))
+    ).fetchone()
+    return row[0] if row else None
+
+
+# Exports the stored data of some cities and a date range
+# Several cities, separated by commas, are exported to one file with a
+# location column
+# export_format is one of EXPORT_EXTENSIONS, backend a storage backend name
+# conn is kept open so that repeated queries reuse it and its cache
+def query_database(export_format='csv', backend=None, conn=None):
+    # Connect to the SQLite database
+    own_conn = conn is None
+    if own_conn:
+        conn = connect_database()
+    c = conn.cursor()
+
+    # Getting city names
+    while True:
+        user_input_cities = [
+            city.strip() for city in input(
+                "Enter the name of the city you want to query "
+                "(several separated by commas): "
+            ).split(",") if city.strip()
+        ]
+
+        # Attempt to find a city in the database that matches
+        # Or partially matches the user input
+        location_ids = [
+            match_location(c, city) for city in user_input_cities]
+
+        if not location_ids or None in location_ids:
+            print(
+                "Error: City not found in database. "
+                "Please enter a valid city name."
+                )
+            continue
+        break
+
+    # Get the date range the user wants
+    while True:
+        start_date = input(
+            "Enter the start date (format: yyyy-mm-dd): "
+            )
+        end_date = input(
+            "Enter the end date (format: yyyy-mm-dd): "
+            )
+
+        try:
+            # Validate the date format
+            datetime.strptime(start_date, "%Y-%m-%d")
+            datetime.strptime(end_date, "%Y-%m-%d")
+            break
+        except ValueError:
+            print(
+                "Error: Invalid date format."
+                "Please enter the date in yyyy-mm-dd format."
+            )
+
+    filename = export_filename(
+        "_".join(user_input_cities), start_date, end_date, export_format)
+    try:
+        col_names, batches = query_cities(
+            c, location_ids, stored_variables_of(c, location_ids),
+            start_date, end_date, backend
+        )
+        if len(set(location_ids)) == 1:
+            col_names, batches = without_location(col_names, batches)
+        row_count = export_rows(batches, col_names, filename, export_format)
+    except ImportError:
+        print(
+            "Error: Parquet and Arrow exports need pyarrow. "
+            "Install it with 'pip install pyarrow'."
+        )
+        return
+    finally:
+        # Close the database connection
+        if own_conn:
+            conn.close()
+
+    if row_count:
+        print(f"Results saved to {filename}")
+    else:
+        print("No results found for the specified criteria.")
+
+
+# Exports the stored data of a location within [start_date, end_date]
+# to <label>_weather_data_<start_date>_to_<end_date>.<extension>
+# Returns the filename and the number of rows written
+def export_location(c, location_id, label, start_date, end_date,
+                    export_format='csv', backend=None, directory=None):
+    # Select data within the specified date range
+    # With SQLite this is a seek on the (location_id, date) primary key
+    variables = stored_variables(c, location_id)
+    col_names, batches = get_backend(backend).query(
+        c, location_id, variables, start_date, end_date)
+
+    # Rows are streamed from the backend straight into the file
+    filename = export_filename(
+        label, start_date, end_date, export_format, directory)
+    return filename, export_rows(batches, col_names, filename, export_format)
+
+
+# Returns <label>_weather_data_<start_date>_to_<end_date>.<extension>
+def export_filename(label, start_date, end_date, export_format='csv',
+                    directory=None):
+    return os.path.join(directory or '', (
+        f"{label}_weather_data_{start_date}_to_{end_date}"
+        f".{EXPORT_EXTENSIONS.get(export_format, export_format)}"
+    ))
+
+
+# Yields the rows of one city of a CitySeries in batches of size rows,
+# skipping the days it has no value for and with NaN as None
+def series_batches(series, city, size=None):
+    size = size or EXPORT_BATCH_ROWS
+    present = series.present(city)
+    days = series.days[present].astype(str)
+    values = series.array[series.positions[city]][:, present]
+    for start in range(0, len(days), size):
+        columns = values[:, start:start + size].astype('float64')
+        columns = columns.astype(object)
+        columns[np.isnan(columns.astype('float64'))] = None
+        yield list(zip(days[start:start + size].tolist(), *columns))
+
+
+# Exports one city of a CitySeries to filename
+# Returns the number of rows written
+def export_series(series, city, filename, export_format='csv'):
+    return export_rows(
+        series_batches(series, city), ['date'] + series.variables,
+        filename, export_format)
+
+
+# Yields the rows of an executed cursor in batches of size rows
+def iter_batches(cursor, size=None):
+    size = size or EXPORT_BATCH_ROWS
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+# Streams the rows of an executed cursor into filename
+# The file is only created when there is at least one row
+# Returns the number of rows written
+def export_results(cursor, filename, export_format='csv', batch_rows=None):
+    # Get column names from cursor description
+    col_names = [desc[0] for desc in cursor.description]
+    return export_rows(
+        iter_batches(cursor, batch_rows), col_names, filename, export_format)
+
+
+# Streams row batches into filename
+# The file is only created when there is at least one row
+# Returns the number of rows written
+def export_rows(batches, col_names, filename, export_format='csv'):
+    if export_format not in EXPORT_EXTENSIONS:
+        raise ValueError(f"Unknown export format: {export_format}")
+
+    batches = iter(batches)
+    first = next(batches, None)
+    if first is None:
+        return 0
+
+    batches = itertools.chain([first], batches)
+    with metrics.timer('export'):
+        if export_format == 'csv':
+            row_count = export_csv(batches, col_names, filename)
+        else:
+            row_count = export_columnar(
+                batches, col_names, filename, export_format)
+    metrics.count('rows_exported', row_count)
+    metrics.count('bytes_exported', os.path.getsize(filename))
+    return row_count
+
+
+# Writes row batches to a CSV file, one batch in memory at a time
+# A file left unfinished by an error is removed
+def export_csv(batches, col_names, filename):
+    row_count = 0
+    try:
+        with open(filename, 'w', newline='') as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(col_names)  # Write column headers
+            for rows in batches:
+                csv_writer.writerows(rows)   # Write data rows
+                row_count += len(rows)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    return row_count
+
+
+# Writes row batches to a Parquet or Arrow IPC file as record batches
+# location is a string column, date date32, every other column float64
+# A file left unfinished by an error is removed
+def export_columnar(batches, col_names, filename, export_format):
+    import pyarrow as pa
+
+    types = {'location': pa.string(), 'date': pa.date32()}
+    schema = pa.schema([
+        pa.field(name, types.get(name, pa.float64())) for name in col_names])
+
+    def array(name, column):
+        if name == 'date':
+            column = [
+                datetime.strptime(day, "%Y-%m-%d").date() for day in column]
+        return pa.array(column, type=schema.field(name).type)
+
+    row_count = 0
+    try:
+        if export_format == 'parquet':
+            import pyarrow.parquet as pq
+            writer = pq.ParquetWriter(filename, schema)
+        else:
+            writer = pa.ipc.new_file(filename, schema)
+        with writer:
+            for rows in batches:
+                arrays = [
+                    array(name, column)
+                    for name, column in zip(col_names, zip(*rows))
+                ]
+                writer.write_batch(
+                    pa.RecordBatch.from_arrays(arrays, schema=schema))
+                row_count += len(rows)
+    except BaseException:
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
+    return row_count
+
+
+# Checks if date is before 2016 (Archive API vs Forecast API)
+def check_date(date_str):
+    str_list = date_str.split("-")
+    year = int(str_list[0])
+
+    if year < 2016:
+        return True
+    else:
+        return False
+
+
+# Ensures the date is in the correct format
+# Return the str as it's needed later
+def ensure_valid_date(prompt):
+    while True:
+        user_input = input(prompt)
+        try:
+            valid_date = datetime.strptime(user_input, "%Y-%m-%d")
+            return user_input
+        except ValueError:
+            print(
+                "Invalid date format. "
+                "Please enter the date in yyyy-mm-dd format."
+            )
 
 
-# Needed to find lat & long given city name
-geolocator = Nominatim(user_agent='weather_data')
+# Checks if the date range is valid
+def check_range(user_start, user_end):
+    error_code = 0
+    user_start_datetime = datetime.strptime(user_start, "%Y-%m-%d")
+    user_end_datetime = datetime.strptime(user_end, "%Y-%m-%d")
 
+    # Check if start date is after end date
+    if user_end_datetime < user_start_datetime:
+        error_code = -1
 
-# Store data in a database file
-def write_to_file(cities_dict):
-    # Create or connect to the database
-    conn = sqlite3.connect('weather_data.db')
-    c = conn.cursor()
+    # Check if start date is before 1940
+    minimum_start = datetime.strptime("1940-01-01", "%Y-%m-%d")
+    if user_start_datetime < minimum_start:
+        error_code = -2
 
-    # Create a new table for each city
-    for city, dataframe in cities_dict.items():
-        city_table = (
-            city.replace(" ", "_")
-                .replace(",", "")
-                .replace("(", "")
-                .replace(")", "")
-                .replace("User_entered:", "")
-                .replace("-", "_")
-                .replace("__", "_")
-                .replace("'", "")
+    # Check if end date is after the current date
+    if user_end_datetime > datetime.now():
+        error_code = -3
+
+    return error_code
+
+
+# Returns the indices of the points worth drawing when values are
+# plotted across buckets pixel columns
+# Every column keeps its first, last, minimum and maximum point, which
+# draws the same line as the full series at that width
+def minmax_downsample(values, buckets):
+    values = np.asarray(values, dtype=np.float64)
+    count = len(values)
+    if buckets <= 0 or count <= 4 * buckets:
+        return np.arange(count)
+
+    # Equal-sized buckets, the last one padded with NaN
+    size = -(-count // buckets)
+    buckets = -(-count // size)
+    padded = np.full(buckets * size, np.nan)
+    padded[:count] = values
+    padded = padded.reshape(buckets, size)
+
+    starts = np.arange(buckets) * size
+    missing = np.isnan(padded)
+    lows = np.where(missing, np.inf, padded).argmin(axis=1)
+    highs = np.where(missing, -np.inf, padded).argmax(axis=1)
+    lasts = np.minimum(starts + size - 1, count - 1)
+
+    return np.unique(np.concatenate(
+        [starts, starts + lows, starts + highs, lasts]))
+
+
+# Number of pixel columns a figure is saved with
+def point_budget(figure, dpi=None):
+    import matplotlib
+
+    dpi = dpi or matplotlib.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = figure.dpi
+    return int(figure.get_figwidth() * dpi)
+
+
+# Draws target_var for every city onto figure
+# Long series are decimated to the width of the figure before plotting
+def draw_graph(figure, cities_dict, target_var):
+    series = to_series(cities_dict, [target_var])
+    axes = figure.subplots()
+    budget = point_budget(figure)
+    for city in series:
+        dates, values = series.line(city, target_var)
+        keep = minmax_downsample(values, budget)
+        axes.plot(
+            dates[keep], values[keep], label=target_var + " " + city)
+
+    axes.set_xlabel('Date')
+    axes.set_ylabel(target_var)
+    axes.set_title(target_var + " over time")
+    axes.legend()
+
+
+# Renders one graph to a PNG on its own Agg figure
+# The figure never goes through pyplot, so no global state is touched
+# and it is cleared and released once saved
+# Returns True when a character of a city name could not be displayed
+def render_graph(cities_dict, target_var, filename=None):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    filename = filename or target_var + '_plot.png'
+
+    # Warning filter for city names with unrecognized characters
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+
+        figure = Figure(figsize=(12, 6))
+        FigureCanvasAgg(figure)
+        try:
+            with metrics.timer('draw'):
+                draw_graph(figure, cities_dict, target_var)
+            with metrics.timer('savefig'):
+                figure.savefig(filename)
+        finally:
+            figure.clear()
+
+    return any(
+        issubclass(warning.category, UserWarning)
+        and "Glyph" in str(warning.message)
+        for warning in w
+    )
+
+
+# Creates a graph based on the cities and variable given
+def create_graph(cities_dict, target_var):
+    # Replace the glyph warning with a custom message
+    if render_graph(cities_dict, target_var):
+        print(
+            "Warning: cannot properly display "
+            "one or more characters in the city name"
+            )
+
+    print("Graph has been saved")
+
+
+# Process pool entry point, job is (cities_dict, target_var, filename)
+# Returns the worker's metrics of the job along with the result
+def render_job(job):
+    cities_dict, target_var, filename = job
+    metrics.reset()
+    glyph_missing = render_graph(cities_dict, target_var, filename)
+    return filename, glyph_missing, metrics.snapshot()
+
+
+# Renders every (cities_dict, target_var, filename) job
+# Jobs are spread over a pool of max_workers processes,
+# each job only ships the dates and the target_var slice of array
+# to its worker
+# Returns (filename, glyph_missing) pairs in job order
+def render_graphs(jobs, max_workers=None):
+    jobs = [
+        (
+            to_series(cities_dict, [target_var]).subset([target_var]),
+            target_var, filename
         )
+        for cities_dict, target_var, filename in jobs
+    ]
+    if len(jobs) <= 1 or max_workers == 1:
+        return [
+            (filename, render_graph(cities_dict, target_var, filename))
+            for cities_dict, target_var, filename in jobs
+        ]
 
-        c.execute(f'''CREATE TABLE IF NOT EXISTS {city_table} (
-                        date TEXT,
-                        temperature_2m_max REAL,
-                        temperature_2m_min REAL,
-                        uv_index_max REAL,
-                        precipitation_sum REAL,
-                        wind_speed_10m_max REAL)''')
+    from concurrent.futures import ProcessPoolExecutor
 
-        # Write the dataframe to the table
-        dataframe.to_sql(city_table, conn, if_exists='replace', index=False)
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for filename, glyph_missing, snapshot in executor.map(
+                render_job, jobs):
+            metrics.merge(snapshot)
+            results.append((filename, glyph_missing))
+    return results
 
-    conn.commit()
-    conn.close()
 
+# Renders a graph for every combination of city group and variable
+# city_groups maps a group name to a cities_dict,
+# graphs are saved as <variable>_<group>_plot.png in directory
+# Returns (filename, glyph_missing) pairs
+def render_all(city_groups, variables, max_workers=None, directory=None):
+    jobs = [
+        (
+            cities_dict, target_var,
+            os.path.join(
+                directory or '',
+                f"{target_var}_{re.sub(r'[^A-Za-z0-9]+', '_', group)}"
+                "_plot.png"
+            )
+        )
+        for group, cities_dict in city_groups.items()
+        for target_var in variables
+    ]
+    return render_graphs(jobs, max_workers)
 
-def query_database():
-    # Connect to the SQLite database
-    conn = sqlite3.connect('weather_data.db')
-    c = conn.cursor()
 
-    # Getting city name
-    while True:
-        user_input_city = input(
-            "Enter the name of the city you want to query: "
+# Endpoints and the daily variables requested from each one.
+# The order of variables needs to be the same as requested.
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+FORECAST_VARIABLES = [
+    "temperature_2m_max", "temperature_2m_min", "uv_index_max",
+    "precipitation_sum", "wind_speed_10m_max"]
+
+ARCHIVE_URL = "https://archive-api.open-meteo.com/v1/archive"
+ARCHIVE_VARIABLES = [
+    "temperature_2m_max", "temperature_2m_min",
+    "temperature_2m_mean", "precipitation_sum",
+    "wind_speed_10m_max", "shortwave_radiation_sum"]
+
+# Upper bound on the number of requests in flight at the same time
+MAX_WORKERS = 8
+
+# Upper bound on the number of locations packed into one API request
+BATCH_SIZE = 50
+
+# Long date ranges are split into chunks starting on this pandas
+# frequency ('YS' is one chunk per calendar year)
+CHUNK_FREQ = 'YS'
+
+# Hourly values of a quarter per request, about 2,200 hours
+HOURLY_CHUNK_FREQ = 'QS'
+
+# Hourly variables fetched unless others are asked for
+HOURLY_VARIABLES = [
+    "temperature_2m", "relative_humidity_2m", "precipitation",
+    "wind_speed_10m", "shortwave_radiation"]
+
+# Extra attempts for a chunk that fails, waiting
+# CHUNK_BACKOFF * 2 ** attempt seconds in between
+CHUNK_RETRIES = 2
+CHUNK_BACKOFF = 1.0
+
+# Fetched chunks waiting to be stored before fetching waits for the
+# writer, and the rows or seconds after which the writer commits
+WRITE_QUEUE_SIZE = 16
+WRITE_BATCH_ROWS = 100000
+WRITE_BATCH_SECONDS = 2.0
+
+RATE_LIMIT_ERROR = (
+    'Minutely API request limit exceeded. '
+    'Please try again in one minute.'
+)
+
+# Seconds to wait once the minutely request limit is hit
+RATE_LIMIT_WAIT = 60
+
+# The other limits the API answers with, by the window they apply to
+RATE_LIMIT_ERRORS = {
+    RATE_LIMIT_ERROR: 'minute',
+    'Hourly API request limit exceeded. '
+    'Please try again in the next hour.': 'hour',
+    'Daily API request limit exceeded. '
+    'Please try again tomorrow.': 'day',
+}
+
+# Weighted API calls allowed per window, as (seconds, calls)
+# These are the free tier's limits. A call counts once per location,
+# times variables / 10 and days / 14 when it asks for more than that
+API_RATE_LIMITS = {
+    'minute': (60, 600),
+    'hour': (3600, 5000),
+    'day': (86400, 10000),
+}
+
+# Share of every limit requests are paced to, the rest is left for
+# other clients on the same address
+API_RATE_HEADROOM = 0.95
+
+# Longest a request waits for the rate budget, in seconds
+# A request that would wait longer, like after the hourly or daily
+# limit was hit, fails instead of holding the run for hours
+RATE_MAX_WAIT = 300
+
+# Weighted calls of the last day, kept across runs
+RATE_BUDGET_FILE = 'rate_budget.db'
+
+# Format parameter the SDK adds to every request
+API_FORMAT = 'flatbuffers'
+
+# HTTP cache of the API responses, requests_cache adds '.sqlite'
+HTTP_CACHE_FILE = '.cache'
+
+# Least recently used responses are evicted above this many body bytes
+HTTP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds a response stays cached, per endpoint: 'final' when every
+# requested day is older than PROVISIONAL_DAYS, 'recent' otherwise
+# -1 never expires, archive days do not change once final
+NEVER_EXPIRE = -1
+HTTP_CACHE_POLICY = {
+    ARCHIVE_URL: {'final': NEVER_EXPIRE, 'recent': 3600},
+    FORECAST_URL: {'final': 24 * 3600, 'recent': 15 * 60},
+}
+HTTP_CACHE_EXPIRY = 3600
+
+
+# Picks how long the response to a request may be cached
+def cache_expiry(url, params):
+    policy = HTTP_CACHE_POLICY.get(url)
+    if policy is None:
+        return HTTP_CACHE_EXPIRY
+
+    end_date = params.get('end_date')
+    final_before = date.today() - timedelta(days=PROVISIONAL_DAYS)
+    if end_date and date.fromisoformat(str(end_date)[:10]) < final_before:
+        return policy['final']
+    return policy['recent']
+
+
+# requests_cache session with a size cap and hit/miss counters
+# Sizes and last use times are kept next to the cached responses
+# so the least recently used ones are evicted first across runs
+class HTTPCache:
+    def __init__(self, path=HTTP_CACHE_FILE, max_bytes=None):
+        import requests_cache
+
+        self.session = requests_cache.CachedSession(
+            path, expire_after=HTTP_CACHE_EXPIRY)
+        # The API client cannot pass an expiry, the session picks it
+        self.session_request = self.session.request
+        self.session.request = self.request
+        self.max_bytes = max_bytes or HTTP_CACHE_MAX_BYTES
+        self.lock = threading.Lock()
+        self.counts = {
+            'hits': 0, 'misses': 0, 'bytes_from_cache': 0,
+            'bytes_fetched': 0, 'evictions': 0, 'bytes_evicted': 0,
+        }
+        self.responses_table = self.session.cache.responses.table_name
+        self.conn = sqlite3.connect(
+            self.session.cache.responses.db_path,
+            timeout=30, check_same_thread=False
         )
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS cache_usage (
+                                    key TEXT PRIMARY KEY,
+                                    size INTEGER,
+                                    last_used REAL)''')
+            # Responses cached before tracking started count as oldest
+            self.conn.execute(
+                f"INSERT OR IGNORE INTO cache_usage "
+                f"SELECT key, length(value), 0 FROM {self.responses_table}"
+            )
+        self.session.hooks['response'].append(self.record)
 
-        # Attempt to find a city in the database that matches
-        # Or partially matches the user input
-        c.execute(
-            f"SELECT name FROM sqlite_master WHERE type='table';"
+    # Session request, expiring as cache_expiry says unless the caller
+    # gives an expiry
+    def request(self, method, url, *args, expire_after=None, **kwargs):
+        if expire_after is None:
+            expire_after = cache_expiry(url, kwargs.get('params') or {})
+        return self.session_request(
+            method, url, *args, expire_after=expire_after, **kwargs)
+
+    # True when a request for url and params would be answered from the
+    # cache without reaching the API
+    def is_fresh(self, url, params):
+        import requests
+
+        prepared = requests.Request(
+            'GET', url, params=dict(params, format=API_FORMAT)).prepare()
+        key = self.session.cache.create_key(prepared)
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT expires FROM {self.responses_table} WHERE key = ?",
+                (key,)
+            ).fetchone()
+        return row is not None and (row[0] is None or row[0] > time.time())
+
+    # Response hook: counts the response and marks it as used
+    def record(self, response, *args, **kwargs):
+        # requests runs the hook once more on misses, before
+        # requests_cache has wrapped the response
+        if not hasattr(response, 'from_cache'):
+            return response
+
+        size = len(response.content or b'')
+        with self.lock:
+            metrics.count(
+                'http_cache_hits' if response.from_cache
+                else 'http_cache_misses')
+            if response.from_cache:
+                self.counts['hits'] += 1
+                self.counts['bytes_from_cache'] += size
+            else:
+                self.counts['misses'] += 1
+                self.counts['bytes_fetched'] += size
+            if response.cache_key:
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO cache_usage VALUES (?, ?, ?)",
+                        (response.cache_key, size, time.time())
+                    )
+                if not response.from_cache:
+                    self.evict()
+        return response
+
+    # Deletes least recently used responses until under max_bytes
+    # The caller holds self.lock
+    def evict(self):
+        with self.conn:
+            # Forget responses requests_cache already dropped
+            self.conn.execute(
+                f"DELETE FROM cache_usage WHERE key NOT IN "
+                f"(SELECT key FROM {self.responses_table})"
             )
-        tables = c.fetchall()
-        city_table = None
-        for table in tables:
-            if user_input_city in table[0]:
-                city_table = table[0]
-                break
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM cache_usage"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
 
-        if not city_table:
-            print(
-                "Error: City not found in database. "
-                "Please enter a valid city name."
-                )
-            continue
+            victims = []
+            for key, size in self.conn.execute(
+                    "SELECT key, size FROM cache_usage ORDER BY last_used"):
+                if total <= self.max_bytes:
+                    break
+                victims.append(key)
+                total -= size
+                self.counts['bytes_evicted'] += size
+            self.conn.executemany(
+                "DELETE FROM cache_usage WHERE key = ?",
+                [(key,) for key in victims]
+            )
+        self.session.cache.delete(*victims)
+        self.counts['evictions'] += len(victims)
 
-        try:
-            break
-        except ValueError:
-            print(
-                "Error: City not found in database."
-                "Please enter a valid city name."
-                )
+    # Counters of this process plus what the cache holds now
+    def stats(self):
+        with self.lock:
+            entries, size = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_usage"
+            ).fetchone()
+            stats = dict(self.counts)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / requests if requests else 0.0
+        stats['entries'] = entries
+        stats['bytes'] = size
+        stats['max_bytes'] = self.max_bytes
+        return stats
 
-    # Get the date range the user wants
-    while True:
-        start_date = input(
-            "Enter the start date (format: yyyy-mm-dd): "
+    def close(self):
+        with self.lock:
+            self.conn.close()
+        self.session.close()
+
+
+http_cache = None
+
+
+# Opens the HTTP cache on first use
+def get_http_cache():
+    global http_cache
+    with init_lock:
+        if http_cache is None:
+            http_cache = HTTPCache(HTTP_CACHE_FILE)
+    return http_cache
+
+
+# Prints the cache counters, one per line
+def print_cache_stats(stats):
+    print("HTTP cache:")
+    print(f"  requests: {stats['hits'] + stats['misses']} "
+          f"({stats['hits']} hits, {stats['misses']} misses, "
+          f"{stats['hit_ratio']:.0%} hit ratio)")
+    print(f"  bytes: {stats['bytes_from_cache']} from cache, "
+          f"{stats['bytes_fetched']} fetched")
+    print(f"  evicted: {stats['evictions']} responses, "
+          f"{stats['bytes_evicted']} bytes")
+    print(f"  stored: {stats['entries']} responses, "
+          f"{stats['bytes']} of {stats['max_bytes']} bytes")
+
+
+# Returns what a request counts against the API limits: one call per
+# location, scaled up by the variables over 10 and the days over 14
+def request_weight(params):
+    locations = len(str(params.get('latitude', '')).split(','))
+    variables = max((
+        len(params[resolution]) for resolution in TIME_COLUMNS
+        if resolution in params
+    ), default=1)
+    days = 1
+    if params.get('start_date') and params.get('end_date'):
+        days = (
+            date.fromisoformat(str(params['end_date'])[:10])
+            - date.fromisoformat(str(params['start_date'])[:10])
+        ).days + 1
+    return locations * max(1.0, variables / 10) * max(1.0, days / 14)
+
+
+# Heaviest request every window of API_RATE_LIMITS can take,
+# infinite without limits
+def max_request_weight():
+    return min((
+        limit * API_RATE_HEADROOM for _, limit in API_RATE_LIMITS.values()
+    ), default=float('inf'))
+
+
+# Paces API requests to stay under API_RATE_LIMITS
+# Every request is recorded with its weight and time in path, so runs
+# following each other, and processes running side by side, share one
+# budget. A request waits until every window has room for its weight
+class RateBudget:
+    def __init__(self, path=RATE_BUDGET_FILE):
+        self.conn = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS api_calls (
+                                    at REAL,
+                                    weight REAL)''')
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS api_calls_at ON api_calls (at)")
+            # Times before which no request is sent, set when the API
+            # answered that a limit was hit anyway
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS api_blocks (
+                                    until REAL)''')
+
+    # Seconds until a request of weight fits in every window
+    # The caller holds self.lock inside a transaction
+    def wait_time(self, weight, now):
+        until, = self.conn.execute(
+            "SELECT MAX(until) FROM api_blocks").fetchone()
+        wait = max(0.0, (until or 0) - now)
+        for seconds, limit in API_RATE_LIMITS.values():
+            cap = limit * API_RATE_HEADROOM
+            excess = weight - cap + self.conn.execute(
+                "SELECT COALESCE(SUM(weight), 0) FROM api_calls WHERE at > ?",
+                (now - seconds,)
+            ).fetchone()[0]
+            if excess <= 0:
+                continue
+            # Wait for the oldest calls of the window to leave it
+            for at, spent in self.conn.execute(
+                    "SELECT at, weight FROM api_calls WHERE at > ? "
+                    "ORDER BY at", (now - seconds,)):
+                wait = max(wait, at + seconds - now)
+                excess -= spent
+                if excess <= 0:
+                    break
+        return wait
+
+    # Waits until a request of weight is within the limits and records it
+    # Returns the ticket to settle once the request is answered
+    # Raises ValueError for a request heavier than a whole window, or
+    # one that would wait longer than RATE_MAX_WAIT
+    def acquire(self, weight):
+        if weight > max_request_weight():
+            raise ValueError(
+                f"Request weighs {weight:.0f} API calls, more than the "
+                f"{max_request_weight():.0f} the rate limits allow at once")
+        while True:
+            with self.lock:
+                now = time.time()
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    longest = max(
+                        [seconds for seconds, _ in API_RATE_LIMITS.values()],
+                        default=0)
+                    self.conn.execute(
+                        "DELETE FROM api_calls WHERE at <= ?",
+                        (now - longest,))
+                    self.conn.execute(
+                        "DELETE FROM api_blocks WHERE until <= ?", (now,))
+                    wait = self.wait_time(weight, now)
+                    ticket = None
+                    if wait <= 0:
+                        ticket = self.conn.execute(
+                            "INSERT INTO api_calls VALUES (?, ?)",
+                            (now, weight)
+                        ).lastrowid
+                    self.conn.execute("COMMIT")
+                except BaseException:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            if ticket is not None:
+                return ticket
+            if wait > RATE_MAX_WAIT:
+                raise ValueError(
+                    "API rate limit reached, requests can resume in "
+                    f"{wait / 60:.0f} minutes")
+
+            metrics.count('rate_limit_waits')
+            with metrics.timer('rate_limit_wait'):
+                time.sleep(wait)
+
+    # Moves a request to the time it was answered, the API counts it
+    # when it arrives, which can be well after it was acquired
+    def settle(self, ticket):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE api_calls SET at = MAX(at, ?) WHERE rowid = ?",
+                (time.time(), ticket)
             )
-        end_date = input(
-            "Enter the end date (format: yyyy-mm-dd): "
+
+    # Holds every request back for seconds, after the API reported
+    # a limit the budget did not see coming
+    def block(self, seconds):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO api_blocks VALUES (?)", (time.time() + seconds,))
+
+    # Weighted calls sent in each window up to now
+    def spent(self):
+        now = time.time()
+        with self.lock:
+            return {
+                window: self.conn.execute(
+                    "SELECT COALESCE(SUM(weight), 0) FROM api_calls "
+                    "WHERE at > ?", (now - seconds,)
+                ).fetchone()[0]
+                for window, (seconds, _) in API_RATE_LIMITS.items()
+            }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+rate_budget = None
+
+
+# Opens the rate budget on first use
+def get_rate_budget():
+    global rate_budget
+    with init_lock:
+        if rate_budget is None:
+            rate_budget = RateBudget(RATE_BUDGET_FILE)
+    return rate_budget
+
+
+# Geocoding server, and the seconds between two requests to it
+# Nominatim's usage policy allows one request per second
+NOMINATIM_DOMAIN = 'nominatim.openstreetmap.org'
+NOMINATIM_SCHEME = 'https'
+GEOCODE_MIN_DELAY = 1
+
+geocode_limiter = None
+
+
+# Needed to find lat & long given city name
+# Nominatim allows one request per second, shared by all worker threads
+def geocode(query):
+    global geocode_limiter
+    with init_lock:
+        if geocode_limiter is None:
+            from geopy.geocoders import Nominatim
+            from geopy.extra.rate_limiter import RateLimiter
+
+            geolocator = Nominatim(
+                user_agent='weather_data', domain=NOMINATIM_DOMAIN,
+                scheme=NOMINATIM_SCHEME
+            )
+            geocode_limiter = RateLimiter(
+                geolocator.geocode, min_delay_seconds=GEOCODE_MIN_DELAY,
+                swallow_exceptions=False
+            )
+    return geocode_limiter(query)
+
+
+# Geocoding results are kept here so repeat cities resolve offline
+GEOCODE_CACHE_FILE = 'geocode_cache.db'
+
+
+# Cache keys ignore case and extra whitespace
+def normalize_query(query):
+    return " ".join(str(query).casefold().split())
+
+
+# Builds a geopy Location shaped like the ones Nominatim returns
+def make_location(lat, lon, display_name):
+    from geopy.location import Location
+
+    raw = {'lat': lat, 'lon': lon, 'display_name': display_name}
+    return Location(display_name, (lat, lon), raw)
+
+
+# Persistent geocode cache keyed on the normalized query string
+# An in-memory dict sits in front of the SQLite table
+class GeocodeCache:
+    def __init__(self, path=GEOCODE_CACHE_FILE):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.memo = {}
+        with self.lock, self.conn:
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS geocode_cache (
+                                    query TEXT PRIMARY KEY,
+                                    lat REAL,
+                                    lon REAL,
+                                    display_name TEXT)''')
+
+    # Returns the cached Location for query, or None on a miss
+    def get(self, query):
+        key = normalize_query(query)
+        location = self.memo.get(key)
+        if location is not None:
+            return location
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT lat, lon, display_name FROM geocode_cache "
+                "WHERE query = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        location = make_location(*row)
+        self.memo[key] = location
+        return location
+
+    # Stores a geocoded Location under query
+    def put(self, query, location):
+        self.put_many([(
+            query, location.raw['lat'], location.raw['lon'],
+            location.raw['display_name']
+        )])
+
+    # Stores (query, lat, lon, display_name) rows in one transaction
+    def put_many(self, rows):
+        rows = [
+            (normalize_query(query), float(lat), float(lon), display_name)
+            for query, lat, lon, display_name in rows
+        ]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO geocode_cache VALUES (?, ?, ?, ?)",
+                rows
             )
+        for key, lat, lon, display_name in rows:
+            self.memo[key] = make_location(lat, lon, display_name)
+        return len(rows)
+
+    # Loads a local gazetteer file with name, lat and lon columns
+    # and an optional display_name column
+    # Returns the number of entries added
+    def preload(self, path, delimiter=','):
+        with open(path, newline='', encoding='utf-8') as file:
+            rows = [
+                (
+                    row['name'], row['lat'], row['lon'],
+                    row.get('display_name') or row['name']
+                )
+                for row in csv.DictReader(file, delimiter=delimiter)
+            ]
+        return self.put_many(rows)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
 
+geocode_cache = None
+
+
+# Opens the geocode cache on first use
+def get_geocode_cache():
+    global geocode_cache
+    with init_lock:
+        if geocode_cache is None:
+            geocode_cache = GeocodeCache(GEOCODE_CACHE_FILE)
+    return geocode_cache
+
+
+# Loads a gazetteer file into the geocode cache
+def preload_gazetteer(path, delimiter=','):
+    return get_geocode_cache().preload(path, delimiter)
+
+
+# Input validation for the number of cities to graph
+def ask_num_cities():
+    while True:
         try:
-            # Validate the date format
-            datetime.strptime(start_date, "%Y-%m-%d")
-            datetime.strptime(end_date, "%Y-%m-%d")
-            break
+            return int(input(
+                "Enter the number of cities you'd like to graph "
+                "(warning: more than 5 cities might "
+                "hit the minute rate limit): "
+            ))
         except ValueError:
+            print("Error: Please enter an integer")
+
+
+# Raised for a city name the geocoder does not know, the one fetch
+# error the user can fix by entering another name
+class CityNotFoundError(ValueError):
+    pass
+
+
+# Gets latitude and longitude from a user city name
+# Only cache misses reach Nominatim, through the throttled geocode
+def geocode_city(user_city):
+    cache = get_geocode_cache()
+    location = cache.get(user_city)
+    if location is not None:
+        metrics.count('geocode_cache_hits')
+        return location
+
+    metrics.count('geocode_requests')
+    with metrics.timer('geocode'):
+        location = geocode(user_city)
+    if location is None:
+        raise CityNotFoundError(f"City name not recognized: {user_city}")
+    cache.put(user_city, location)
+    return location
+
+
+# Geocodes many cities, resolving each distinct query once
+# Misses are sent one after another so the 1 req/s limit is never
+# raced by worker threads
+# Returns one location or exception per city in input order
+def bulk_geocode(user_cities):
+    resolved = {}
+    for user_city in user_cities:
+        key = normalize_query(user_city)
+        if key in resolved:
+            continue
+        try:
+            resolved[key] = geocode_city(user_city)
+        except Exception as e:
+            resolved[key] = e
+
+    return [resolved[normalize_query(city)] for city in user_cities]
+
+
+# Desired weather variables and specifications in params
+# Hourly values are requested in UTC, so every day has 24 of them
+def build_params(city_lat, city_lon, variables, user_start, user_end,
+                 resolution='daily'):
+    return {
+        "latitude": city_lat,
+        "longitude": city_lon,
+        resolution: variables,
+        "temperature_unit": "fahrenheit",
+        "wind_speed_unit": "mph",
+        "precipitation_unit": "inch",
+        "timezone": "auto" if resolution == 'daily' else "GMT",
+        "start_date": user_start,
+        "end_date": user_end
+    }
+
+
+# Returns the 'reason' of an API error body, or None
+# The SDK raises the body as the argument of an error that it then
+# wraps in another one, so the whole chain is searched
+def api_error_reason(error):
+    while error is not None:
+        body = getattr(error, 'error_data', None)
+        if body is None and error.args and isinstance(error.args[0], dict):
+            body = error.args[0]
+        if body:
+            return body.get('reason')
+        error = error.__cause__
+    return None
+
+
+# Calls the API, paced by the rate budget so the limits are not hit
+# Answers the HTTP cache holds are not paced, they never reach the API
+# If a limit is hit anyway the request waits it out and is retried
+def call_weather_api(url, params):
+    weight = request_weight(params)
+    while True:
+        client = get_openmeteo()
+        ticket = None
+        if http_cache is None or not http_cache.is_fresh(url, params):
+            ticket = get_rate_budget().acquire(weight)
+        metrics.count('api_calls')
+        try:
+            with metrics.timer('api_call'):
+                return client.weather_api(url, params=params)
+        except Exception as e:  # Catching all exceptions
+            window = RATE_LIMIT_ERRORS.get(api_error_reason(e))
+            if window is None:
+                metrics.count('api_errors')
+                raise  # Re-raise the exception if not related to API limit
+            seconds = (
+                RATE_LIMIT_WAIT if window == 'minute'
+                else API_RATE_LIMITS.get(window, (RATE_LIMIT_WAIT,))[0])
             print(
-                "Error: Invalid date format."
-                "Please enter the date in yyyy-mm-dd format."
+                f"API limit exceeded for this {window}. " + (
+                    "Waiting before retrying." if seconds <= RATE_MAX_WAIT
+                    else "Try again later.")
             )
+            metrics.count('rate_limited')
+            # The wait is shared with every other request, the retry
+            # fails in acquire when it is longer than RATE_MAX_WAIT
+            get_rate_budget().block(seconds)
+        finally:
+            if ticket is not None:
+                get_rate_budget().settle(ticket)
 
-    # SQL query to select data within the specified date range
-    query = f'''SELECT * FROM {city_table}
-                WHERE date BETWEEN '{start_date}' AND '{end_date}' '''
-    c.execute(query)
-    results = c.fetchall()
 
-    # Close the database connection
-    conn.close()
+# Turns the daily block of one API response into a dataframe,
+# or the hourly block into one with a time column
+def response_to_dataframe(response, variables, resolution='daily'):
+    if resolution == 'hourly':
+        daily = response.Hourly()
+        offset = 0
+    else:
+        daily = response.Daily()
+        # Shifting by the UTC offset puts each day on its local midnight
+        offset = response.UtcOffsetSeconds()
 
-    # Save results to CSV file
-    if results:
-        # Get column names from cursor description
-        col_names = [desc[0] for desc in c.description]
+    # Create a daily_data dictionary
+    # Add the extracted data to dictionary
+    time_column = TIME_COLUMNS[resolution]
+    daily_data = {time_column: pd.date_range(
+        start=pd.to_datetime(daily.Time() + offset, unit="s", utc=True),
+        end=pd.to_datetime(daily.TimeEnd() + offset, unit="s", utc=True),
+        freq=pd.Timedelta(seconds=daily.Interval()),
+        inclusive="left"
+    )}
+    for i, variable in enumerate(variables):
+        daily_data[variable] = daily.Variables(i).ValuesAsNumpy()
+    metrics.count(
+        'hours_fetched' if resolution == 'hourly' else 'days_fetched',
+        len(daily_data[time_column]))
 
-        # Write results to CSV file
-        filename = (
-            f"{user_input_city}_weather_data_{start_date}_to_{end_date}.csv"
+    # ValuesAsNumpy() views the FlatBuffers payload, copy=False keeps
+    # those views as the columns instead of copying them into one block
+    return pd.DataFrame(data=daily_data, copy=False)
+
+
+# Calls func on every item on a bounded worker pool
+# Yields (index, result or exception) pairs as they complete
+# At most two items per worker are in flight, so finished results
+# do not pile up faster than the caller consumes them
+def iter_pool(func, items, max_workers=MAX_WORKERS):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    if not items:
+        return
+
+    workers = max(1, min(max_workers, len(items)))
+    queued = iter(enumerate(items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for i, item in itertools.islice(queued, 2 * workers):
+            pending[executor.submit(func, item)] = i
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                try:
+                    yield i, future.result()
+                except Exception as e:
+                    yield i, e
+                for j, item in itertools.islice(queued, 1):
+                    pending[executor.submit(func, item)] = j
+
+
+# Calls func on every item on a bounded worker pool
+# Returns one result or exception per item in input order
+def run_in_pool(func, items, max_workers=MAX_WORKERS):
+    results = [None] * len(items)
+    for i, result in iter_pool(func, items, max_workers):
+        results[i] = result
+    return results
+
+
+# Splits [user_start, user_end] into consecutive chunks that start
+# on the boundaries of freq, so each request stays small
+def split_range(user_start, user_end, freq=CHUNK_FREQ):
+    if not freq:
+        return [(user_start, user_end)]
+
+    start = pd.Timestamp(user_start)
+    end = pd.Timestamp(user_end)
+    bounds = [start] + [
+        bound for bound in pd.date_range(start, end, freq=freq)
+        if bound > start
+    ]
+    return [
+        (
+            chunk_start.strftime("%Y-%m-%d"),
+            (next_start - pd.Timedelta(days=1)).strftime("%Y-%m-%d")
         )
+        for chunk_start, next_start in zip(
+            bounds, bounds[1:] + [end + pd.Timedelta(days=1)])
+    ]
 
-        with open(filename, 'w', newline='') as file:
-            csv_writer = csv.writer(file)
-            csv_writer.writerow(col_names)  # Write column headers
-            csv_writer.writerows(results)   # Write data rows
 
-        print(f"Results saved to {filename}")
-        return
-    else:
-        print("No results found for the specified criteria.")
+# Calls func, retrying failures other than ValueError with backoff
+def with_retries(func, retries=CHUNK_RETRIES, backoff=CHUNK_BACKOFF):
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except ValueError:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            metrics.count('chunk_retries')
+            with metrics.timer('retry_backoff'):
+                time.sleep(backoff * 2 ** attempt)
+
+
+# Builds the cities_dict key for a geocoded city
+def city_name(user_city, location):
+    return f"{location.raw['display_name']} (User entered: {user_city})"
+
+
+# Downloads several geocoded locations with a single API request
+# Returns one dataframe per location in request order
+def fetch_batch(url, variables, locations, user_start, user_end,
+                resolution='daily'):
+    params = build_params(
+        ",".join(str(location.raw['lat']) for location in locations),
+        ",".join(str(location.raw['lon']) for location in locations),
+        variables, user_start, user_end, resolution
+    )
+    response = call_weather_api(url, params)
+    if not response or len(response) != len(locations):
+        raise ValueError("No response from server for this batch")
+
+    # The API answers with one response per location, in request order
+    with metrics.timer('dataframe'):
+        return [
+            response_to_dataframe(city_response, variables, resolution)
+            for city_response in response
+        ]
+
+
+# Joins the dataframes fetched for one city into a single date-ordered one
+def concat_frames(frames, variables, time_column='date'):
+    if not frames:
+        return pd.DataFrame(columns=[time_column] + variables)
+    dataframe = (
+        pd.concat(frames, ignore_index=True)
+        .sort_values(time_column, ignore_index=True)
+    )
+    dataframe.attrs.update(frames[0].attrs)
+    return dataframe
+
+
+# Geocodes the cities, then downloads them in batches of up to batch_size
+# locations per request, running the batches on a bounded worker pool
+# Cities in the same grid cell are fetched once, for the first of them,
+# and the others get its dataframe, listed in its 'aliases' attribute
+# plan(city, location) may return the (start, end) ranges actually
+# needed for a city, by default the whole [user_start, user_end] range
+# Ranges are split into chunks that are fetched and retried on their own
+# When store is given, every finished chunk is handed to it right away
+# as a cities_dict and not kept in memory, so outcomes hold no dataframe
+# resolution is 'daily' or 'hourly'
+# Returns one outcome per city in input order,
+# either a (city, dataframe) pair or the exception that city raised
+def fetch_outcomes(url, variables, user_cities, user_start, user_end,
+                   max_workers=MAX_WORKERS, batch_size=BATCH_SIZE,
+                   plan=None, chunk_freq=CHUNK_FREQ, store=None,
+                   resolution='daily'):
+    outcomes = bulk_geocode(user_cities)
+
+    # Cities needing the same date chunk can share a request
+    cities = {}
+    cells = {}
+    leaders = {}
+    jobs = {}
+    for i, location in enumerate(outcomes):
+        if isinstance(location, Exception):
+            continue
+        cities[i] = city_name(user_cities[i], location)
+        cell = location_cell(url, location.raw['lat'], location.raw['lon'])
+        if cell is not None and cell in cells:
+            leaders[i] = cells[cell]
+            metrics.count('requests_shared')
+            continue
+        cells[cell] = leaders[i] = i
+        ranges = (
+            plan(cities[i], location) if plan
+            else [(user_start, user_end)]
+        )
+        for start, end in ranges:
+            for chunk in split_range(start, end, chunk_freq):
+                jobs.setdefault(chunk, []).append(i)
+
+    # Batches are also kept light enough for every rate limit window,
+    # a heavier request could never be paced under the limits
+    def chunk_size(chunk):
+        weight = request_weight(
+            build_params("0", "0", variables, *chunk, resolution))
+        return max(1, int(min(batch_size, max_request_weight() / weight)))
 
+    batches = []
+    for chunk, indices in jobs.items():
+        size = chunk_size(chunk)
+        batches.extend(
+            (chunk, indices[n:n + size])
+            for n in range(0, len(indices), size))
 
-# Checks if date is before 2016 (Archive API vs Forecast API)
-def check_date(date_str):
-    str_list = date_str.split("-")
-    year = int(str_list[0])
+    def fetch_job(job):
+        (start, end), indices = job
+        locations = [outcomes[i] for i in indices]
+        return with_retries(lambda: fetch_batch(
+            url, variables, locations, start, end, resolution))
 
-    if year < 2016:
-        return True
-    else:
-        return False
+    def with_location(i, dataframe):
+        dataframe.attrs['latitude'] = float(outcomes[i].raw['lat'])
+        dataframe.attrs['longitude'] = float(outcomes[i].raw['lon'])
+        dataframe.attrs['grid_cell'] = location_cell(
+            url, outcomes[i].raw['lat'], outcomes[i].raw['lon'])
+        dataframe.attrs['aliases'] = [
+            cities[j] for j, leader in leaders.items()
+            if leader == i and j != i
+        ]
+        return dataframe
 
+    # A failed chunk is reported against every city it contained
+    frames = {i: [] for i in cities}
+    errors = {}
+    for n, result in iter_pool(fetch_job, batches, max_workers):
+        indices = batches[n][1]
+        if isinstance(result, Exception):
+            for i in indices:
+                errors.setdefault(i, result)
+        elif store is not None:
+            store({
+                cities[i]: with_location(i, dataframe)
+                for i, dataframe in zip(indices, result)
+            })
+        else:
+            for i, dataframe in zip(indices, result):
+                frames[i].append(dataframe)
 
-# Ensures the date is in the correct format
-# Return the str as it's needed later
-def ensure_valid_date(prompt):
-    while True:
-        user_input = input(prompt)
-        try:
-            valid_date = datetime.strptime(user_input, "%Y-%m-%d")
-            return user_input
-        except ValueError:
-            print(
-                "Invalid date format. "
-                "Please enter the date in yyyy-mm-dd format."
-            )
+    # Aliases of cities with nothing left to fetch still get stored
+    if store is not None:
+        shared = sorted({
+            leader for i, leader in leaders.items()
+            if leader != i and leader not in errors
+        })
+        if shared:
+            store({
+                cities[leader]: with_location(leader, concat_frames(
+                    [], variables, TIME_COLUMNS[resolution]))
+                for leader in shared
+            })
 
+    merged = {}
+    for i, city in cities.items():
+        leader = leaders[i]
+        if leader in errors:
+            outcomes[i] = errors[leader]
+        elif store is not None:
+            outcomes[i] = (city, None)
+        else:
+            if leader not in merged:
+                merged[leader] = with_location(leader, concat_frames(
+                    frames[leader], variables, TIME_COLUMNS[resolution]))
+            outcomes[i] = (city, merged[leader])
 
-# Checks if the date range is valid
-def check_range(user_start, user_end):
-    error_code = 0
-    user_start_datetime = datetime.strptime(user_start, "%Y-%m-%d")
-    user_end_datetime = datetime.strptime(user_end, "%Y-%m-%d")
+    return outcomes
 
-    # Check if start date is after end date
-    if user_end_datetime < user_start_datetime:
-        error_code = -1
 
-    # Check if start date is before 1940
-    minimum_start = datetime.strptime("1940-01-01", "%Y-%m-%d")
-    if user_start_datetime < minimum_start:
-        error_code = -2
+# Fetches every city concurrently without aborting on a failed city
+# Returns (cities_dict, failures) where failures maps city name to error
+def fetch_cities(url, variables, user_cities, user_start, user_end,
+                 max_workers=MAX_WORKERS, batch_size=BATCH_SIZE):
+    cities_dict = {}
+    failures = {}
+    outcomes = fetch_outcomes(
+        url, variables, user_cities, user_start, user_end,
+        max_workers, batch_size
+    )
+    for user_city, outcome in zip(user_cities, outcomes):
+        if isinstance(outcome, Exception):
+            failures[user_city] = outcome
+        else:
+            city, dataframe = outcome
+            cities_dict[city] = dataframe
 
-    # Check if end date is after the current date
-    if user_end_datetime > datetime.now():
-        error_code = -3
+    return cities_dict, failures
 
-    return error_code
 
+# Fetches only the dates not stored yet, a StoreWriter writing each chunk
+# while the next ones are fetched
+# Hourly values are fetched in HOURLY_CHUNK_FREQ chunks
+# Returns one outcome per city in input order, either the stored city
+# name or the exception that city raised
+def update_outcomes(c, url, variables, user_cities, user_start, user_end,
+                    resolution='daily'):
+    hourly = resolution == 'hourly'
+    covered = [
+        HOURLY_COVERAGE + variable if hourly else variable
+        for variable in variables
+    ]
 
-# Creates a graph based on the cities and variable given
-def create_graph(cities_dict, target_var):
-    # Warning filter for city names with unrecognized characters
-    with warnings.catch_warnings(record=True) as w:
-        warnings.simplefilter("always")
+    # A new city in the grid cell of a stored location becomes an alias
+    # of it, and only fetches what that location is missing
+    def plan(city, location):
+        location_id = find_location(c, city)
+        if location_id is None:
+            cell = location_cell(
+                url, location.raw['lat'], location.raw['lon'])
+            location_id = cell_location(c, cell) if cell else None
+            if location_id is None:
+                return [(user_start, user_end)]
+            add_alias(c, city, location_id)
+        return missing_ranges(
+            c, location_id, covered, user_start, user_end)
 
-        plt.figure(figsize=(12, 6))
-        for city, dataframe in cities_dict.items():
-            plt.plot(
-                dataframe['date'], dataframe[target_var],
-                label=target_var + " " + city
-            )
+    # Chunks are handed to the writer thread as they arrive, and are
+    # all committed once it is closed
+    with StoreWriter(c.connection, resolution=resolution) as writer:
+        outcomes = fetch_outcomes(
+            url, variables, user_cities, user_start, user_end,
+            plan=plan,
+            chunk_freq=HOURLY_CHUNK_FREQ if hourly else CHUNK_FREQ,
+            store=writer.put,
+            resolution=resolution
+        )
+    return [
+        outcome if isinstance(outcome, Exception) else outcome[0]
+        for outcome in outcomes
+    ]
 
-        plt.xlabel('Date')
-        plt.ylabel(target_var)
-        plt.title(target_var + " over time")
-        plt.legend()
-        plt.savefig(target_var + '_plot.png')
-
-        # Check if any UserWarning was
-        # issued and replace it with a custom message
-        for warning in w:
-            if issubclass(warning.category, UserWarning):
-                if "Glyph" in str(warning.message):
-                    print(
-                        "Warning: cannot properly display "
-                        "one or more characters in the city name"
-                        )
-                break
 
-    print("Graph has been saved")
+# Brings the stored data of every city up to date without prompting
+# Returns (cities_dict, failures) where failures maps city name to error,
+# cities_dict is a CitySeries of the whole range, or a dict of hourly
+# dataframes with resolution='hourly'
+def update_cities(url, variables, user_cities, user_start, user_end,
+                  resolution='daily'):
+    conn = connect_database()
+    c = conn.cursor()
+    try:
+        outcomes = update_outcomes(
+            c, url, variables, user_cities, user_start,
+            user_end, resolution)
 
+        cities = []
+        failures = {}
+        for user_city, outcome in zip(user_cities, outcomes):
+            if isinstance(outcome, Exception):
+                failures[user_city] = outcome
+            else:
+                cities.append(outcome)
 
-# Uses the weather forecast API for start dates after 2016-01-01
-def weather_forecast(user_start, user_end):
-    url = "https://api.open-meteo.com/v1/forecast"
+        if resolution == 'hourly':
+            cities_dict = {
+                city: read_hourly_frame(
+                    c, find_location(c, city), variables,
+                    user_start, user_end)
+                for city in cities
+            }
+        else:
+            cities_dict = read_series(
+                c, cities, variables, user_start, user_end)
+    finally:
+        conn.close()
+    return cities_dict, failures
 
-    # Input validation for the number of cities to graph
-    while True:
-        try:
-            num_cities = int(input(
-                "Enter the number of cities you'd like to graph "
-                "(warning: more than 5 cities might "
-                "hit the minute rate limit): "
-            ))
-            break
-        except ValueError:
-            print("Error: Please enter an integer")
 
-    cities_dict = {}
-    city_count = 1
+# Prompts for the cities, fetches the dates not stored yet concurrently,
+# stores them and returns the whole range for every city as a CitySeries
+# Unrecognized city names are asked for again
+def prompt_and_fetch(url, variables, user_start, user_end):
+    num_cities = ask_num_cities()
+    user_cities = [
+        input(f"Enter the name of city #{city_count}: ")
+        for city_count in range(1, num_cities + 1)
+    ]
 
-    while num_cities != 0:
-        # Gets longitude and latitude from user city input
-        # Input validation for city name
-        while True:
-            user_city = input(f"Enter the name of city #{city_count}: ")
-            try:
-                location = geolocator.geocode(user_city)
-                city_lat = location.raw['lat']
-                city_lon = location.raw['lon']
-                break
-            except AttributeError:
+    conn = connect_database()
+    c = conn.cursor()
+
+    # One slot per city so retried names keep their position
+    slots = [None] * len(user_cities)
+    pending = list(range(len(user_cities)))
+    while pending:
+        outcomes = update_outcomes(
+            c, url, variables, [user_cities[i] for i in pending],
+            user_start, user_end
+        )
+        retry_slots = []
+        for i, outcome in zip(pending, outcomes):
+            if not isinstance(outcome, Exception):
+                slots[i] = outcome
+            elif isinstance(outcome, CityNotFoundError):
                 print(
                     "Error: City name not recognized. "
                     "Please enter a valid city name."
                 )
-
-        # Desired weather variables and specifications in params
-        params = {
-            "latitude": city_lat,
-            "longitude": city_lon,
-            "daily": [
-                "temperature_2m_max", "temperature_2m_min", "uv_index_max",
-                "precipitation_sum", "wind_speed_10m_max"],
-            "temperature_unit": "fahrenheit",
-            "wind_speed_unit": "mph",
-            "precipitation_unit": "inch",
-            "timezone": "auto",
-            "start_date": user_start,
-            "end_date": user_end
-        }
-        try:
-            response = openmeteo.weather_api(url, params=params)
-        except Exception as e:  # Catching all exceptions
-            sample_error = (
-                'Minutely API request limit exceeded. '
-                'Please try again in one minute.'
-            )
-            # Handle any exception here
-            if hasattr(e, 'error_data'):
-                if getattr(e, 'error_data', {}).get('reason') == sample_error:
-                    print(
-                        "API limit exceeded for this minute. "
-                        "Please try again in one minute."
-                    )
-                    time.sleep(60)  # Wait for one minute before retrying
+                user_cities[i] = input(f"Enter the name of city #{i + 1}: ")
+                retry_slots.append(i)
             else:
-                raise  # Re-raise the exception if not related to API limit
+                print(f"Error: Could not fetch {user_cities[i]}: {outcome}")
+        pending = retry_slots
+
+    try:
+        return read_series(
+            c, [city for city in slots if city is not None], variables,
+            user_start, user_end)
+    finally:
+        conn.close()
 
-        if not response:
-            print(
-                "No response from server. "
-                "Please enter valid city name."
-            )
-            continue
 
-        # Process daily data
-        # The order of variables needs to be the same as requested.
-        daily = response[0].Daily()
-
-        # Extract data for each variable and convert to Numpy arrays
-        daily_temperature_2m_max = daily.Variables(0).ValuesAsNumpy()
-        daily_temperature_2m_min = daily.Variables(1).ValuesAsNumpy()
-        daily_uv_index_max = daily.Variables(2).ValuesAsNumpy()
-        daily_precipitation_sum = daily.Variables(3).ValuesAsNumpy()
-        daily_wind_speed_10m_max = daily.Variables(4).ValuesAsNumpy()
-
-        # Create a daily_data dictionary
-        # Add the extracted data to dictionary
-        daily_data = {"date": pd.date_range(
-            start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-            end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=daily.Interval()),
-            inclusive="left"
-        )}
-        daily_data["temperature_2m_max"] = daily_temperature_2m_max
-        daily_data["temperature_2m_min"] = daily_temperature_2m_min
-        daily_data["uv_index_max"] = daily_uv_index_max
-        daily_data["precipitation_sum"] = daily_precipitation_sum
-        daily_data["wind_speed_10m_max"] = daily_wind_speed_10m_max
-
-        # Place the city name and the dataframe into a dictionary
-        daily_dataframe = pd.DataFrame(data=daily_data)
-        cities_dict[
-            f"{location.raw['display_name']} (User entered: {user_city})"
-        ] = daily_dataframe
-
-        num_cities -= 1
-        city_count += 1
-
-    # Output to db file
-    write_to_file(cities_dict)
-
-    return cities_dict
+# Uses the weather forecast API for start dates after 2016-01-01
+def weather_forecast(user_start, user_end):
+    return prompt_and_fetch(
+        FORECAST_URL, FORECAST_VARIABLES, user_start, user_end
+    )
 
 
 # Uses the weather archive API for start dates before 2016-01-01
 def weather_archive(user_start, user_end):
-    url = "https://archive-api.open-meteo.com/v1/archive"
+    return prompt_and_fetch(
+        ARCHIVE_URL, ARCHIVE_VARIABLES, user_start, user_end
+    )
 
-    # Input validation for number of cities to graph
-    while True:
-        try:
-            num_cities = int(input(
-                "Enter the number of cities you'd like to graph "
-                "(warning: more than 5 cities might "
-                "hit the minute rate limit): "
-            ))
-            break
-        except ValueError:
-            print("Error: Please enter an integer")
 
-    cities_dict = {}
-    city_count = 1
+# Messages for the error codes of check_range
+RANGE_ERRORS = {
+    -1: "Ensure that the start date is before the end date.",
+    -2: "Start date cannot be before 1940-01-01.",
+    -3: "End date cannot be after the current date.",
+}
 
-    while num_cities != 0:
-        # Gets longitude and latitude from user city input
-        # Input validation for city name
-        while True:
-            user_city = input(f"Enter the name of city #{city_count}: ")
-            try:
-                location = geolocator.geocode(user_city)
-                city_lat = location.raw['lat']
-                city_lon = location.raw['lon']
-                break
-            except AttributeError:
-                print(
-                    "Error: City name not recognized. "
-                    "Please enter a valid city name."
-                    )
 
-        # Desired weather variables and specifications in params
-        params = {
-            "latitude": city_lat,
-            "longitude": city_lon,
-            "daily": [
-                "temperature_2m_max", "temperature_2m_min",
-                "temperature_2m_mean", "precipitation_sum",
-                "wind_speed_10m_max", "shortwave_radiation_sum"],
-            "temperature_unit": "fahrenheit",
-            "wind_speed_unit": "mph",
-            "precipitation_unit": "inch",
-            "timezone": "auto",
-            "start_date": user_start,
-            "end_date": user_end
-        }
+# Runs one job of a job file without prompting
+# A job names its cities and date range, and optionally the variables to
+# fetch, the export formats, the variables to graph and an output_dir
+# Returns a summary dict, a failing job is reported and not raised
+def run_job(job, number=1):
+    summary = {
+        'name': job.get('name', f"job{number}"),
+        'status': 'ok',
+        'cities': 0,
+        'rows': 0,
+        'failures': {},
+        'exports': [],
+        'graphs': [],
+        'error': None,
+    }
+    # Each job reports its own metrics
+    metrics.reset()
+    started = time.perf_counter()
+    try:
+        user_start = job['start_date']
+        user_end = job['end_date']
+        for day in (user_start, user_end):
+            datetime.strptime(day, "%Y-%m-%d")
+        error_code = check_range(user_start, user_end)
+        if error_code:
+            raise ValueError(RANGE_ERRORS[error_code])
+
+        # If the start date is before 2016, use the archive API
+        if check_date(user_start):
+            url, variables = ARCHIVE_URL, ARCHIVE_VARIABLES
+        else:
+            url, variables = FORECAST_URL, FORECAST_VARIABLES
+        variables = job.get('variables', variables)
+        user_cities = job['cities']
+        directory = job.get('output_dir')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = connect_database()
+        c = conn.cursor()
         try:
-            response = openmeteo.weather_api(url, params=params)
-        except Exception as e:  # Catching all exceptions
-            sample_error = (
-                'Minutely API request limit exceeded. '
-                'Please try again in one minute.'
-            )
-            # Handle any exception here
-            if hasattr(e, 'error_data'):
-                if getattr(e, 'error_data', {}).get('reason') == sample_error:
-                    print(
-                        "API limit exceeded for this minute. "
-                        "Please try again in one minute."
-                    )
-                    time.sleep(60)  # Wait for one minute before retrying
-            else:
-                raise  # Re-raise the exception if not related to API limit
+            outcomes = update_outcomes(
+                c, url, variables, user_cities, user_start, user_end)
 
-        if not response:
-            print(
-                "No response from server. "
-                "Please enter valid city name."
+            fetched = []
+            for user_city, outcome in zip(user_cities, outcomes):
+                if isinstance(outcome, Exception):
+                    summary['failures'][user_city] = str(outcome)
+                else:
+                    fetched.append((user_city, outcome))
+            cities_dict = read_series(
+                c, [city for _, city in fetched], variables,
+                user_start, user_end)
+        finally:
+            conn.close()
+
+        # Exports and graphs are written from the series read once
+        for user_city, city in fetched:
+            summary['rows'] += int(cities_dict.present(city).sum())
+            for export_format in job.get('exports', []):
+                filename = export_filename(
+                    user_city, user_start, user_end, export_format,
+                    directory)
+                if export_series(cities_dict, city, filename, export_format):
+                    summary['exports'].append(filename)
+
+        summary['cities'] = len(cities_dict)
+        if cities_dict and job.get('graphs'):
+            summary['graphs'] = [
+                filename for filename, _ in render_all(
+                    {summary['name']: cities_dict}, job['graphs'],
+                    directory=directory
                 )
-            continue
+            ]
+    except Exception as e:
+        summary['status'] = 'failed'
+        summary['error'] = f"{type(e).__name__}: {e}"
+
+    if summary['status'] == 'ok' and summary['failures']:
+        summary['status'] = 'partial'
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    summary['metrics'] = metrics.snapshot()
+    return summary
+
 
-        # Process daily data.
-        # The order of variables needs to be the same as requested.
-        daily = response[0].Daily()
-
-        daily_temperature_2m_max = daily.Variables(0).ValuesAsNumpy()
-        daily_temperature_2m_min = daily.Variables(1).ValuesAsNumpy()
-        daily_temperature_2m_mean = daily.Variables(2).ValuesAsNumpy()
-        daily_precipitation_sum = daily.Variables(3).ValuesAsNumpy()
-        daily_wind_speed_10m_max = daily.Variables(4).ValuesAsNumpy()
-        daily_shortwave_radiation_sum = daily.Variables(5).ValuesAsNumpy()
-
-        # Create a daily_data dictionary
-        # add the extracted data to dictionary
-        daily_data = {"date": pd.date_range(
-            start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-            end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=daily.Interval()),
-            inclusive="left"
-        )}
-        daily_data["temperature_2m_max"] = daily_temperature_2m_max
-        daily_data["temperature_2m_min"] = daily_temperature_2m_min
-        daily_data["temperature_2m_mean"] = daily_temperature_2m_mean
-        daily_data["precipitation_sum"] = daily_precipitation_sum
-        daily_data["wind_speed_10m_max"] = daily_wind_speed_10m_max
-        daily_data["shortwave_radiation_sum"] = daily_shortwave_radiation_sum
-
-        # Place the city name and the dataframe into a dictionary
-        daily_dataframe = pd.DataFrame(data=daily_data)
-        cities_dict[
-            f"{location.raw['display_name']} (User entered: {user_city})"
-        ] = daily_dataframe
-
-        num_cities -= 1
-        city_count += 1
-
-    # Output to db file
-    write_to_file(cities_dict)
-
-    return cities_dict
+# Prints one line per job and one per failed city
+def print_summary(summaries):
+    for summary in summaries:
+        print(
+            f"{summary['name']}: {summary['status']} - "
+            f"{summary['cities']} cities, {summary['rows']} rows, "
+            f"{len(summary['exports'])} exports, "
+            f"{len(summary['graphs'])} graphs "
+            f"in {summary['seconds']:.1f}s"
+        )
+        if summary['error']:
+            print(f"  Error: {summary['error']}")
+        for user_city, error in summary['failures'].items():
+            print(f"  Could not fetch {user_city}: {error}")
+
+
+# Runs every job of a JSON job file, either a list of jobs
+# or an object with a "jobs" list
+# Returns one summary dict per job
+def run_batch(path):
+    with open(path) as file:
+        spec = json.load(file)
+    jobs = spec['jobs'] if isinstance(spec, dict) else spec
+
+    summaries = [
+        run_job(job, number) for number, job in enumerate(jobs, start=1)
+    ]
+    print_summary(summaries)
+    return summaries
 
 
 def main():
     database_empty = True
+    # One connection for every query, so repeated ones can be cached
+    query_conn = None
     while True:
         # Prompt user to either add new data or query the database, or exit
         choice = input(
@@ -500,6 +3670,9 @@ def main():
 
             # Output the list of variables
             dataframe_list = list(cities_dict.values())
+            if not dataframe_list:
+                print("Error: No data could be fetched for any city.")
+                continue
             temp_col = dataframe_list[0]
             for i, variable in enumerate(temp_col):
                 print(f"{i + 1}. {variable}")
@@ -537,17 +3710,740 @@ def main():
                     "attempting to query the database"
                 )
             else:
-                query_database()
+                if query_conn is None:
+                    query_conn = connect_database()
+                query_database(conn=query_conn)
         elif choice == '3':
             exit()
         else:
             print("Invalid choice. Please enter '1', '2', or '3'.")
 
 
+# Read-only HTTP service over the stored data
+# Flask is imported when the app is created, so the other commands
+# never load it
+
+# Read-only connections the service keeps open at most
+SERVICE_POOL_SIZE = 8
+
+# Responses up to SERVICE_CACHE_MAX_ENTRY bytes are kept in memory for
+# the current data version, SERVICE_CACHE_MAX_BYTES in total
+SERVICE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SERVICE_CACHE_MAX_ENTRY = 4 * 1024 * 1024
+
+# Media type of each format series and aggregates can be sent as
+SERVICE_FORMATS = {'json': 'application/json', 'csv': 'text/csv'}
+
+
+# Pool of read-only connections to the database
+# The database is in WAL mode, so readers work on the last committed
+# transaction without blocking a writer or being blocked by one
+# Connections are opened on demand, at most size at a time
+class ReadPool:
+    def __init__(self, path=None, size=None):
+        self.path = path or DATABASE_FILE
+        self.slots = threading.BoundedSemaphore(size or SERVICE_POOL_SIZE)
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def open(self):
+        conn = sqlite3.connect(
+            f"file:{quote(os.path.abspath(self.path))}?mode=ro",
+            uri=True, check_same_thread=False
+        )
+        conn.execute("PRAGMA query_only=ON")
+        for pragma in ('cache_size', 'mmap_size'):
+            conn.execute(f"PRAGMA {pragma}={SQLITE_PRAGMAS[pragma]}")
+        return conn
+
+    # Returns an idle connection, waiting while all of them are lent
+    def acquire(self):
+        self.slots.acquire()
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        try:
+            return self.open()
+        except sqlite3.Error:
+            self.slots.release()
+            raise
+
+    # Ends the read transaction of conn and puts it back
+    def release(self, conn):
+        conn.rollback()
+        with self.lock:
+            self.idle.append(conn)
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+# Least recently used response bodies, bounded in bytes
+# Entries belong to one data version and are dropped as soon as a
+# request sees a newer one
+class ResponseCache:
+    def __init__(self, max_bytes=None, max_entry=None):
+        self.max_bytes = max_bytes or SERVICE_CACHE_MAX_BYTES
+        self.max_entry = max_entry or SERVICE_CACHE_MAX_ENTRY
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.size = 0
+
+    def check_version(self, version):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+            self.size = 0
+
+    # Returns (mimetype, body) stored for key, or None
+    def get(self, key, version):
+        with self.lock:
+            self.check_version(version)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, mimetype, body):
+        if len(body) > self.max_entry:
+            return
+        with self.lock:
+            self.check_version(version)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (mimetype, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# Yields the row batches of a query as the text of a JSON object
+# {"location": ..., "columns": [...], "rows": [[...], ...]}
+# one batch at a time
+def stream_json(location, col_names, batches):
+    yield json.dumps({'location': location, 'columns': col_names})[:-1]
+    yield ', "rows": ['
+    separator = ""
+    for rows in batches:
+        yield separator + json.dumps(rows)[1:-1]
+        separator = ", "
+    yield "]}"
+
+
+# Yields the row batches of a query as CSV text, header first
+def stream_csv(col_names, batches):
+    for rows in itertools.chain([[col_names]], batches):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        yield buffer.getvalue()
+
+
+# Checks a yyyy-mm-dd request argument, returns its value or default
+def date_argument(args, name, default):
+    value = args.get(name, default)
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"{name} must be in yyyy-mm-dd format")
+    return value
+
+
+# Creates the Flask app serving the database at path
+#   GET /locations                      stored locations and coverage
+#   GET /locations/<city>/series        daily values, ?start&end&variables
+#   GET /locations/<city>/hourly        hourly values, ?start&end&variables
+#                                       &bucket&stat
+#   GET /locations/<city>/aggregates    rollups, ?variable&period&start&end
+#   GET /graph                          PNG, ?city=...&variable&start&end
+# Series and aggregates are JSON, or CSV with ?format=csv, and are
+# streamed from the database one batch at a time
+# Every response carries the data version as its ETag, so a client
+# sending it back in If-None-Match gets 304 until new data is stored
+def create_app(path=None, pool_size=None):
+    from flask import Flask, Response, request, jsonify, abort
+    from werkzeug.exceptions import HTTPException
+
+    path = path or DATABASE_FILE
+    # Read-only connections cannot create the schema or switch to WAL
+    connect_database(path).close()
+
+    app = Flask(__name__)
+    pool = ReadPool(path, pool_size)
+    cache = ResponseCache()
+    app.extensions['climagraph'] = {'pool': pool, 'cache': cache}
+
+    # Runs prepare(c) in a read transaction and sends what it returns,
+    # an iterable of text or bytes chunks
+    # prepare does its lookups and checks up front, so errors are
+    # raised before the response starts, and the chunks are streamed
+    # while the connection stays lent
+    def send(prepare, mimetype):
+        metrics.count('service_requests')
+        key = request.full_path
+        conn = pool.acquire()
+        c = conn.cursor()
+        try:
+            c.execute("BEGIN")
+            version = data_version(c)
+            tag = str(version)
+            if request.if_none_match.contains_weak(tag):
+                metrics.count('service_not_modified')
+                response = Response(status=304)
+                chunks = None
+            else:
+                cached = cache.get(key, version)
+                if cached is not None:
+                    metrics.count('service_cache_hits')
+                    response = Response(cached[1], mimetype=cached[0])
+                    chunks = None
+                else:
+                    chunks = iter(prepare(c))
+        except BaseException:
+            c.close()
+            pool.release(conn)
+            raise
+        if chunks is None:
+            c.close()
+            pool.release(conn)
+            response.set_etag(tag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+
+        lent = [conn]
+
+        # Gives the connection back once, when the body has been sent
+        # or when the response is closed unread, as HEAD responses and
+        # dropped clients are
+        def release():
+            if lent:
+                c.close()
+                pool.release(lent.pop())
+
+        def stream():
+            kept, size = [], 0
+            try:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    if kept is not None:
+                        size += len(chunk)
+                        if size > cache.max_entry:
+                            kept = None
+                        else:
+                            kept.append(chunk)
+                    yield chunk
+            finally:
+                release()
+            if kept is not None:
+                cache.put(key, version, mimetype, b"".join(kept))
+
+        response = Response(stream(), mimetype=mimetype)
+        response.call_on_close(release)
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def find(c, city):
+        location_id = match_location(c, city)
+        if location_id is None:
+            abort(404, description=f"{city} not found in database")
+        name = c.execute(
+            "SELECT name FROM locations WHERE location_id = ?",
+            (location_id,)
+        ).fetchone()[0]
+        return location_id, name
+
+    def output_format():
+        export_format = request.args.get('format', 'json')
+        if export_format not in SERVICE_FORMATS:
+            abort(400, description=f"Unknown format: {export_format}")
+        return export_format
+
+    def date_range():
+        try:
+            return (
+                date_argument(request.args, 'start', '1940-01-01'),
+                date_argument(
+                    request.args, 'end', datetime.now().strftime("%Y-%m-%d"))
+            )
+        except ValueError as error:
+            abort(400, description=str(error))
+
+    @app.errorhandler(HTTPException)
+    def http_error(error):
+        return jsonify(error=error.description), error.code
+
+    @app.get("/locations")
+    def locations():
+        def prepare(c):
+            rows = c.execute(
+                '''SELECT location_id, name, latitude, longitude, variable,
+                          MIN(start_date), MAX(end_date)
+                   FROM locations LEFT JOIN coverage USING (location_id)
+                   GROUP BY location_id, variable
+                   ORDER BY name, variable'''
+            ).fetchall()
+            aliases = collections.defaultdict(list)
+            for name, location_id in c.execute(
+                    "SELECT name, location_id FROM aliases ORDER BY name"):
+                aliases[location_id].append(name)
+            result = []
+            for (location_id, name, lat, lon), group in itertools.groupby(
+                    rows, key=lambda row: row[:4]):
+                result.append({
+                    'name': name, 'latitude': lat, 'longitude': lon,
+                    'aliases': aliases[location_id],
+                    'variables': {
+                        row[4]: {'start': row[5], 'end': row[6]}
+                        for row in group if row[4] is not None
+                    }
+                })
+            return [json.dumps(result)]
+
+        return send(prepare, SERVICE_FORMATS['json'])
+
+    @app.get("/locations/<city>/series")
+    def series(city):
+        export_format = output_format()
+        start, end = date_range()
+
+        def prepare(c):
+            location_id, name = find(c, city)
+            stored = stored_variables(c, location_id)
+            variables = request.args.get('variables')
+            variables = variables.split(",") if variables else stored
+            unknown = [v for v in variables if v not in stored]
+            if unknown:
+                abort(400, description=f"Not stored: {', '.join(unknown)}")
+            col_names, batches = get_backend().query(
+                c, location_id, variables, start, end)
+            if export_format == 'csv':
+                return stream_csv(col_names, batches)
+            return stream_json(name, col_names, batches)
+
+        return send(prepare, SERVICE_FORMATS[export_format])
+
+    @app.get("/locations/<city>/hourly")
+    def hourly(city):
+        export_format = output_format()
+        start, end = date_range()
+        stat = request.args.get('stat', 'mean')
+        try:
+            bucket = int(request.args.get('bucket', 1))
+            check_bucket(bucket)
+            if stat not in BUCKET_STATS:
+                raise ValueError(f"Unknown statistic: {stat}")
+        except ValueError as error:
+            abort(400, description=str(error))
+
+        def prepare(c):
+            location_id, name = find(c, city)
+            stored = stored_hourly_variables(c, location_id)
+            variables = request.args.get('variables')
+            variables = variables.split(",") if variables else stored
+            unknown = [v for v in variables if v not in stored]
+            if unknown:
+                abort(400, description=f"Not stored: {', '.join(unknown)}")
+            col_names, batches = query_hourly(
+                c, location_id, variables, start, end, bucket, stat)
+            if export_format == 'csv':
+                return stream_csv(col_names, batches)
+            return stream_json(name, col_names, batches)
+
+        return send(prepare, SERVICE_FORMATS[export_format])
+
+    @app.get("/locations/<city>/aggregates")
+    def aggregates(city):
+        export_format = output_format()
+        variable = request.args.get('variable')
+        period = request.args.get('period', 'month')
+        if not variable:
+            abort(400, description="variable is required")
+        if period not in ROLLUP_PERIODS:
+            abort(400, description=f"Unknown period: {period}")
+
+        def prepare(c):
+            location_id, name = find(c, city)
+            col_names, rows = query_rollups(
+                c, location_id, variable, period,
+                request.args.get('start'), request.args.get('end'),
+                backfill=False
+            )
+            if export_format == 'csv':
+                return stream_csv(col_names[3:], [[row[3:] for row in rows]])
+            return stream_json(
+                name, col_names[3:], [[row[3:] for row in rows]])
+
+        return send(prepare, SERVICE_FORMATS[export_format])
+
+    @app.get("/locations/<city>/overview")
+    def overview(city):
+        export_format = output_format()
+        variable = request.args.get('variable')
+        if not variable:
+            abort(400, description="variable is required")
+        try:
+            points = int(request.args.get('points', GRAPH_PERIODS))
+            if points < 1:
+                raise ValueError(f"points must be positive: {points}")
+        except ValueError as error:
+            abort(400, description=str(error))
+        start, end = date_range()
+
+        def prepare(c):
+            location_id, name = find(c, city)
+            if variable not in stored_variables(c, location_id):
+                abort(400, description=f"Not stored: {variable}")
+            level, col_names, rows = read_pyramid(
+                c, location_id, variable, start, end, points,
+                backfill=False
+            )
+            if export_format == 'csv':
+                return stream_csv(col_names, [rows])
+            return [json.dumps({
+                'location': name, 'variable': variable, 'level': level,
+                'columns': col_names, 'rows': rows})]
+
+        return send(prepare, SERVICE_FORMATS[export_format])
+
+    @app.get("/graph")
+    def graph():
+        cities = request.args.getlist('city')
+        target_var = request.args.get('variable')
+        if not cities or not target_var:
+            abort(400, description="city and variable are required")
+        start, end = date_range()
+
+        def prepare(c):
+            names = []
+            for city in cities:
+                location_id, name = find(c, city)
+                if target_var not in stored_variables(c, location_id):
+                    abort(400, description=f"{target_var} not stored "
+                                           f"for {name}")
+                names.append(name)
+            image = io.BytesIO()
+            render_graph(
+                overview_series(
+                    c, names, target_var, start, end, backfill=False),
+                target_var, image)
+            return [image.getvalue()]
+
+        return send(prepare, 'image/png')
+
+    return app
+
+
+# fetch: download the dates not stored yet for some cities
+def command_fetch(args):
+    # If the start date is before 2016, use the archive API
+    if check_date(args.start):
+        url, variables = ARCHIVE_URL, ARCHIVE_VARIABLES
+    else:
+        url, variables = FORECAST_URL, FORECAST_VARIABLES
+
+    resolution = 'hourly' if args.hourly else 'daily'
+    if args.hourly:
+        variables = HOURLY_VARIABLES
+
+    cities_dict, failures = update_cities(
+        url, args.variables or variables, args.cities, args.start, args.end,
+        resolution)
+    unit = 'hours' if args.hourly else 'days'
+    for city, dataframe in cities_dict.items():
+        print(f"{city}: {len(dataframe)} {unit} stored")
+    for user_city, error in failures.items():
+        print(f"Error: Could not fetch {user_city}: {error}")
+    return 1 if failures else 0
+
+
+# Opens the database and finds the location matching a city name
+# Returns (conn, location_id), location_id is None when nothing matches
+def open_location(city):
+    conn = connect_database()
+    location_id = match_location(conn.cursor(), city)
+    if location_id is None:
+        print(f"Error: {city} not found in database.")
+    return conn, location_id
+
+
+# query: print the stored data of some cities as CSV, with a location
+# column for several cities, hourly values bucketed with --bucket and
+# --stat
+def command_query(args):
+    conn = connect_database()
+    c = conn.cursor()
+    location_ids = []
+    for city in args.cities:
+        location_id = match_location(c, city)
+        if location_id is None:
+            print(f"Error: {city} not found in database.")
+            conn.close()
+            return 1
+        location_ids.append(location_id)
+
+    try:
+        if args.hourly:
+            if len(set(location_ids)) > 1:
+                raise ValueError("--hourly queries one city at a time")
+            col_names, batches = query_hourly(
+                c, location_id, stored_hourly_variables(c, location_id),
+                args.start, args.end, args.bucket, args.stat
+            )
+        else:
+            col_names, batches = query_cities(
+                c, location_ids,
+                args.variables or stored_variables_of(c, location_ids),
+                args.start, args.end
+            )
+            if len(set(location_ids)) == 1:
+                col_names, batches = without_location(col_names, batches)
+    except ValueError as error:
+        print(f"Error: {error}")
+        conn.close()
+        return 1
+    csv_writer = csv.writer(sys.stdout)
+    csv_writer.writerow(col_names)
+    for rows in batches:
+        csv_writer.writerows(rows)
+    conn.close()
+    return 0
+
+
+# export: write the stored data of a city to a file
+def command_export(args):
+    conn, location_id = open_location(args.city)
+    if location_id is None:
+        conn.close()
+        return 1
+
+    try:
+        filename, row_count = export_location(
+            conn.cursor(), location_id, args.city, args.start, args.end,
+            args.format, directory=args.output_dir
+        )
+    finally:
+        conn.close()
+
+    if not row_count:
+        print("No results found for the specified criteria.")
+        return 1
+    print(f"Results saved to {filename}")
+    return 0
+
+
+# climate: print the monthly or annual rollups of a city as CSV
+def command_climate(args):
+    conn, location_id = open_location(args.city)
+    if location_id is None:
+        conn.close()
+        return 1
+
+    col_names, rows = query_rollups(
+        conn.cursor(), location_id, args.variable, args.period,
+        args.start, args.end
+    )
+    conn.commit()
+    conn.close()
+    csv_writer = csv.writer(sys.stdout)
+    csv_writer.writerow(col_names[3:])
+    csv_writer.writerows(row[3:] for row in rows)
+    return 0
+
+
+# plot: graph stored data of some cities, one PNG per variable
+def command_plot(args):
+    conn = connect_database()
+    c = conn.cursor()
+    names = []
+    for city in args.cities:
+        location_id = match_location(c, city)
+        if location_id is None:
+            print(f"Error: {city} not found in database.")
+            continue
+        names.append(c.execute(
+            "SELECT name FROM locations WHERE location_id = ?",
+            (location_id,)
+        ).fetchone()[0])
+    if not names:
+        conn.close()
+        return 1
+    # Long ranges are read from the pyramid, one series per variable
+    jobs = [
+        (
+            overview_series(c, names, target_var, args.start, args.end),
+            target_var,
+            os.path.join(args.output_dir or '', f"{target_var}_plot.png")
+        )
+        for target_var in args.variables
+    ]
+    conn.commit()
+    conn.close()
+
+    results = render_graphs(jobs, args.workers)
+    for filename, _ in results:
+        print(f"Graph saved to {filename}")
+    return 0
+
+
+# batch: run a job file without prompting
+def command_batch(args):
+    summaries = run_batch(args.job_file)
+    args.metric_runs = [
+        ({'job': summary['name']}, summary['metrics'])
+        for summary in summaries
+    ]
+    return 1 if any(s['status'] == 'failed' for s in summaries) else 0
+
+
+# serve: answer HTTP requests for the stored data until interrupted
+def command_serve(args):
+    app = create_app(pool_size=args.pool_size)
+    app.run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+# Command line parser, one subcommand per task so that each one only
+# loads what it needs, without a command the interactive menu runs
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="ClimaGraph.py",
+        description="Fetch, store, export and graph Open-Meteo data."
+    )
+    parser.add_argument(
+        "--backend", choices=[SQLiteBackend.name, ColumnarBackend.name],
+        help=f"storage backend for the series (default: {STORAGE_BACKEND})"
+    )
+    parser.add_argument(
+        "--cache-stats", action="store_true",
+        help="print HTTP cache hits, misses and sizes when done"
+    )
+    parser.add_argument(
+        "--metrics", choices=METRICS_FORMATS,
+        help="write stage timings and counters when done (per job for "
+             "batch), to stderr unless --metrics-file is given"
+    )
+    parser.add_argument("--metrics-file", help="file to write metrics to")
+    parser.add_argument(
+        "--profile", metavar="FILE",
+        help="save cProfile stats of the main thread to FILE")
+    parser.add_argument(
+        "--trace-memory", action="store_true",
+        help="trace allocations, reported as the memory_peak_bytes gauge")
+    commands = parser.add_subparsers(dest="command")
+
+    def add_range(command):
+        command.add_argument(
+            "--start", default="1940-01-01", help="yyyy-mm-dd")
+        command.add_argument(
+            "--end", default=datetime.now().strftime("%Y-%m-%d"),
+            help="yyyy-mm-dd")
+
+    fetch = commands.add_parser(
+        "fetch", help="download the dates not stored yet for some cities")
+    fetch.add_argument("cities", nargs="+")
+    fetch.add_argument("--start", required=True, help="yyyy-mm-dd")
+    fetch.add_argument("--end", required=True, help="yyyy-mm-dd")
+    fetch.add_argument("--variables", nargs="+")
+    fetch.add_argument(
+        "--hourly", action="store_true",
+        help="fetch hourly variables instead of daily ones")
+    fetch.set_defaults(func=command_fetch)
+
+    query = commands.add_parser(
+        "query", help="print the stored data of cities as CSV")
+    query.add_argument("cities", nargs="+")
+    add_range(query)
+    query.add_argument(
+        "--variables", nargs="+",
+        help="variables to print, every stored one by default")
+    query.add_argument(
+        "--hourly", action="store_true", help="print hourly values")
+    query.add_argument(
+        "--bucket", type=int, default=1, metavar="HOURS",
+        help="aggregate hourly values over buckets of HOURS")
+    query.add_argument("--stat", choices=BUCKET_STATS, default="mean")
+    query.set_defaults(func=command_query)
+
+    export = commands.add_parser(
+        "export", help="write the stored data of a city to a file")
+    export.add_argument("city")
+    add_range(export)
+    export.add_argument(
+        "--format", choices=list(EXPORT_EXTENSIONS), default="csv")
+    export.add_argument("--output-dir")
+    export.set_defaults(func=command_export)
+
+    climate = commands.add_parser(
+        "climate", help="print monthly or annual aggregates and anomalies")
+    climate.add_argument("city")
+    climate.add_argument("--variable", required=True)
+    climate.add_argument(
+        "--period", choices=list(ROLLUP_PERIODS), default="month")
+    climate.add_argument("--start", help="yyyy or yyyy-mm")
+    climate.add_argument("--end", help="yyyy or yyyy-mm")
+    climate.set_defaults(func=command_climate)
+
+    plot = commands.add_parser(
+        "plot", help="graph the stored data of some cities")
+    plot.add_argument("cities", nargs="+")
+    plot.add_argument("--variables", nargs="+", required=True)
+    add_range(plot)
+    plot.add_argument("--output-dir")
+    plot.add_argument("--workers", type=int)
+    plot.set_defaults(func=command_plot)
+
+    batch = commands.add_parser(
+        "batch", help="run the jobs of a JSON job file without prompting")
+    batch.add_argument("job_file")
+    batch.set_defaults(func=command_batch)
+
+    serve = commands.add_parser(
+        "serve", help="serve the stored data over HTTP, read-only")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=5000)
+    serve.add_argument(
+        "--pool-size", type=int, default=SERVICE_POOL_SIZE,
+        help="read-only database connections to keep open")
+    serve.set_defaults(func=command_serve)
+
+    return parser
+
+
+# Runs the command line, returns the exit status
+def run_cli(argv=None):
+    global STORAGE_BACKEND
+
+    args = build_parser().parse_args(argv)
+    if args.backend:
+        STORAGE_BACKEND = args.backend
+    metrics.reset()
+    with profiling(args.profile, args.trace_memory):
+        if args.command is None:
+            main()
+            status = 0
+        else:
+            status = args.func(args)
+    if args.metrics:
+        runs = getattr(args, 'metric_runs', None) or [
+            ({'command': args.command or 'menu'}, metrics.snapshot())]
+        write_metrics(runs, args.metrics, args.metrics_file)
+    if args.cache_stats:
+        print_cache_stats(get_http_cache().stats())
+    return status
+
+
 if __name__ == "__main__":
     # Globally suppress the specific UserWarning
     warnings.filterwarnings(
         "ignore", category=UserWarning,
         message=r"Glyph .* missing from font\(s\) DejaVu Sans"
     )
-    main()
+    sys.exit(run_cli())
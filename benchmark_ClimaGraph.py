@@ -0,0 +1,607 @@
+import argparse
+import collections
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import flatbuffers
+import numpy as np
+import pandas as pd
+
+import ClimaGraph
+
+SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "ClimaGraph.py")
+
+# Small database so the query and export commands have rows to stream
+SEED = f"""
+import sys
+sys.path.insert(0, {os.path.dirname(SCRIPT)!r})
+import pandas as pd
+import ClimaGraph
+dates = pd.date_range('2020-01-01', periods=366).strftime('%Y-%m-%d')
+ClimaGraph.write_to_file({{'Oslo': pd.DataFrame({{
+    'date': dates, 'temperature_2m_max': range(len(dates))
+}})}})
+"""
+
+# Each case runs in a fresh interpreter, the way a user runs the script
+STARTUP_CASES = {
+    "import": [sys.executable, "-c",
+               f"import sys; sys.path.insert(0, {os.path.dirname(SCRIPT)!r});"
+               " import ClimaGraph"],
+    "query --help": [sys.executable, SCRIPT, "query", "--help"],
+    "query": [sys.executable, SCRIPT, "query", "Oslo"],
+    "export": [sys.executable, SCRIPT, "export", "Oslo"],
+}
+
+# Benchmarked date ranges end here, so runs fetch the same days
+LAST_DAY = date(2020, 12, 31)
+
+# Shape of the synthetic series, per variable:
+# (annual mean, seasonal amplitude, day to day noise), in the units
+# ClimaGraph asks for (fahrenheit, inch, mph)
+SERIES_SHAPES = {
+    "temperature_2m_max": (60.0, 20.0, 6.0),
+    "temperature_2m_min": (42.0, 18.0, 6.0),
+    "temperature_2m_mean": (51.0, 19.0, 5.0),
+    "uv_index_max": (4.5, 3.5, 1.0),
+    "precipitation_sum": (0.05, 0.03, 0.25),
+    "wind_speed_10m_max": (14.0, 3.0, 5.0),
+    "shortwave_radiation_sum": (15.0, 10.0, 4.0),
+}
+
+
+# Deterministic daily values for a location, seasonal and noisy like
+# real series, with the seasons flipped south of the equator
+def synthetic_values(variable, latitude, longitude, start, days):
+    mean, amplitude, noise = SERIES_SHAPES.get(variable, (10.0, 5.0, 2.0))
+    seed = zlib.crc32(f"{variable},{latitude},{longitude},{start}".encode())
+    rng = np.random.default_rng(seed)
+    day_of_year = (
+        np.arange(days) + date.fromisoformat(str(start)).timetuple().tm_yday)
+    season = np.cos(2 * np.pi * (day_of_year - 200) / 365.25)
+    if latitude < 0:
+        season = -season
+    values = mean + amplitude * season + rng.normal(0, noise, days)
+    if variable in ("precipitation_sum", "uv_index_max",
+                    "wind_speed_10m_max", "shortwave_radiation_sum"):
+        values = np.maximum(values, 0)
+    return values.astype(np.float32)
+
+
+# Synthetic stored series of one location, as fetch_cities returns them
+def synthetic_frame(variables, latitude, longitude, start, days):
+    frame = pd.DataFrame({"date": pd.date_range(
+        start, periods=days, freq="D", tz="UTC")})
+    for variable in variables:
+        frame[variable] = synthetic_values(
+            variable, latitude, longitude, start, days)
+    frame.attrs.update(latitude=latitude, longitude=longitude)
+    return frame
+
+
+# One length-prefixed FlatBuffers WeatherApiResponse holding daily
+# series, laid out like the Open-Meteo server sends them
+# Field slots follow the openmeteo_sdk schema
+def weather_message(latitude, longitude, start, days, variables,
+                    utc_offset=0):
+    builder = flatbuffers.Builder(1024 + 4 * days * len(variables))
+
+    columns = []
+    for variable in variables:
+        values = builder.CreateNumpyVector(synthetic_values(
+            variable, latitude, longitude, start, days))
+        builder.StartObject(4)  # VariableWithValues
+        builder.PrependUOffsetTRelativeSlot(3, values, 0)
+        columns.append(builder.EndObject())
+    builder.StartVector(4, len(columns), 4)
+    for column in reversed(columns):
+        builder.PrependUOffsetTRelative(column)
+    variables_vector = builder.EndVector()
+
+    first = int(datetime.fromisoformat(str(start)).replace(
+        tzinfo=timezone.utc).timestamp()) - utc_offset
+    builder.StartObject(4)  # VariablesWithTime
+    builder.PrependInt64Slot(0, first, 0)
+    builder.PrependInt64Slot(1, first + 86400 * days, 0)
+    builder.PrependInt32Slot(2, 86400, 0)
+    builder.PrependUOffsetTRelativeSlot(3, variables_vector, 0)
+    daily = builder.EndObject()
+
+    builder.StartObject(11)  # WeatherApiResponse, up to daily
+    builder.PrependFloat32Slot(0, latitude, 0.0)
+    builder.PrependFloat32Slot(1, longitude, 0.0)
+    builder.PrependInt32Slot(6, utc_offset, 0)
+    builder.PrependUOffsetTRelativeSlot(10, daily, 0)
+    builder.Finish(builder.EndObject())
+
+    body = builder.Output()
+    return len(body).to_bytes(4, "little") + bytes(body)
+
+
+# Coordinates the stand-in Nominatim returns for a place name
+def stand_in_coordinates(query):
+    digest = zlib.crc32(ClimaGraph.normalize_query(query).encode())
+    latitude = round(-55 + digest % 12000 / 100, 4)
+    longitude = round(-180 + (digest >> 12) % 36000 / 100, 4)
+    return latitude, longitude
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        time.sleep(self.server.latency)
+        if url.path == "/search":
+            self.geocode(query)
+        elif url.path in ("/v1/archive", "/v1/forecast"):
+            self.weather(query)
+        else:
+            self.send_body(404, {"error": True, "reason": "Not found"})
+
+    # Nominatim search, every name but Atlantis is found
+    def geocode(self, query):
+        self.server.count("geocode")
+        name = query.get("q", [""])[0]
+        if ClimaGraph.normalize_query(name) == "atlantis":
+            self.send_body(200, [])
+            return
+        latitude, longitude = stand_in_coordinates(name)
+        self.send_body(200, [{
+            "place_id": zlib.crc32(name.encode()),
+            "lat": str(latitude),
+            "lon": str(longitude),
+            "display_name": f"{name}, Stand-in",
+            "class": "place",
+            "type": "city",
+            "importance": 0.5,
+        }])
+
+    # Open-Meteo forecast/archive, one message per requested location
+    def weather(self, query):
+        if not self.server.allow():
+            self.server.count("limited")
+            self.send_body(429, {
+                "error": True, "reason": ClimaGraph.RATE_LIMIT_ERROR})
+            return
+        self.server.count("weather")
+
+        def values(name):
+            return [
+                item for value in query.get(name, [])
+                for item in value.split(",") if item
+            ]
+
+        try:
+            start = date.fromisoformat(query["start_date"][0])
+            end = date.fromisoformat(query["end_date"][0])
+            locations = list(zip(
+                map(float, values("latitude")),
+                map(float, values("longitude"))))
+        except (KeyError, ValueError) as e:
+            self.send_body(400, {"error": True, "reason": str(e)})
+            return
+        days = (end - start).days + 1
+        if days <= 0 or not locations:
+            self.send_body(400, {
+                "error": True, "reason": "Invalid date range or location"})
+            return
+
+        self.send_body(200, b"".join(
+            weather_message(latitude, longitude, start, days,
+                            values("daily"))
+            for latitude, longitude in locations
+        ), "application/octet-stream")
+
+    def send_body(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Local stand-in for the Open-Meteo and Nominatim servers
+# latency: seconds added to every request
+# rate_limit: weather requests allowed per rate_window seconds, 0 for
+# no limit, requests over it get Open-Meteo's 429 answer
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, rate_limit=0, rate_window=60.0):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.recent = collections.deque()
+        self.counts = collections.Counter()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    # Sliding window rate limit
+    def allow(self):
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and self.recent[0] <= now - self.rate_window:
+                self.recent.popleft()
+            if len(self.recent) >= self.rate_limit:
+                return False
+            self.recent.append(now)
+            return True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+# Points ClimaGraph at the stand-in server, with its database and
+# caches under workdir, and puts everything back afterwards
+@contextmanager
+def use_stand_in(server, workdir):
+    forecast_url = server.url + "/v1/forecast"
+    archive_url = server.url + "/v1/archive"
+    settings = {
+        "FORECAST_URL": forecast_url,
+        "ARCHIVE_URL": archive_url,
+        "HTTP_CACHE_POLICY": {
+            forecast_url: ClimaGraph.HTTP_CACHE_POLICY[
+                ClimaGraph.FORECAST_URL],
+            archive_url: ClimaGraph.HTTP_CACHE_POLICY[
+                ClimaGraph.ARCHIVE_URL],
+        },
+        "NOMINATIM_DOMAIN": server.url.split("://")[1],
+        "NOMINATIM_SCHEME": "http",
+        "GEOCODE_MIN_DELAY": 0,
+        "RATE_LIMIT_WAIT": server.rate_window,
+        # The stand-in has no weighted quotas, only its own rate_limit
+        "API_RATE_LIMITS": {},
+        "RATE_BUDGET_FILE": os.path.join(workdir, "rate_budget.db"),
+        "DATABASE_FILE": os.path.join(workdir, "weather_data.db"),
+        "COLUMNAR_DIR": os.path.join(workdir, "weather_columns"),
+        "HTTP_CACHE_FILE": os.path.join(workdir, "http_cache"),
+        "GEOCODE_CACHE_FILE": os.path.join(workdir, "geocode_cache.db"),
+        "openmeteo": None,
+        "http_cache": None,
+        "geocode_limiter": None,
+        "geocode_cache": None,
+        "rate_budget": None,
+        "storage_backends": {},
+    }
+    saved = {name: getattr(ClimaGraph, name) for name in settings}
+    for name, value in settings.items():
+        setattr(ClimaGraph, name, value)
+    try:
+        yield
+    finally:
+        for cache in (ClimaGraph.http_cache, ClimaGraph.geocode_cache,
+                      ClimaGraph.rate_budget):
+            if cache is not None:
+                cache.close()
+        for name, value in saved.items():
+            setattr(ClimaGraph, name, value)
+
+
+# City names and synthetic stored series for a benchmark size
+def city_names(cities):
+    return [f"Stand-in City {n}" for n in range(1, cities + 1)]
+
+
+def date_range_for(years):
+    start = date(LAST_DAY.year - years + 1, 1, 1)
+    return start.isoformat(), LAST_DAY.isoformat()
+
+
+def synthetic_cities(cities, years, variables):
+    start, end = date_range_for(years)
+    days = (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+    return {
+        name: synthetic_frame(
+            variables, *stand_in_coordinates(name), start, days)
+        for name in city_names(cities)
+    }
+
+
+# Every case takes (server, cities, years, workdir), runs untimed setup,
+# and returns a function doing the timed work that returns the number of
+# city-days it went through
+def fetch_case(server, cities, years, workdir):
+    start, end = date_range_for(years)
+    names = city_names(cities)
+
+    def run():
+        with tempfile.TemporaryDirectory(dir=workdir) as rundir, \
+                use_stand_in(server, rundir):
+            cities_dict, failures = ClimaGraph.update_cities(
+                ClimaGraph.ARCHIVE_URL, ClimaGraph.ARCHIVE_VARIABLES,
+                names, start, end)
+        if failures:
+            raise RuntimeError(f"fetch failed: {failures}")
+        return sum(len(frame) for frame in cities_dict.values())
+    return run
+
+
+def ingest_case(server, cities, years, workdir):
+    cities_dict = synthetic_cities(
+        cities, years, ClimaGraph.ARCHIVE_VARIABLES)
+
+    def run():
+        with tempfile.TemporaryDirectory(dir=workdir) as rundir, \
+                use_stand_in(server, rundir):
+            ClimaGraph.write_to_file(cities_dict)
+        return sum(len(frame) for frame in cities_dict.values())
+    return run
+
+
+# Cases reading stored data share one database per size
+@contextmanager
+def stored_cities(server, cities, years, workdir):
+    rundir = tempfile.mkdtemp(dir=workdir)
+    with use_stand_in(server, rundir):
+        ClimaGraph.write_to_file(synthetic_cities(
+            cities, years, ClimaGraph.ARCHIVE_VARIABLES))
+        yield rundir
+
+
+def query_case(server, cities, years, workdir):
+    start, end = date_range_for(years)
+    stored = stored_cities(server, cities, years, workdir)
+    rundir = stored.__enter__()
+
+    def run():
+        rows = 0
+        conn = ClimaGraph.connect_database()
+        c = conn.cursor()
+        for name in city_names(cities):
+            location_id = ClimaGraph.find_location(c, name)
+            _, batches = ClimaGraph.get_backend().query(
+                c, location_id, ClimaGraph.stored_variables(c, location_id),
+                start, end)
+            for batch in batches:
+                rows += len(batch)
+        conn.close()
+        return rows
+    run.cleanup = lambda: stored.__exit__(None, None, None)
+    run.rundir = rundir
+    return run
+
+
+def export_case(export_format):
+    def case(server, cities, years, workdir):
+        start, end = date_range_for(years)
+        run_query = query_case(server, cities, years, workdir)
+
+        def run():
+            rows = 0
+            conn = ClimaGraph.connect_database()
+            c = conn.cursor()
+            for name in city_names(cities):
+                _, count = ClimaGraph.export_location(
+                    c, ClimaGraph.find_location(c, name), name, start, end,
+                    export_format, directory=run_query.rundir)
+                rows += count
+            conn.close()
+            return rows
+        run.cleanup = run_query.cleanup
+        return run
+    return case
+
+
+def render_case(server, cities, years, workdir):
+    cities_dict = synthetic_cities(cities, years, ["temperature_2m_max"])
+    filename = os.path.join(workdir, "render_plot.png")
+
+    def run():
+        ClimaGraph.render_graph(cities_dict, "temperature_2m_max", filename)
+        return sum(len(frame) for frame in cities_dict.values())
+    return run
+
+
+CASES = {
+    "fetch": fetch_case,
+    "ingest": ingest_case,
+    "query": query_case,
+    "export-csv": export_case("csv"),
+    "export-parquet": export_case("parquet"),
+    "render": render_case,
+}
+
+
+# Runs one case `runs` times, returns its result record
+def measure(case, server, cities, years, runs, workdir):
+    run = case(server, cities, years, workdir)
+    times = []
+    try:
+        for _ in range(runs):
+            start = time.perf_counter()
+            items = run()
+            times.append((time.perf_counter() - start) * 1000)
+    finally:
+        getattr(run, "cleanup", lambda: None)()
+    median = statistics.median(times)
+    return {
+        "median_ms": median,
+        "min_ms": min(times),
+        "city_days": items,
+        "city_days_per_s": items / median * 1000 if median else 0.0,
+    }
+
+
+# Runs a command `runs` times, returns the wall times in milliseconds
+def time_command(command, runs, cwd):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+# Times fresh interpreters, returns {name: result record}
+def run_startup(runs=5):
+    results = {}
+    with tempfile.TemporaryDirectory() as cwd:
+        subprocess.run([sys.executable, "-c", SEED], cwd=cwd, check=True)
+        for name, command in STARTUP_CASES.items():
+            times = time_command(command, runs, cwd)
+            results[f"startup {name}"] = {
+                "median_ms": statistics.median(times),
+                "min_ms": min(times),
+            }
+    return results
+
+
+# Runs the selected cases for every size, printing a row per result
+# Returns {"<case> <cities>x<years>": result record}
+def run_benchmark(cases=None, cities=(1, 10), years=(1, 10), runs=3,
+                  latency=0.02, rate_limit=0, rate_window=60.0,
+                  startup=True):
+    results = {}
+    print(f"{'case':<32} {'median ms':>10} {'min ms':>10} "
+          f"{'city-days/s':>12}")
+
+    def report(name, result):
+        results[name] = result
+        throughput = result.get("city_days_per_s")
+        print(f"{name:<32} {result['median_ms']:>10.1f} "
+              f"{result['min_ms']:>10.1f} "
+              f"{'' if throughput is None else f'{throughput:>12.0f}'}")
+
+    if startup:
+        for name, result in run_startup(max(runs, 3)).items():
+            report(name, result)
+
+    server = StandInServer(latency, rate_limit, rate_window)
+    with server, tempfile.TemporaryDirectory() as workdir:
+        for case_name in cases or CASES:
+            for city_count in cities:
+                for year_count in years:
+                    report(
+                        f"{case_name} {city_count}x{year_count}",
+                        measure(CASES[case_name], server, city_count,
+                                year_count, runs, workdir)
+                    )
+    return results
+
+
+# Prints how each result moved against a saved run
+# Returns the names whose median got slower than tolerance allows
+def compare_results(baseline, results, tolerance=0.25):
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        ratio = result["median_ms"] / before["median_ms"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<32} {before['median_ms']:>10.1f} -> "
+              f"{result['median_ms']:>10.1f} ms ({ratio - 1:+.0%}){flag}")
+    return regressions
+
+
+def save_results(path, results, settings):
+    with open(path, "w") as file:
+        json.dump({
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": settings,
+            "results": results,
+        }, file, indent=2)
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark ClimaGraph against a local stand-in for "
+                    "the Open-Meteo and Nominatim servers.")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES))
+    parser.add_argument("--cities", nargs="+", type=int, default=[1, 10])
+    parser.add_argument("--years", nargs="+", type=int, default=[1, 10])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "--latency-ms", type=float, default=20,
+        help="delay the stand-in adds to every request")
+    parser.add_argument(
+        "--rate-limit", type=int, default=0,
+        help="weather requests allowed per --rate-window, 0 for no limit")
+    parser.add_argument("--rate-window", type=float, default=60)
+    parser.add_argument(
+        "--no-startup", action="store_true",
+        help="skip the fresh interpreter startup cases")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument(
+        "--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25,
+        help="slowdown against --compare counted as a regression")
+    parser.add_argument(
+        "--max-ms", type=float,
+        help="exit with status 1 when a startup median goes over this")
+    args = parser.parse_args()
+
+    settings = {
+        "cities": args.cities, "years": args.years, "runs": args.runs,
+        "latency_ms": args.latency_ms, "rate_limit": args.rate_limit,
+        "rate_window": args.rate_window,
+    }
+    results = run_benchmark(
+        args.cases, args.cities, args.years, args.runs,
+        args.latency_ms / 1000, args.rate_limit, args.rate_window,
+        not args.no_startup
+    )
+    if args.save:
+        save_results(args.save, results, settings)
+
+    failed = []
+    if args.compare:
+        failed += compare_results(
+            load_results(args.compare), results, args.tolerance)
+    if args.max_ms is not None:
+        for name, result in results.items():
+            if name.startswith("startup ") and \
+                    result["median_ms"] > args.max_ms:
+                print(f"Regression: {name} took {result['median_ms']:.1f} "
+                      f"ms (limit {args.max_ms:.1f} ms)")
+                failed.append(name)
+    sys.exit(1 if failed else 0)
@@ -1,21 +1,204 @@
 import unittest
 from unittest.mock import patch, mock_open, MagicMock
 from ClimaGraph import *
-from io import StringIO
+import ClimaGraph
+from io import StringIO, BytesIO
 import pandas as pd
 from datetime import datetime, timedelta
 import warnings
+from contextlib import contextmanager
+import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import numpy as np
+import os
+import tempfile
+import sqlite3
+import json
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import sys
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+from benchmark_ClimaGraph import (
+    StandInServer, use_stand_in, stand_in_coordinates, weather_message,
+    synthetic_values)
+from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
 
 
-class TestWeatherData(unittest.TestCase):
+# Minimal stand-ins for the Open-Meteo SDK response objects
+class FakeVariable:
+    def __init__(self, values):
+        self.values = values
+
+    def ValuesAsNumpy(self):
+        return self.values
+
+
+class FakeDaily:
+    def __init__(self, start, columns, interval=86400):
+        self.start = int(pd.Timestamp(start, tz='UTC').timestamp())
+        self.columns = columns
+        self.interval = interval
+
+    def Time(self):
+        return self.start
+
+    def TimeEnd(self):
+        return self.start + self.interval * len(self.columns[0])
+
+    def Interval(self):
+        return self.interval
+
+    def Variables(self, i):
+        return FakeVariable(self.columns[i])
+
+
+class FakeResponse:
+    def __init__(self, start, columns, lat=40.7, lon=-74.0, interval=86400):
+        self.daily = FakeDaily(start, columns, interval)
+        self.lat = lat
+        self.lon = lon
+
+    def Daily(self):
+        return self.daily
+
+    def Hourly(self):
+        return self.daily
+
+    def Latitude(self):
+        return self.lat
+
+    def Longitude(self):
+        return self.lon
+
+    def UtcOffsetSeconds(self):
+        return 0
+
+
+class FakeLocation:
+    def __init__(self, name, lat=40.7, lon=-74.0):
+        self.raw = {'display_name': name, 'lat': lat, 'lon': lon}
+        self.latitude = lat
+        self.longitude = lon
+        self.address = name
+
+
+def fake_columns(variables, days, offset=0.0):
+    return [
+        np.arange(days, dtype=np.float32) + offset + i
+        for i in range(len(variables))
+    ]
+
+
+# Every city gets coordinates of its own, in a grid cell of its own
+def fake_geocode(user_city):
+    if user_city == 'Atlantis':
+        return None
+    return FakeLocation(
+        f'{user_city} City', *stand_in_coordinates(user_city))
+
+
+# Answers with one response per comma-separated latitude
+def fake_api(url, params, method='GET'):
+    latitudes = str(params['latitude']).split(',')
+    # Later cities answer first to exercise the ordering guarantee
+    time.sleep(0.05 if '1' in latitudes else 0)
+    days = (pd.Timestamp(params['end_date']) -
+            pd.Timestamp(params['start_date'])).days + 1
+    return [
+        FakeResponse(
+            params['start_date'],
+            fake_columns(params['daily'], days, float(lat)), float(lat)
+        )
+        for lat in latitudes
+    ]
+
+
+# Answers hourly requests with one response per latitude, the value of
+# every hour being its number since the start plus the latitude
+def fake_hourly_api(url, params, method='GET'):
+    hours = 24 * ((pd.Timestamp(params['end_date']) -
+                   pd.Timestamp(params['start_date'])).days + 1)
+    return [
+        FakeResponse(
+            params['start_date'],
+            fake_columns(params['hourly'], hours, float(lat)), float(lat),
+            interval=3600
+        )
+        for lat in str(params['latitude']).split(',')
+    ]
+
+
+# Swaps in an Open-Meteo client whose weather_api is a mock
+@contextmanager
+def patch_api(side_effect):
+    client = MagicMock()
+    client.weather_api.side_effect = side_effect
+    with patch('ClimaGraph.openmeteo', client), \
+            patch('ClimaGraph.rate_budget', RateBudget(':memory:')):
+        yield client.weather_api
+
+
+# Transport answering every request with `size` bytes, no network
+class FakeAdapter(HTTPAdapter):
+    def __init__(self, size=100):
+        super().__init__()
+        self.size = size
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append(request.url)
+        return self.build_response(request, HTTPResponse(
+            body=BytesIO(b'x' * self.size), status=200,
+            preload_content=False, request_url=request.url
+        ))
+
+
+# Base for tests touching stored data or files: every test works in a
+# temporary directory with a database, columnar store and caches of
+# its own, so tests never see each other's data or leave files behind
+class TempDirTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        self.db_path = os.path.join(self.tmpdir, 'weather_data.db')
+        self.patch_all([
+            patch('ClimaGraph.DATABASE_FILE', self.db_path),
+            patch('ClimaGraph.COLUMNAR_DIR',
+                  os.path.join(self.tmpdir, 'weather_columns')),
+            patch('ClimaGraph.storage_backends', {}),
+            patch('ClimaGraph.geocode_cache', GeocodeCache(':memory:')),
+            patch('ClimaGraph.rate_budget', RateBudget(':memory:')),
+            patch('ClimaGraph.query_cache', QueryCache()),
+            patch('ClimaGraph.metrics', Metrics()),
+        ])
+
+    # Starts patchers, stopped at the end of the test
+    def patch_all(self, patchers):
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # Makes the temporary directory the working directory of the test
+    def work_in_tmpdir(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tmpdir)
+
+
+class TestWeatherData(TempDirTestCase):
 
     @patch('builtins.input', side_effect=[
         1, 'New York', '2023-01-01', '2023-01-07'])
     def test_weather_forecast(self, mock_input):
         # Test weather_forecast function with mocked user input
-        cities_dict = weather_forecast('2023-01-01', '2023-01-07')
-        # Assert that the function returns a dictionary
-        self.assertIsInstance(cities_dict, dict)
+        # against the local stand-in for the API servers
+        with StandInServer() as server, use_stand_in(server, self.tmpdir):
+            cities_dict = weather_forecast('2023-01-01', '2023-01-07')
+        # Assert that the function returns a city series
+        self.assertIsInstance(cities_dict, CitySeries)
         # Assert that the dictionary is not empty
         self.assertTrue(len(cities_dict) > 0)
 
@@ -23,41 +206,47 @@ class TestWeatherData(unittest.TestCase):
         1, 'New York', '2023-01-01', '2023-01-07'])
     def test_weather_archive(self, mock_input):
         # Test weather_archive function with mocked user input
-        cities_dict = weather_archive('2023-01-01', '2023-01-07')
-        # Assert that the function returns a dictionary
-        self.assertIsInstance(cities_dict, dict)
+        # against the local stand-in for the API servers
+        with StandInServer() as server, use_stand_in(server, self.tmpdir):
+            cities_dict = weather_archive('2023-01-01', '2023-01-07')
+        # Assert that the function returns a city series
+        self.assertIsInstance(cities_dict, CitySeries)
         # Assert that the dictionary is not empty
         self.assertTrue(len(cities_dict) > 0)
 
+    # Stores a few days of New York and works in the temporary
+    # directory, where query_database saves its file
+    def stored_new_york(self):
+        self.work_in_tmpdir()
+        write_to_file({'New York': pd.DataFrame({
+            'date': pd.date_range('2023-01-01', periods=7).strftime(
+                '%Y-%m-%d'),
+            'temperature_2m_max': np.arange(7, dtype='float64'),
+        })})
+
     @patch('builtins.input', side_effect=[
-        'New York', '2023-01-01', '2023-01-01', '2023-01-07'])
+        'New York', '2023-01-01', '2023-01-07'])
     @patch('sys.stdout', new_callable=StringIO)
     def test_query_database_existing_city(self, mock_stdout, mock_input):
-        # Test query_database function with mocked
-        # Database response for an existing city
-        with patch('weather_data.sqlite3') as mock_sqlite:
-            mock_cursor = mock_sqlite.connect().cursor()
-            # Mock database cursor to return a known result
-            mock_cursor.fetchall.return_value = [
-                ('2023-01-01_weather_data_2023-01-01_to_2023-01-07.csv',)]
-            query_database()
+        # Test query_database function against a database
+        # holding the city
+        self.stored_new_york()
+        query_database()
         # Assert that the expected message is printed
-        saved_csv = "2023-01-01_weather_data_2023-01-01_to_2023-01-07.csv"
+        saved_csv = export_filename('New York', '2023-01-01', '2023-01-07')
         self.assertIn(
             f"Results saved to {saved_csv}", mock_stdout.getvalue().strip())
+        with open(saved_csv) as file:
+            self.assertEqual(len(file.read().splitlines()), 8)
 
     @patch('builtins.input', side_effect=[
-        'Nonexistent City', '2023-01-01', '2023-01-01', '2023-01-07'])
+        'Nonexistent City', 'New York', '2023-01-01', '2023-01-07'])
     @patch('sys.stdout', new_callable=StringIO)
     def test_query_database_nonexistent_city(self, mock_stdout, mock_input):
-        # Test query_database function with mocked
-        # Database response for a nonexistent city
-        with patch('weather_data.sqlite3') as mock_sqlite:
-            mock_cursor = mock_sqlite.connect().cursor()
-            # Mock database cursor to return an empty result
-            mock_cursor.fetchall.return_value = [
-                ('2023-01-01_weather_data_2023-01-01_to_2023-01-07.csv',)]
-            query_database()
+        # Test query_database function with a city the database
+        # does not hold, then one it does
+        self.stored_new_york()
+        query_database()
 
         # Assert that the expected error message is printed
         prompt_str = "Please enter a valid city name"
@@ -65,16 +254,9 @@ class TestWeatherData(unittest.TestCase):
             f"Error: City not found in database. {prompt_str}.",
             mock_stdout.getvalue().strip()
         )
+        self.assertIn("Results saved to", mock_stdout.getvalue())
 
-    @patch('weather_data.sqlite3.connect')
-    @patch('pandas.DataFrame.to_sql')
-    def test_write_to_file(self, mock_to_sql, mock_connect):
-        # Mock the connection and cursor
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-
+    def test_write_to_file(self):
         # Create a sample cities_dict with a pandas dataframe
         sample_data = {
             'date': ['2023-01-01', '2023-01-02'],
@@ -84,32 +266,48 @@ class TestWeatherData(unittest.TestCase):
             'precipitation_sum': [0.0, 0.1],
             'wind_speed_10m_max': [10.0, 12.0]
         }
-        sample_df = pd.DataFrame(sample_data)
-        cities_dict = {'New York': sample_df}
-
-        # Call the write_to_file function with the sample data
-        write_to_file(cities_dict)
-
-        # Verify that the correct SQL commands were executed
-        expected_table_name = 'New_York'
-        mock_cursor.execute.assert_any_call(
-            f'''CREATE TABLE IF NOT EXISTS {expected_table_name} (
-                        date TEXT,
-                        temperature_2m_max REAL,
-                        temperature_2m_min REAL,
-                        uv_index_max REAL,
-                        precipitation_sum REAL,
-                        wind_speed_10m_max REAL)''')
-
-        # Check that commit was called, but allow for multiple calls
-        self.assertTrue(mock_conn.commit.call_count >= 1)
-        mock_conn.close.assert_called_once()
-
-        # Verify that the dataframe was written to the table
-        sample_df.to_sql.assert_called_with(
-            expected_table_name,
-            mock_conn, if_exists='replace', index=False
-        )
+        newer_data = dict(sample_data, date=['2023-01-02', '2023-01-03'])
+
+        write_to_file({'New York': pd.DataFrame(sample_data)})
+        write_to_file({'New York': pd.DataFrame(newer_data)})
+
+        # Rows are upserted on date instead of replacing the table
+        conn = connect_database()
+        self.addCleanup(conn.close)
+        c = conn.cursor()
+        location_id = find_location(c, 'New York')
+        rows = c.execute(
+            '''SELECT date, temperature_2m_max FROM observations
+               WHERE location_id = ? ORDER BY date''', (location_id,)
+        ).fetchall()
+        self.assertEqual(rows, [
+            ('2023-01-01', 5.0), ('2023-01-02', 5.0), ('2023-01-03', 6.0)])
+        self.assertEqual(
+            missing_ranges(c, location_id, ['uv_index_max'],
+                           '2022-12-30', '2023-01-05'),
+            [('2022-12-30', '2022-12-31'), ('2023-01-04', '2023-01-05')])
+        self.assertEqual(
+            conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+
+    @patch('builtins.input', side_effect=[
+        'Lisbon', 'New York', '2023-01-02', '2023-01-03'])
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_query_database_reads_observations(self, mock_stdout, mock_input):
+        self.work_in_tmpdir()
+        write_to_file({'New York City (User entered: New York)': pd.DataFrame({
+            'date': ['2023-01-01', '2023-01-02', '2023-01-03'],
+            'temperature_2m_max': [5.0, 6.0, 7.0],
+        })})
+        query_database()
+
+        self.assertIn("Error: City not found in database.",
+                      mock_stdout.getvalue())
+        with open('New York_weather_data_2023-01-02_to_2023-01-03.csv') as f:
+            self.assertEqual(f.read().splitlines(), [
+                'date,temperature_2m_max',
+                '2023-01-02,6.0',
+                '2023-01-03,7.0',
+            ])
 
     def test_check_date(self):
         # Test dates before 2016
@@ -161,8 +359,10 @@ class TestWeatherData(unittest.TestCase):
 
         target_var = 'temperature'
 
-        # with self.assertWarns(UserWarning):
-        #     create_graph(cities_dict, target_var)
+        self.work_in_tmpdir()
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            create_graph(cities_dict, target_var)
+        self.assertIn("Graph has been saved", mock_stdout.getvalue())
 
         # Test that the plot file is created
         expected_filename = f'{target_var}_plot.png'
@@ -172,5 +372,1856 @@ class TestWeatherData(unittest.TestCase):
             self.fail(f"Plot file '{expected_filename}' not created.")
 
 
+class TestFetchCities(TempDirTestCase):
+
+    fake_geocode = staticmethod(fake_geocode)
+    fake_api = staticmethod(fake_api)
+
+    def test_fetch_cities_keeps_order_and_collects_failures(self):
+        user_cities = ['Boston', 'Atlantis', 'Denver', 'Austin']
+
+        def geocode_with_lat(user_city):
+            location = self.fake_geocode(user_city)
+            if location is not None and user_city == 'Boston':
+                location.raw['lat'] = 1
+            return location
+
+        with patch('ClimaGraph.geocode', side_effect=geocode_with_lat), \
+                patch_api(self.fake_api):
+            cities_dict, failures = fetch_cities(
+                FORECAST_URL, FORECAST_VARIABLES, user_cities,
+                '2023-01-01', '2023-01-03', max_workers=4, batch_size=1
+            )
+
+        self.assertEqual(list(cities_dict), [
+            'Boston City (User entered: Boston)',
+            'Denver City (User entered: Denver)',
+            'Austin City (User entered: Austin)',
+        ])
+        self.assertEqual(list(failures), ['Atlantis'])
+        self.assertIsInstance(failures['Atlantis'], ValueError)
+        dataframe = cities_dict['Denver City (User entered: Denver)']
+        self.assertEqual(
+            list(dataframe.columns), ['date'] + FORECAST_VARIABLES)
+        self.assertEqual(len(dataframe), 3)
+
+    def test_fetch_cities_packs_batches_into_one_request(self):
+        user_cities = ['A', 'B', 'C', 'D', 'E']
+
+        def geocode_by_index(user_city):
+            return FakeLocation(user_city, lat=user_cities.index(user_city))
+
+        with patch('ClimaGraph.geocode', side_effect=geocode_by_index), \
+                patch_api(self.fake_api) as mock_api:
+            cities_dict, failures = fetch_cities(
+                ARCHIVE_URL, ARCHIVE_VARIABLES, user_cities,
+                '2000-01-01', '2000-01-03', batch_size=2
+            )
+
+        self.assertEqual(mock_api.call_count, 3)
+        self.assertEqual(failures, {})
+        self.assertEqual(
+            sorted(call.kwargs['params']['latitude']
+                   for call in mock_api.call_args_list),
+            ['0,1', '2,3', '4'])
+        # Each response is fanned back out to the city it belongs to
+        for n, (city, dataframe) in enumerate(cities_dict.items()):
+            self.assertEqual(city, f'{user_cities[n]} (User entered: '
+                                   f'{user_cities[n]})')
+            self.assertEqual(dataframe['temperature_2m_max'][0], n)
+
+    @patch('builtins.print')
+    @patch('builtins.input', side_effect=['2', 'Atlantis', 'Paris', 'Oslo'])
+    def test_prompt_and_fetch_reprompts_unrecognized_city(
+            self, mock_input, mock_print):
+        with patch('ClimaGraph.geocode', side_effect=self.fake_geocode), \
+                patch_api(self.fake_api):
+            cities_dict = weather_archive('2000-01-01', '2000-01-03')
+
+        self.assertEqual(list(cities_dict), [
+            'Oslo City (User entered: Oslo)',
+            'Paris City (User entered: Paris)',
+        ])
+        self.assertEqual(len(cities_dict['Oslo City (User entered: Oslo)']), 3)
+
+    @patch('builtins.print')
+    @patch('builtins.input', side_effect=['1', 'Oslo'])
+    def test_prompt_and_fetch_reports_other_errors_as_they_are(
+            self, mock_input, mock_print):
+        with patch('ClimaGraph.geocode', side_effect=self.fake_geocode), \
+                patch_api(lambda url, params: []):
+            cities_dict = weather_archive('2000-01-01', '2000-01-03')
+
+        self.assertEqual(len(cities_dict), 0)
+        mock_print.assert_any_call(
+            'Error: Could not fetch Oslo: '
+            'No response from server for this batch')
+        self.assertNotIn(
+            'City name not recognized', str(mock_print.call_args_list))
+
+    @patch('builtins.print')
+    @patch('builtins.input',
+           side_effect=['1', '2000-01-01', '2000-01-03', '3'])
+    def test_main_returns_to_the_menu_when_no_city_was_fetched(
+            self, mock_input, mock_print):
+        with patch('ClimaGraph.weather_archive',
+                   return_value=CitySeries([], [], [])), \
+                self.assertRaises(SystemExit) as exited:
+            main()
+        mock_print.assert_called_with(
+            "Error: No data could be fetched for any city.")
+        # The session ended on the exit choice of the menu
+        self.assertEqual(mock_input.call_count, 4)
+        self.assertIsNone(exited.exception.code)
+
+    @patch('builtins.print')
+    def test_prompt_and_fetch_only_requests_missing_days(self, mock_print):
+        with patch('ClimaGraph.geocode', side_effect=self.fake_geocode), \
+                patch_api(self.fake_api) as mock_api:
+            with patch('builtins.input', side_effect=['1', 'Oslo']):
+                weather_archive('2000-01-01', '2000-01-03')
+            with patch('builtins.input', side_effect=['1', 'Oslo']):
+                cities_dict = weather_archive('1999-12-30', '2000-01-05')
+            with patch('builtins.input', side_effect=['1', 'Oslo']):
+                weather_archive('2000-01-02', '2000-01-04')
+
+        ranges = [
+            (call.kwargs['params']['start_date'],
+             call.kwargs['params']['end_date'])
+            for call in mock_api.call_args_list
+        ]
+        self.assertEqual(ranges, [
+            ('2000-01-01', '2000-01-03'),
+            ('1999-12-30', '1999-12-31'),
+            ('2000-01-04', '2000-01-05'),
+        ])
+        dataframe = cities_dict['Oslo City (User entered: Oslo)']
+        self.assertEqual(len(dataframe), 7)
+        self.assertEqual(
+            list(dataframe['date'].dt.strftime('%Y-%m-%d')),
+            ['1999-12-30', '1999-12-31', '2000-01-01', '2000-01-02',
+             '2000-01-03', '2000-01-04', '2000-01-05'])
+
+    def test_legacy_tables_are_migrated_to_observations(self):
+        conn = sqlite3.connect(self.db_path)
+        pd.DataFrame({
+            'date': pd.date_range(
+                '2000-01-01 05:00', periods=3, freq='D', tz='UTC'),
+            'temperature_2m_max': [1.0, 2.0, 3.0],
+        }).to_sql('Oslo_City_Oslo', conn, index=False)
+        conn.commit()
+        conn.close()
+
+        conn = connect_database(self.db_path)
+        self.addCleanup(conn.close)
+        c = conn.cursor()
+        tables = {row[0] for row in c.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")}
+        self.assertEqual(tables, SCHEMA_TABLES)
+
+        # The fetched city key finds the location migrated from its table
+        location_id = find_location(c, 'Oslo City (User entered: Oslo)')
+        self.assertEqual(
+            read_observations(c, location_id, ['temperature_2m_max'],
+                              '2000-01-01', '2000-01-03')
+            ['temperature_2m_max'].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(
+            missing_ranges(c, location_id, ['temperature_2m_max'],
+                           '2000-01-01', '2000-01-04'),
+            [('2000-01-04', '2000-01-04')])
+
+    def test_only_legacy_city_tables_are_migrated_once(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE trips (date TEXT, destination TEXT)")
+        conn.execute('CREATE TABLE "my readings" '
+                     '(date TEXT, temperature_2m_max REAL)')
+        conn.commit()
+        conn.close()
+        connect_database(self.db_path).close()
+
+        # Later city-like tables are left alone too
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE Oslo (date TEXT, temperature_2m_max REAL)")
+        conn.commit()
+        conn.close()
+
+        conn = connect_database(self.db_path)
+        self.addCleanup(conn.close)
+        tables = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")}
+        self.assertEqual(
+            tables, SCHEMA_TABLES | {'trips', 'my readings', 'Oslo'})
+        self.assertEqual(
+            conn.execute("PRAGMA user_version").fetchone()[0],
+            SCHEMA_VERSION)
+
+    def test_split_range_by_year(self):
+        self.assertEqual(split_range('1998-06-15', '2000-02-01'), [
+            ('1998-06-15', '1998-12-31'),
+            ('1999-01-01', '1999-12-31'),
+            ('2000-01-01', '2000-02-01'),
+        ])
+        self.assertEqual(split_range('2000-01-01', '2000-01-01'),
+                         [('2000-01-01', '2000-01-01')])
+        self.assertEqual(split_range('1998-06-15', '2000-02-01', None),
+                         [('1998-06-15', '2000-02-01')])
+
+    @patch('ClimaGraph.time.sleep')
+    def test_chunks_are_retried_and_streamed_to_store(self, mock_sleep):
+        calls = []
+
+        def flaky_api(url, params, method='GET'):
+            calls.append(params['start_date'])
+            if params['start_date'] == '1999-01-01' and \
+                    calls.count('1999-01-01') == 1:
+                raise ConnectionError('connection reset')
+            if params['start_date'] == '2000-01-01':
+                raise ConnectionError('still down')
+            return self.fake_api(url, params)
+
+        stored = []
+        with patch('ClimaGraph.geocode', side_effect=self.fake_geocode), \
+                patch_api(flaky_api):
+            outcomes = fetch_outcomes(
+                ARCHIVE_URL, ARCHIVE_VARIABLES, ['Oslo'],
+                '1998-12-30', '2000-01-02', max_workers=1,
+                store=lambda cities_dict: stored.append(cities_dict)
+            )
+
+        # Each finished chunk is stored on its own
+        self.assertEqual(
+            sorted(len(cities_dict['Oslo City (User entered: Oslo)'])
+                   for cities_dict in stored), [2, 365])
+        self.assertEqual(calls.count('1999-01-01'), 2)
+        self.assertEqual(calls.count('2000-01-01'), 1 + CHUNK_RETRIES)
+        # Only the chunk that kept failing is lost
+        self.assertIsInstance(outcomes[0], ConnectionError)
+        mock_sleep.assert_called()
+
+
+class TestExport(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': pd.date_range('2000-01-01', periods=5),
+            'temperature_2m_max': [1.0, 2.0, None, 4.0, 5.0],
+        })})
+        self.conn = connect_database()
+        self.addCleanup(self.conn.close)
+
+    def query(self, start_date='2000-01-01'):
+        return self.conn.execute(
+            '''SELECT date, temperature_2m_max FROM observations
+               WHERE date >= ? ORDER BY date''', (start_date,))
+
+    def test_export_csv_streams_batches(self):
+        filename = os.path.join(self.tmpdir, 'oslo.csv')
+        cursor = MagicMock(wraps=self.query())
+        cursor.description = cursor._mock_wraps.description
+        row_count = export_results(cursor, filename, batch_rows=2)
+
+        self.assertEqual(row_count, 5)
+        self.assertEqual(cursor.fetchmany.call_count, 4)
+        cursor.fetchmany.assert_called_with(2)
+        cursor.fetchall.assert_not_called()
+        with open(filename) as file:
+            self.assertEqual(file.read().splitlines(), [
+                'date,temperature_2m_max', '2000-01-01,1.0',
+                '2000-01-02,2.0', '2000-01-03,', '2000-01-04,4.0',
+                '2000-01-05,5.0'])
+
+    def test_export_without_rows_creates_no_file(self):
+        filename = os.path.join(self.tmpdir, 'empty.csv')
+        self.assertEqual(export_results(self.query('2001-01-01'), filename), 0)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_failed_csv_export_removes_the_file(self):
+        filename = os.path.join(self.tmpdir, 'broken.csv')
+
+        def batches():
+            yield [('2000-01-01', 1.0)]
+            raise sqlite3.OperationalError('database is locked')
+
+        with self.assertRaises(sqlite3.OperationalError):
+            export_csv(batches(), ['date', 'temperature_2m_max'], filename)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_export_columnar_formats(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+
+        parquet_file = os.path.join(self.tmpdir, 'oslo.parquet')
+        arrow_file = os.path.join(self.tmpdir, 'oslo.arrow')
+        self.assertEqual(export_results(
+            self.query(), parquet_file, 'parquet', batch_rows=2), 5)
+        self.assertEqual(export_results(
+            self.query(), arrow_file, 'arrow', batch_rows=2), 5)
+
+        parquet_table = pq.read_table(parquet_file)
+        with pa.ipc.open_file(arrow_file) as reader:
+            self.assertEqual(reader.num_record_batches, 3)
+            arrow_table = reader.read_all()
+        for table in [parquet_table, arrow_table]:
+            self.assertEqual(table.schema.field('date').type, pa.date32())
+            self.assertEqual(
+                table.column('temperature_2m_max').to_pylist(),
+                [1.0, 2.0, None, 4.0, 5.0])
+
+
+class TestColumnarBackend(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backend = ColumnarBackend(os.path.join(self.tmpdir, 'columns'))
+        ClimaGraph.storage_backends['columnar'] = self.backend
+
+    def write(self, start, values):
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': pd.date_range(start, periods=len(values), tz='UTC'),
+            'temperature_2m_max': values,
+            'precipitation_sum': [v / 10 for v in values],
+        })}, backend='columnar')
+
+    def test_round_trip_across_years(self):
+        self.write('1999-12-30', [1.0, 2.0, 3.0, 4.0])
+        conn = connect_database()
+        self.addCleanup(conn.close)
+        c = conn.cursor()
+        location_id = find_location(c, 'Oslo')
+
+        dataframe = read_observations(
+            c, location_id, ['temperature_2m_max', 'precipitation_sum'],
+            '1999-12-01', '2000-01-31', backend='columnar')
+        self.assertEqual(
+            list(dataframe['date'].dt.strftime('%Y-%m-%d')),
+            ['1999-12-30', '1999-12-31', '2000-01-01', '2000-01-02'])
+        self.assertEqual(dataframe['temperature_2m_max'].tolist(),
+                         [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(dataframe['precipitation_sum'].dtype, np.float32)
+
+        # One partition file per year and variable, a float32 per day
+        path = self.backend.partition_path(
+            location_id, 2000, 'temperature_2m_max')
+        self.assertEqual(os.path.getsize(path), 366 * 4)
+
+    def test_append_leaves_older_partitions_alone(self):
+        self.write('1999-12-30', [1.0, 2.0])
+        conn = connect_database()
+        self.addCleanup(conn.close)
+        location_id = find_location(conn.cursor(), 'Oslo')
+        old_path = self.backend.partition_path(
+            location_id, 1999, 'temperature_2m_max')
+        os.utime(old_path, (0, 0))
+
+        self.write('2000-01-01', [3.0, 4.0])
+
+        self.assertEqual(os.stat(old_path).st_mtime, 0)
+        arrays = self.backend.read_arrays(
+            location_id, ['temperature_2m_max'], '2000-01-01', '2000-01-03')
+        # A range within one year is a view of the mapped file
+        self.assertIsInstance(arrays['temperature_2m_max'], np.memmap)
+        np.testing.assert_array_equal(
+            arrays['temperature_2m_max'], [3.0, 4.0, np.nan])
+
+    @patch('builtins.input', side_effect=['Oslo', '1999-12-31', '2000-01-01'])
+    @patch('builtins.print')
+    def test_query_database_exports_from_columns(self, mock_print,
+                                                 mock_input):
+        self.write('1999-12-30', [1.0, 2.0, 3.0])
+        self.work_in_tmpdir()
+
+        query_database(backend='columnar')
+
+        with open('Oslo_weather_data_1999-12-31_to_2000-01-01.csv') as file:
+            self.assertEqual(file.read().splitlines(), [
+                'date,temperature_2m_max,precipitation_sum',
+                '1999-12-31,2.0,0.20000000298023224',
+                '2000-01-01,3.0,0.30000001192092896',
+            ])
+
+
+class TestDownsample(unittest.TestCase):
+
+    def test_minmax_downsample_keeps_extremes(self):
+        rng = np.random.default_rng(0)
+        values = rng.normal(size=30000)
+        values[12345] = 50.0
+        values[23456] = -50.0
+        values[100] = np.nan
+
+        keep = minmax_downsample(values, 1000)
+
+        self.assertLessEqual(len(keep), 4000)
+        self.assertTrue(np.all(np.diff(keep) > 0))
+        self.assertIn(12345, keep)
+        self.assertIn(23456, keep)
+        self.assertEqual((keep[0], keep[-1]), (0, 29999))
+        # Every bucket still spans the same range of values
+        for bucket in range(0, 30000, 30):
+            kept = values[keep[(keep >= bucket) & (keep < bucket + 30)]]
+            self.assertEqual(np.nanmax(kept),
+                             np.nanmax(values[bucket:bucket + 30]))
+            self.assertEqual(np.nanmin(kept),
+                             np.nanmin(values[bucket:bucket + 30]))
+
+    def test_short_series_are_left_alone(self):
+        np.testing.assert_array_equal(
+            minmax_downsample(np.arange(10.0), 1000), np.arange(10))
+
+    def test_draw_graph_plots_within_budget(self):
+        cities_dict = {
+            city: pd.DataFrame({
+                'date': pd.date_range('1940-01-01', periods=30000),
+                'temperature_2m_max': np.sin(np.arange(30000) / 50.0),
+            })
+            for city in ['Oslo', 'Lima']
+        }
+        figure = Figure(figsize=(12, 6))
+
+        draw_graph(figure, cities_dict, 'temperature_2m_max')
+
+        budget = point_budget(figure)
+        lines = figure.axes[0].get_lines()
+        self.assertEqual(len(lines), 2)
+        for line in lines:
+            self.assertLessEqual(len(line.get_xdata()), 4 * budget)
+
+
+class TestRenderGraphs(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.work_in_tmpdir()
+        self.cities_dict = {
+            city: pd.DataFrame({
+                'date': pd.date_range('2000-01-01', periods=50),
+                'temperature_2m_max': np.arange(50.0) + offset,
+                'precipitation_sum': np.arange(50.0) * offset,
+            })
+            for offset, city in enumerate(['Oslo', 'Lima'])
+        }
+
+    @patch('builtins.print')
+    def test_create_graph_leaves_no_pyplot_figures(self, mock_print):
+        figures = plt.get_fignums()
+        create_graph(self.cities_dict, 'temperature_2m_max')
+
+        self.assertEqual(plt.get_fignums(), figures)
+        self.assertTrue(os.path.exists('temperature_2m_max_plot.png'))
+        mock_print.assert_called_with("Graph has been saved")
+
+    def test_render_all_combinations_in_process_pool(self):
+        city_groups = {
+            'Both cities': self.cities_dict,
+            'Oslo': {'Oslo': self.cities_dict['Oslo']},
+        }
+        results = render_all(
+            city_groups, ['temperature_2m_max', 'precipitation_sum'],
+            max_workers=2)
+
+        self.assertEqual([filename for filename, _ in results], [
+            'temperature_2m_max_Both_cities_plot.png',
+            'precipitation_sum_Both_cities_plot.png',
+            'temperature_2m_max_Oslo_plot.png',
+            'precipitation_sum_Oslo_plot.png',
+        ])
+        for filename, glyph_missing in results:
+            self.assertFalse(glyph_missing)
+            self.assertEqual(plt.imread(filename).shape[:2], (600, 1200))
+
+
+class TestGeocodeCache(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmpdir, 'geocode.db')
+        patcher = patch('ClimaGraph.geocode_cache', GeocodeCache(self.path))
+        self.cache = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache.close)
+
+    @patch('ClimaGraph.geocode')
+    def test_bulk_geocode_only_sends_misses_once(self, mock_geocode):
+        mock_geocode.side_effect = lambda city: (
+            None if city == 'Atlantis' else FakeLocation(f'{city} City'))
+        self.cache.put('Paris', FakeLocation('Paris, France', 48.8, 2.3))
+
+        locations = bulk_geocode(
+            ['Paris', 'Oslo', ' oslo ', 'Atlantis', 'PARIS'])
+
+        self.assertEqual(mock_geocode.call_count, 2)
+        self.assertEqual(locations[0].raw['display_name'], 'Paris, France')
+        self.assertIs(locations[1], locations[2])
+        self.assertIsInstance(locations[3], ValueError)
+        self.assertEqual(locations[4].raw['lat'], 48.8)
+
+    @patch('ClimaGraph.geocode')
+    def test_cache_persists_across_instances(self, mock_geocode):
+        mock_geocode.return_value = FakeLocation('Oslo, Norway', 59.9, 10.7)
+        geocode_city('Oslo')
+
+        reopened = GeocodeCache(self.path)
+        self.addCleanup(reopened.close)
+        location = reopened.get('  OSLO')
+        self.assertEqual(location.raw['display_name'], 'Oslo, Norway')
+        self.assertEqual((location.latitude, location.longitude),
+                         (59.9, 10.7))
+
+    @patch('ClimaGraph.geocode')
+    def test_preload_gazetteer(self, mock_geocode):
+        gazetteer = os.path.join(self.tmpdir, 'cities.csv')
+        with open(gazetteer, 'w', newline='') as file:
+            file.write('name,lat,lon,display_name\n'
+                       'Lima,-12.05,-77.04,"Lima, Peru"\n'
+                       'Quito,-0.22,-78.51,\n')
+
+        self.assertEqual(preload_gazetteer(gazetteer), 2)
+        lima, quito = bulk_geocode(['lima', 'Quito'])
+
+        mock_geocode.assert_not_called()
+        self.assertEqual(lima.raw['display_name'], 'Lima, Peru')
+        self.assertEqual(quito.raw['display_name'], 'Quito')
+
+    def test_worker_threads_share_one_cache(self):
+        ClimaGraph.geocode_cache = None
+        with patch('ClimaGraph.GEOCODE_CACHE_FILE', self.path):
+            with ThreadPoolExecutor(max_workers=8) as pool:
+                caches = list(pool.map(
+                    lambda _: get_geocode_cache(), range(16)))
+        self.addCleanup(caches[0].close)
+
+        self.assertTrue(all(cache is caches[0] for cache in caches))
+
+
+class TestBatchJobs(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_all([
+            patch('ClimaGraph.geocode', side_effect=fake_geocode),
+            patch('ClimaGraph.openmeteo',
+                  MagicMock(**{'weather_api.side_effect': fake_api})),
+        ])
+
+    @patch('builtins.input', side_effect=AssertionError('prompted'))
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_run_batch_runs_every_job_without_prompting(
+            self, mock_stdout, mock_input):
+        output_dir = os.path.join(self.tmpdir, 'out')
+        job_file = os.path.join(self.tmpdir, 'jobs.json')
+        with open(job_file, 'w') as file:
+            json.dump({'jobs': [
+                {
+                    'name': 'nordic',
+                    'cities': ['Oslo', 'Atlantis', 'Bergen'],
+                    'start_date': '2000-01-01',
+                    'end_date': '2000-01-10',
+                    'variables': ['temperature_2m_max', 'precipitation_sum'],
+                    'exports': ['csv'],
+                    'graphs': ['temperature_2m_max'],
+                    'output_dir': output_dir,
+                },
+                {
+                    'name': 'backwards',
+                    'cities': ['Oslo'],
+                    'start_date': '2001-01-01',
+                    'end_date': '2000-01-01',
+                },
+            ]}, file)
+
+        nordic, backwards = run_batch(job_file)
+
+        self.assertEqual(nordic['status'], 'partial')
+        self.assertEqual(nordic['cities'], 2)
+        self.assertEqual(nordic['rows'], 20)
+        self.assertEqual(list(nordic['failures']), ['Atlantis'])
+        self.assertEqual(sorted(os.listdir(output_dir)), [
+            'Bergen_weather_data_2000-01-01_to_2000-01-10.csv',
+            'Oslo_weather_data_2000-01-01_to_2000-01-10.csv',
+            'temperature_2m_max_nordic_plot.png',
+        ])
+        self.assertEqual(backwards['status'], 'failed')
+        self.assertIn('start date is before the end date',
+                      backwards['error'])
+
+        output = mock_stdout.getvalue()
+        self.assertIn('nordic: partial - 2 cities, 20 rows, 2 exports, '
+                      '1 graphs', output)
+        self.assertIn('  Could not fetch Atlantis: City name not recognized',
+                      output)
+        self.assertIn('backwards: failed', output)
+
+
+class TestCommandLine(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_all([
+            patch('ClimaGraph.geocode', side_effect=fake_geocode),
+            patch('ClimaGraph.openmeteo',
+                  MagicMock(**{'weather_api.side_effect': fake_api})),
+        ])
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_fetch_then_export(self, mock_stdout):
+        status = run_cli(['fetch', 'Oslo', 'Atlantis', '--start', '2000-01-01',
+                          '--end', '2000-01-03', '--variables',
+                          'temperature_2m_max'])
+        self.assertEqual(status, 1)
+        self.assertIn('(User entered: Oslo): 3 days stored',
+                      mock_stdout.getvalue())
+        self.assertIn('Could not fetch Atlantis', mock_stdout.getvalue())
+
+        status = run_cli(['export', 'Oslo', '--start', '2000-01-01',
+                          '--end', '2000-01-03', '--output-dir', self.tmpdir])
+        self.assertEqual(status, 0)
+        with open(os.path.join(
+                self.tmpdir,
+                'Oslo_weather_data_2000-01-01_to_2000-01-03.csv')) as file:
+            self.assertEqual(len(file.read().splitlines()), 4)
+
+        self.assertEqual(run_cli(['export', 'Atlantis']), 1)
+
+    def test_query_does_not_load_heavy_modules(self):
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': ['2000-01-01', '2000-01-02'],
+            'temperature_2m_max': [1.5, 2.5],
+        })})
+        here = os.path.dirname(os.path.abspath(__file__))
+        probe = (
+            "import sys\n"
+            f"sys.path.insert(0, {here!r})\n"
+            "import ClimaGraph\n"
+            "status = ClimaGraph.run_cli(['query', 'Oslo'])\n"
+            "heavy = ['pandas.core.frame', 'numpy.linalg', 'matplotlib',\n"
+            "         'geopy', 'openmeteo_requests', 'requests_cache']\n"
+            "print([name for name in heavy if name in sys.modules])\n"
+        )
+        result = subprocess.run([sys.executable, '-c', probe], cwd=self.tmpdir,
+                                capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.splitlines(), [
+            'date,temperature_2m_max',
+            '2000-01-01,1.5',
+            '2000-01-02,2.5',
+            '[]',
+        ])
+
+
+class TestHTTPCache(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = HTTPCache(os.path.join(self.tmpdir, 'http'),
+                               max_bytes=250)
+        self.addCleanup(self.cache.close)
+        self.adapter = FakeAdapter(size=100)
+        self.cache.session.mount('https://', self.adapter)
+
+    def get(self, name):
+        return self.cache.session.get(
+            f'https://example.test/{name}', expire_after=NEVER_EXPIRE)
+
+    def test_cache_expiry_per_endpoint_and_dates(self):
+        old = {'start_date': '2000-01-01', 'end_date': '2000-12-31'}
+        today = {'start_date': '2000-01-01',
+                 'end_date': date.today().isoformat()}
+        self.assertEqual(cache_expiry(ARCHIVE_URL, old), NEVER_EXPIRE)
+        self.assertEqual(cache_expiry(ARCHIVE_URL, today), 3600)
+        self.assertEqual(cache_expiry(FORECAST_URL, old), 24 * 3600)
+        self.assertEqual(cache_expiry(FORECAST_URL, today), 15 * 60)
+        self.assertEqual(cache_expiry('https://example.test', old), 3600)
+
+        final = self.cache.session.get(ARCHIVE_URL, params=old)
+        recent = self.cache.session.get(ARCHIVE_URL, params=today)
+        self.assertIsNone(final.expires)
+        self.assertAlmostEqual(
+            (recent.expires - recent.created_at).total_seconds(), 3600,
+            delta=5)
+
+    def test_weather_api_called_with_the_pinned_signature(self):
+        # openmeteo_requests 1.2.0: weather_api(url, params, method='GET')
+        params = {'start_date': '2000-01-01', 'end_date': '2000-01-02'}
+        with patch_api(lambda url, params, method='GET': []) as weather_api:
+            call_weather_api(ARCHIVE_URL, params)
+        weather_api.assert_called_once_with(ARCHIVE_URL, params=params)
+
+    def test_counts_hits_misses_and_bytes(self):
+        self.assertFalse(self.get('a').from_cache)
+        self.assertTrue(self.get('a').from_cache)
+        self.assertEqual(len(self.adapter.sent), 1)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['bytes_fetched'], 100)
+        self.assertEqual(stats['bytes_from_cache'], 100)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_evicts_least_recently_used_above_max_bytes(self):
+        self.get('a')
+        self.get('b')
+        self.get('a')  # b is now the least recently used
+        self.get('c')
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['bytes'], 200)
+        self.assertTrue(self.get('a').from_cache)
+        self.assertTrue(self.get('c').from_cache)
+        self.assertFalse(self.get('b').from_cache)
+
+    def test_usage_survives_reopening(self):
+        self.get('a')
+        path = self.cache.session.cache.responses.db_path
+        self.cache.close()
+
+        self.cache = HTTPCache(str(path)[:-len('.sqlite')], max_bytes=250)
+        self.cache.session.mount('https://', self.adapter)
+        self.assertTrue(self.get('a').from_cache)
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+
+class TestRollups(TempDirTestCase):
+
+    def store(self, start, end, values=None):
+        dates = pd.date_range(start, end)
+        if values is None:
+            values = np.arange(len(dates), dtype='float64')
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': dates.strftime('%Y-%m-%d'),
+            'temperature_2m_max': values,
+        })})
+
+    def rollups(self, period, start=None, end=None):
+        conn = connect_database()
+        col_names, rows = query_rollups(
+            conn.cursor(), 1, 'temperature_2m_max', period, start, end)
+        conn.close()
+        return [dict(zip(col_names, row)) for row in rows]
+
+    def test_summarize_periods_matches_pandas(self):
+        keys = np.array(['2000-01'] * 4 + ['2000-02'] * 3 + ['2000-03'])
+        values = np.array([1, 2, np.nan, 5, 10, 20, 30, np.nan])
+        periods, stats = summarize_periods(keys, values)
+
+        expected = pd.Series(values).groupby(keys)
+        self.assertEqual(periods.tolist(), ['2000-01', '2000-02'])
+        np.testing.assert_allclose(stats['mean'], expected.mean()[:2])
+        np.testing.assert_allclose(stats['p50'], expected.median()[:2])
+        np.testing.assert_allclose(stats['p10'], [
+            np.nanpercentile(values[:4], 10), np.nanpercentile(values[4:7], 10)
+        ])
+        np.testing.assert_allclose(stats['p90'], [
+            np.nanpercentile(values[:4], 90), np.nanpercentile(values[4:7], 90)
+        ])
+        self.assertEqual(stats['days'].tolist(), [3, 3])
+        self.assertEqual(stats['max'].tolist(), [5, 30])
+        self.assertEqual(stats['sum'].tolist(), [8, 60])
+
+    def test_rollups_are_updated_incrementally(self):
+        self.store('2000-01-01', '2000-01-10')
+        january, = self.rollups('month')
+        self.assertEqual(january['days'], 10)
+        self.assertEqual(january['mean'], 4.5)
+
+        self.store('2000-01-11', '2000-02-29', np.full(50, 100.0))
+        january, february = self.rollups('month')
+        self.assertEqual(january['days'], 31)
+        self.assertEqual(january['max'], 100)
+        self.assertEqual(february['days'], 29)
+        self.assertEqual(february['p90'], 100)
+
+        year, = self.rollups('year')
+        self.assertEqual(year['period_start'], '2000')
+        self.assertEqual(year['days'], 60)
+        self.assertEqual(year['min'], 0)
+
+    @patch('ClimaGraph.BASELINE_START', 2000)
+    @patch('ClimaGraph.BASELINE_END', 2001)
+    def test_anomalies_against_baseline(self):
+        self.store('2000-01-01', '2000-12-31', np.full(366, 10.0))
+        self.store('2001-01-01', '2001-12-31', np.full(365, 20.0))
+        self.store('2002-01-01', '2002-12-31', np.full(365, 18.0))
+
+        years = self.rollups('year')
+        self.assertEqual([year['anomaly'] for year in years], [-5, 5, 3])
+        march, = self.rollups('month', '2002-03', '2002-03')
+        self.assertEqual(march['anomaly'], 3)
+
+    def test_query_rolls_up_older_databases(self):
+        self.store('2000-01-01', '2000-03-31')
+        conn = connect_database()
+        conn.execute("DELETE FROM rollups")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(len(self.rollups('month')), 3)
+        self.assertEqual(len(self.rollups('month', '2000-02')), 2)
+
+
+class TestBulkIngest(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_all([patch('ClimaGraph.geocode', side_effect=fake_geocode)])
+
+    def test_response_columns_are_not_copied(self):
+        values = np.frombuffer(
+            np.arange(3, dtype=np.float32).tobytes(), dtype=np.float32)
+        dataframe = response_to_dataframe(
+            FakeResponse('2000-01-01', [values]), ['temperature_2m_max'])
+        self.assertTrue(np.shares_memory(
+            dataframe['temperature_2m_max'].to_numpy(), values))
+
+    def test_day_strings(self):
+        stamps = pd.Series(pd.to_datetime(
+            ['1940-01-01', '1969-12-31', '2020-02-29'], utc=True))
+        expected = ['1940-01-01', '1969-12-31', '2020-02-29']
+        self.assertEqual(day_strings(stamps).tolist(), expected)
+        self.assertEqual(
+            day_strings(pd.Series(expected)).tolist(), expected)
+
+    def test_missing_values_are_stored_as_null(self):
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': ['2000-01-01', '2000-01-02'],
+            'temperature_2m_max': np.array([1.5, np.nan], np.float32),
+        })})
+        conn = sqlite3.connect(self.db_path)
+        self.addCleanup(conn.close)
+        self.assertEqual(conn.execute(
+            "SELECT date, temperature_2m_max FROM observations ORDER BY date"
+        ).fetchall(), [('2000-01-01', 1.5), ('2000-01-02', None)])
+
+    def test_update_streams_chunks_through_one_connection(self):
+        with patch('ClimaGraph.connect_database',
+                   wraps=connect_database) as mock_connect, \
+                patch_api(fake_api) as mock_api:
+            cities_dict, failures = update_cities(
+                ARCHIVE_URL, ['temperature_2m_max'], ['Oslo', 'Bergen'],
+                '1998-06-01', '2000-06-30')
+
+        # Three yearly chunks, each one request for both cities
+        self.assertEqual(mock_api.call_count, 3)
+        self.assertEqual(mock_connect.call_count, 1)
+        self.assertEqual(failures, {})
+        self.assertEqual(
+            [len(dataframe) for dataframe in cities_dict.values()],
+            [761, 761])
+
+    def test_connections_use_bulk_pragmas(self):
+        conn = connect_database()
+        self.addCleanup(conn.close)
+        self.assertEqual(
+            conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.assertEqual(
+            conn.execute("PRAGMA temp_store").fetchone()[0], 2)
+
+
+class TestStandIn(TempDirTestCase):
+
+    def test_weather_message_decodes_with_the_sdk(self):
+        variables = ['temperature_2m_max', 'precipitation_sum']
+        message = weather_message(59.9, 10.7, '2000-01-01', 31, variables)
+        self.assertEqual(int.from_bytes(message[:4], 'little'),
+                         len(message) - 4)
+
+        response = WeatherApiResponse.GetRootAs(message, 4)
+        self.assertAlmostEqual(response.Latitude(), 59.9, places=4)
+        dataframe = response_to_dataframe(response, variables)
+        self.assertEqual(len(dataframe), 31)
+        self.assertEqual(dataframe['date'].iloc[-1],
+                         pd.Timestamp('2000-01-31', tz='UTC'))
+        np.testing.assert_array_equal(
+            dataframe['precipitation_sum'],
+            synthetic_values('precipitation_sum', 59.9, 10.7,
+                             '2000-01-01', 31))
+        self.assertTrue((dataframe['precipitation_sum'] >= 0).all())
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_update_waits_out_the_rate_limit(self, mock_stdout):
+        server = StandInServer(rate_limit=1, rate_window=0.2)
+        with server, use_stand_in(server, self.tmpdir):
+            cities_dict, failures = update_cities(
+                ClimaGraph.ARCHIVE_URL, ['temperature_2m_max'],
+                ['Oslo', 'Atlantis'], '1999-12-01', '2000-01-31')
+
+        self.assertEqual(list(failures), ['Atlantis'])
+        dataframe, = cities_dict.values()
+        self.assertEqual(len(dataframe), 62)
+        self.assertEqual(server.counts['weather'], 2)
+        self.assertGreaterEqual(server.counts['limited'], 1)
+        self.assertIn('API limit exceeded', mock_stdout.getvalue())
+
+        # Settings are put back afterwards
+        self.assertEqual(ClimaGraph.DATABASE_FILE, self.db_path)
+        self.assertIsNone(ClimaGraph.openmeteo)
+
+
+class TestMetrics(TempDirTestCase):
+
+    def test_timer_counts_failed_calls_and_merges(self):
+        recorder = Metrics()
+        with recorder.timer('write'):
+            pass
+        with self.assertRaises(ValueError):
+            with recorder.timer('write'):
+                raise ValueError
+        recorder.count('api_calls', 2)
+
+        other = Metrics()
+        other.merge(recorder.snapshot())
+        other.gauge('memory_peak_bytes', 10)
+        snapshot = other.snapshot()
+        self.assertEqual(snapshot['stages']['write']['calls'], 2)
+        self.assertEqual(snapshot['counters'], {'api_calls': 2})
+        self.assertEqual(snapshot['gauges'], {'memory_peak_bytes': 10})
+
+    def test_prometheus_declares_each_family_once(self):
+        snapshot = {
+            'stages': {'api_call': {
+                'calls': 3, 'seconds': 1.5, 'max_seconds': 0.75}},
+            'counters': {'api_calls': 3},
+            'gauges': {},
+        }
+        text = format_metrics([({'job': 'a "b"\n'}, snapshot),
+                               ({'job': 'c'}, snapshot)], 'prometheus')
+
+        lines = text.splitlines()
+        self.assertEqual(
+            lines.count('# TYPE climagraph_api_calls_total counter'), 1)
+        self.assertIn('climagraph_stage_seconds_total'
+                      '{job="a \\"b\\"\\n",stage="api_call"} 1.5', lines)
+        self.assertIn('climagraph_api_calls_total{job="c"} 3', lines)
+        with self.assertRaises(ValueError):
+            format_metrics([], 'xml')
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_cli_writes_metrics_of_its_own_command(self, mock_stdout):
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': ['2000-01-01', '2000-01-02'],
+            'temperature_2m_max': [1.5, 2.5],
+        })})
+        ClimaGraph.metrics.count('api_calls')
+        metrics_file = os.path.join(self.tmpdir, 'metrics.json')
+        status = run_cli(['--metrics', 'json', '--metrics-file', metrics_file,
+                          '--trace-memory', 'export', 'Oslo',
+                          '--output-dir', self.tmpdir])
+
+        self.assertEqual(status, 0)
+        with open(metrics_file) as file:
+            run, = json.load(file)
+        self.assertEqual(run['command'], 'export')
+        self.assertEqual(run['counters']['rows_exported'], 2)
+        self.assertGreater(run['counters']['bytes_exported'], 0)
+        self.assertNotIn('api_calls', run['counters'])
+        self.assertIn('export', run['stages'])
+        self.assertGreater(run['gauges']['memory_peak_bytes'], 0)
+
+    def test_profiling_saves_cpu_profile(self):
+        profile = os.path.join(self.tmpdir, 'run.prof')
+        with profiling(profile):
+            sum(range(1000))
+        self.assertTrue(os.path.getsize(profile) > 0)
+
+
+class TestService(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_to_file({'Oslo, Norway': pd.DataFrame({
+            'date': ['2000-01-01', '2000-01-02', '2000-01-03'],
+            'temperature_2m_max': [1.5, np.nan, 2.5],
+        })})
+        self.app = create_app(pool_size=2)
+        self.addCleanup(self.app.extensions['climagraph']['pool'].close)
+        self.client = self.app.test_client()
+
+    def test_series_as_json_and_csv(self):
+        response = self.client.get(
+            '/locations/Oslo/series?start=2000-01-02&end=2000-01-03')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {
+            'location': 'Oslo, Norway',
+            'columns': ['date', 'temperature_2m_max'],
+            'rows': [['2000-01-02', None], ['2000-01-03', 2.5]],
+        })
+
+        response = self.client.get('/locations/Oslo/series?format=csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.get_data(as_text=True).splitlines(), [
+            'date,temperature_2m_max', '2000-01-01,1.5', '2000-01-02,',
+            '2000-01-03,2.5'])
+
+    def test_head_requests_return_their_connection(self):
+        # HEAD responses are closed without their body being read, and a
+        # request waiting on an exhausted pool would block forever
+        def head_then_get():
+            for _ in range(3):
+                self.client.head('/locations/Oslo/series').close()
+            return self.client.get('/locations/Oslo/series')
+
+        responses = []
+        thread = threading.Thread(
+            target=lambda: responses.append(head_then_get()), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(responses[0].get_json()['rows']), 3)
+
+    def test_errors_are_json(self):
+        response = self.client.get('/locations/Bergen/series')
+        self.assertEqual(response.status_code, 404)
+        self.assertIn('Bergen', response.get_json()['error'])
+        self.assertEqual(self.client.get(
+            '/locations/Oslo/series?start=2000').status_code, 400)
+        self.assertEqual(self.client.get(
+            '/locations/Oslo/series?variables=uv_index_max').status_code, 400)
+        self.assertEqual(self.client.get(
+            '/locations/Oslo/aggregates').status_code, 400)
+
+    def test_etag_and_cache_follow_the_data_version(self):
+        first = self.client.get('/locations')
+        etag = first.headers['ETag']
+        self.assertEqual(first.get_json()[0]['variables'], {
+            'temperature_2m_max': {'start': '2000-01-01',
+                                   'end': '2000-01-03'}})
+
+        with patch('ClimaGraph.metrics', Metrics()) as recorder:
+            self.assertEqual(self.client.get('/locations').data, first.data)
+            not_modified = self.client.get(
+                '/locations', headers={'If-None-Match': etag})
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(recorder.snapshot()['counters'], {
+            'service_cache_hits': 1, 'service_not_modified': 1,
+            'service_requests': 2})
+
+        write_to_file({'Bergen': pd.DataFrame({
+            'date': ['2000-01-01'], 'temperature_2m_max': [3.0]})})
+        changed = self.client.get(
+            '/locations', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertEqual(len(changed.get_json()), 2)
+
+    def test_aggregates_and_graph(self):
+        response = self.client.get(
+            '/locations/Oslo/aggregates?variable=temperature_2m_max'
+            '&period=year&format=csv')
+        self.assertEqual(response.get_data(as_text=True).splitlines()[1],
+                         '2000,2,2.0,1.5,2.5,4.0,1.6,2.0,2.4,0.0')
+
+        response = self.client.get(
+            '/graph?city=Oslo&variable=temperature_2m_max')
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+
+    def test_pool_is_read_only_and_shared(self):
+        pool = self.app.extensions['climagraph']['pool']
+        conn = pool.acquire()
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("DELETE FROM locations")
+        pool.release(conn)
+
+        def get(i):
+            return self.client.get(
+                f'/locations/Oslo/series?end=2000-01-0{i % 3 + 1}'
+            ).status_code
+
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            self.assertEqual(set(executor.map(get, range(24))), {200})
+        self.assertLessEqual(len(pool.idle), 2)
+
+
+class TestHourly(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.patch_all([patch('ClimaGraph.geocode', side_effect=fake_geocode)])
+
+    def hours(self, start, count, offset=0.0):
+        return pd.DataFrame({
+            'time': pd.date_range(start, periods=count, freq='h', tz='UTC'),
+            'temperature_2m': np.arange(count, dtype=np.float32) + offset,
+        })
+
+    def test_days_are_packed_blobs_merged_on_overlap(self):
+        write_to_file({'Oslo': self.hours('2000-01-01', 48)},
+                      resolution='hourly')
+        write_to_file({'Oslo': self.hours('2000-01-02T12', 24, 100)},
+                      resolution='hourly')
+
+        conn = connect_database()
+        c = conn.cursor()
+        blobs = c.execute(
+            "SELECT date, length(hours) FROM hourly ORDER BY date"
+        ).fetchall()
+        self.assertEqual(blobs, [('2000-01-01', 96), ('2000-01-02', 96),
+                                 ('2000-01-03', 96)])
+        self.assertEqual(stored_hourly_variables(c, 1), ['temperature_2m'])
+        self.assertEqual(stored_variables(c, 1), [])
+
+        times, arrays = read_hourly(
+            c, 1, ['temperature_2m'], '2000-01-02', '2000-01-03')
+        conn.close()
+        values = arrays['temperature_2m']
+        self.assertEqual(str(times[0]), '2000-01-02T00')
+        np.testing.assert_array_equal(values[:12], np.arange(24, 36))
+        np.testing.assert_array_equal(values[12:36], np.arange(100, 124))
+        self.assertTrue(np.isnan(values[36:]).all())
+
+    def test_bucket_statistics_skip_missing_hours(self):
+        times = np.datetime64('2000-01-01T00', 'h') + np.arange(12)
+        values = np.arange(12, dtype=np.float32)
+        values[6:12] = np.nan
+        values[1] = np.nan
+        arrays = {'temperature_2m': values}
+
+        starts, buckets = bucket_hourly(times, arrays, 6, 'mean')
+        self.assertEqual([str(start) for start in starts],
+                         ['2000-01-01T00', '2000-01-01T06'])
+        np.testing.assert_array_equal(
+            buckets['temperature_2m'], [14 / 5, np.nan])
+        for stat, expected in [('min', 0), ('max', 5), ('sum', 14)]:
+            self.assertEqual(
+                bucket_hourly(times, arrays, 6, stat)[1]['temperature_2m'][0],
+                expected)
+        with self.assertRaises(ValueError):
+            check_bucket(5)
+
+    def test_query_spans_do_not_split_buckets(self):
+        write_to_file({'Oslo': self.hours('2000-01-01', 24 * 40)},
+                      resolution='hourly')
+        conn = connect_database()
+        c = conn.cursor()
+        times, arrays = read_hourly(
+            c, 1, ['temperature_2m'], '2000-01-01', '2000-02-09')
+        starts, buckets = bucket_hourly(times, arrays, 168, 'max')
+
+        with patch('ClimaGraph.HOURLY_READ_DAYS', 10):
+            col_names, batches = query_hourly(
+                c, 1, ['temperature_2m'], '2000-01-01', '2000-02-09',
+                168, 'max')
+            rows = [row for batch in batches for row in batch]
+        conn.close()
+
+        self.assertEqual(col_names, ['time', 'temperature_2m'])
+        self.assertEqual(rows, [
+            (f"{start}:00", value) for start, value
+            in zip(starts, buckets['temperature_2m'].tolist())])
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_fetch_and_query_hourly_from_the_cli(self, mock_stdout):
+        with patch_api(fake_hourly_api) as weather_api, patch(
+                'ClimaGraph.geocode',
+                return_value=FakeLocation('Oslo City', 0.0, 10.0)):
+            self.assertEqual(run_cli([
+                'fetch', 'Oslo', '--hourly', '--start', '2000-01-01',
+                '--end', '2000-01-02', '--variables', 'temperature_2m']), 0)
+            run_cli(['fetch', 'Oslo', '--hourly', '--start', '2000-01-01',
+                     '--end', '2000-01-02', '--variables', 'temperature_2m'])
+        self.assertEqual(weather_api.call_count, 1)
+        params = weather_api.call_args[1]['params']
+        self.assertEqual(params['hourly'], ['temperature_2m'])
+        self.assertEqual(params['timezone'], 'GMT')
+        self.assertIn('48 hours stored', mock_stdout.getvalue())
+
+        mock_stdout.seek(0)
+        mock_stdout.truncate()
+        self.assertEqual(run_cli([
+            'query', 'Oslo', '--hourly', '--start', '2000-01-01',
+            '--end', '2000-01-02', '--bucket', '24', '--stat', 'max']), 0)
+        self.assertEqual(mock_stdout.getvalue().splitlines(), [
+            'time,temperature_2m', '2000-01-01T00:00,23.0',
+            '2000-01-02T00:00,47.0'])
+
+
+class TestGridCells(TempDirTestCase):
+
+    coordinates = {
+        'Manhattan': (40.776, -73.971),
+        'Brooklyn': (40.650, -73.950),
+        'Queens': (40.790, -73.990),
+        'Boston': (42.360, -71.058),
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.patch_all([
+            patch('ClimaGraph.geocode', side_effect=lambda city: FakeLocation(
+                f'{city} City', *self.coordinates[city])),
+        ])
+
+    def test_grid_cell_snaps_coordinates(self):
+        self.assertEqual(grid_cell(40.712, -74.006), '40.7,-74.0')
+        self.assertEqual(grid_cell(40.68, -73.96), '40.7,-74.0')
+        self.assertEqual(grid_cell(40.76, -73.96), '40.8,-74.0')
+        self.assertEqual(grid_cell(40.712, -74.006, 0.25), '40.75,-74.00')
+        self.assertIsNone(grid_cell(None, -74.0))
+
+    def test_cities_in_one_cell_share_a_request(self):
+        with patch_api(fake_api) as weather_api:
+            cities_dict, failures = fetch_cities(
+                ARCHIVE_URL, ['temperature_2m_max'],
+                ['Manhattan', 'Boston', 'Queens'], '2000-01-01', '2000-01-03')
+
+        latitudes = weather_api.call_args.kwargs['params']['latitude']
+        self.assertEqual(latitudes, '40.776,42.36')
+        manhattan, boston, queens = cities_dict.values()
+        self.assertIs(queens, manhattan)
+        self.assertEqual(manhattan.attrs['aliases'],
+                         ['Queens City (User entered: Queens)'])
+
+    def test_cities_in_one_cell_share_stored_series(self):
+        with patch_api(fake_api) as weather_api:
+            update_cities(ARCHIVE_URL, ['temperature_2m_max'],
+                          ['Manhattan', 'Boston'], '2000-01-01', '2000-01-03')
+            cities_dict, failures = update_cities(
+                ARCHIVE_URL, ['temperature_2m_max'],
+                ['Manhattan', 'Queens'], '2000-01-01', '2000-01-03')
+            update_cities(ARCHIVE_URL, ['temperature_2m_max'],
+                          ['Brooklyn'], '2000-01-01', '2000-01-03')
+
+        # Queens was never requested, Brooklyn has a cell of its own
+        self.assertEqual(weather_api.call_count, 2)
+        manhattan, queens = cities_dict.values()
+        pd.testing.assert_frame_equal(queens, manhattan)
+
+        conn = connect_database()
+        c = conn.cursor()
+        self.assertEqual(c.execute(
+            "SELECT COUNT(DISTINCT location_id) FROM observations"
+        ).fetchone()[0], 3)
+        self.assertEqual(
+            find_location(c, 'Queens City (User entered: Queens)'),
+            find_location(c, 'Manhattan City (User entered: Manhattan)'))
+        self.assertEqual(match_location(c, 'Queens'),
+                         match_location(c, 'Manhattan'))
+        conn.close()
+
+    def test_stored_cell_is_the_one_planned_with(self):
+        with patch_api(fake_api):
+            update_cities(ARCHIVE_URL, ['temperature_2m_max'],
+                          ['Manhattan'], '2000-01-01', '2000-01-03')
+
+        conn = connect_database()
+        self.assertEqual(
+            conn.execute("SELECT cell FROM locations").fetchall(),
+            [(grid_cell(*self.coordinates['Manhattan']),)])
+        conn.close()
+
+    def test_forecast_locations_are_not_merged(self):
+        with patch_api(fake_api) as weather_api:
+            cities_dict, failures = fetch_cities(
+                FORECAST_URL, ['temperature_2m_max'],
+                ['Manhattan', 'Queens'], '2000-01-01', '2000-01-03')
+            update_cities(FORECAST_URL, ['temperature_2m_max'],
+                          ['Manhattan', 'Queens'], '2000-01-01', '2000-01-03')
+
+        latitudes = weather_api.call_args_list[0].kwargs['params']['latitude']
+        self.assertEqual(latitudes, '40.776,40.79')
+        manhattan, queens = cities_dict.values()
+        self.assertIsNot(queens, manhattan)
+        conn = connect_database()
+        self.assertEqual(conn.execute(
+            "SELECT COUNT(*), COUNT(cell) FROM locations").fetchone(), (2, 0))
+        conn.close()
+
+    def test_cells_merge_locations(self):
+        conn = connect_database()
+        c = conn.cursor()
+        first = upsert_location(c, 'A', 40.71, -74.0, '40.75,-74.00')
+        second = upsert_location(c, 'B', 40.79, -74.1, '40.75,-74.00')
+        self.assertEqual(first, second)
+        self.assertEqual(upsert_location(c, 'B'), first)
+        self.assertEqual(
+            c.execute("SELECT COUNT(*) FROM locations").fetchone()[0], 1)
+        conn.close()
+
+
+class TestCitySeries(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cities_dict = {
+            'Oslo': pd.DataFrame({
+                'date': pd.date_range('2000-01-01', periods=4, tz='UTC'),
+                'temperature_2m_max': [1.0, 2.0, np.nan, 4.0],
+                'precipitation_sum': [0.5, 0.0, 1.5, 2.0],
+            }),
+            'Lima': pd.DataFrame({
+                'date': pd.date_range('2000-01-03', periods=3, tz='UTC'),
+                'temperature_2m_max': [20.0, 21.0, 22.0],
+                'precipitation_sum': [0.0, np.nan, 0.0],
+            }),
+        }
+        self.cities_dict['Lima'].attrs['latitude'] = -12.0
+
+    def test_cities_share_one_date_axis(self):
+        series = CitySeries.from_frames(self.cities_dict)
+
+        self.assertEqual(series.array.shape, (2, 2, 5))
+        self.assertEqual(series.array.dtype, np.float32)
+        self.assertEqual(list(series), ['Oslo', 'Lima'])
+        self.assertEqual(str(series.days[0]), '2000-01-01')
+        np.testing.assert_array_equal(
+            series.present('Lima'), [False, False, True, True, True])
+        np.testing.assert_array_equal(
+            series.column('temperature_2m_max')[1, 2:], [20.0, 21.0, 22.0])
+
+        lima = series['Lima']
+        self.assertEqual(len(lima), 3)
+        self.assertEqual(lima.attrs['latitude'], -12.0)
+        np.testing.assert_array_equal(
+            lima['date'], self.cities_dict['Lima']['date'])
+        np.testing.assert_array_equal(
+            lima['precipitation_sum'], [0.0, np.nan, 0.0])
+
+    def test_complete_city_is_a_view(self):
+        series = CitySeries.from_frames({'Oslo': self.cities_dict['Oslo']})
+
+        oslo = series['Oslo']
+        self.assertEqual(len(oslo), 4)
+        self.assertTrue(np.shares_memory(
+            oslo['precipitation_sum'].to_numpy(), series.array))
+        dates, values = series.line('Oslo', 'temperature_2m_max')
+        np.testing.assert_array_equal(values, [1.0, 2.0, 4.0])
+        subset = series.subset(['precipitation_sum'])
+        self.assertEqual(subset.array.shape, (1, 1, 4))
+
+    def test_read_series_from_database(self):
+        conn = connect_database()
+        self.addCleanup(conn.close)
+        c = conn.cursor()
+        write_to_file(self.cities_dict, conn=conn)
+
+        series = read_series(
+            c, ['Oslo', 'Atlantis', 'Oslo'],
+            ['temperature_2m_max', 'precipitation_sum'],
+            '2000-01-02', '2000-01-06')
+
+        self.assertEqual(list(series), ['Oslo', 'Atlantis'])
+        self.assertEqual(series.array.shape, (2, 2, 5))
+        np.testing.assert_array_equal(
+            series.array[0, 0], [2.0, np.nan, 4.0, np.nan, np.nan])
+        self.assertTrue(np.isnan(series.array[1]).all())
+        self.assertEqual(len(series['Atlantis']), 0)
+
+    def test_export_series_writes_present_days(self):
+        filename = os.path.join(self.tmpdir, 'lima.csv')
+        series = CitySeries.from_frames(self.cities_dict)
+
+        self.assertEqual(export_series(series, 'Lima', filename), 3)
+        with open(filename) as file:
+            self.assertEqual(file.read().splitlines(), [
+                'date,temperature_2m_max,precipitation_sum',
+                '2000-01-03,20.0,0.0',
+                '2000-01-04,21.0,',
+                '2000-01-05,22.0,0.0',
+            ])
+
+
+class TestRateBudget(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        self.sleeps = []
+        self.patch_all([
+            patch('ClimaGraph.time.time', lambda: self.now),
+            patch('ClimaGraph.time.sleep', side_effect=self.sleep),
+            patch('ClimaGraph.API_RATE_LIMITS',
+                  {'minute': (60, 10), 'hour': (3600, 30)}),
+            patch('ClimaGraph.API_RATE_HEADROOM', 1.0),
+        ])
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 3))
+        self.now += seconds
+
+    def test_request_weight_follows_the_api_rules(self):
+        params = build_params('1,2', '3,4', ['temperature_2m_max'] * 5,
+                              '2000-01-01', '2000-12-30')
+        self.assertEqual(request_weight(params), 2 * 365 / 14)
+        params = build_params('1', '3', ['temperature_2m_max'] * 20,
+                              '2000-01-01', '2000-01-07')
+        self.assertEqual(request_weight(params), 2.0)
+
+    def test_requests_wait_for_room_in_every_window(self):
+        budget = RateBudget(':memory:')
+        budget.acquire(4)
+        budget.acquire(4)
+        self.now += 10
+        budget.acquire(4)
+        self.assertEqual(self.sleeps, [50.0])
+
+        # The hourly window is full after 30 calls
+        for _ in range(4):
+            self.now += 60
+            budget.acquire(4)
+        self.assertEqual(budget.spent(), {'minute': 4, 'hour': 28})
+        with self.assertRaisesRegex(ValueError, 'resume in 55 minutes'):
+            budget.acquire(4)
+        self.assertEqual(self.sleeps, [50.0])
+        with patch('ClimaGraph.RATE_MAX_WAIT', 3600):
+            budget.acquire(4)
+        self.assertEqual(self.sleeps[-1], 3600 - 300)
+
+    def test_requests_heavier_than_a_window_fail(self):
+        budget = RateBudget(':memory:')
+        with self.assertRaisesRegex(ValueError, 'more than the 10'):
+            budget.acquire(11)
+        self.assertEqual(budget.spent(), {'minute': 0, 'hour': 0})
+
+    def test_batches_are_split_to_fit_the_smallest_window(self):
+        sizes = []
+
+        def fetch(url, variables, locations, start, end, resolution):
+            sizes.append(len(locations))
+            return [pd.DataFrame({'date': [start], variables[0]: [1.0]})
+                    for _ in locations]
+
+        # 70 days weigh 5 calls per location, two fit in a minute
+        with patch('ClimaGraph.bulk_geocode', return_value=[
+                FakeLocation(f'City {n}', n, n) for n in range(5)]), \
+                patch('ClimaGraph.fetch_batch', side_effect=fetch):
+            outcomes = fetch_outcomes(
+                ARCHIVE_URL, ['temperature_2m_max'],
+                [f'City {n}' for n in range(5)], '2000-01-01', '2000-03-10',
+                max_workers=1, chunk_freq=None)
+        self.assertEqual(sorted(sizes), [1, 2, 2])
+        self.assertFalse(any(
+            isinstance(outcome, Exception) for outcome in outcomes))
+
+    def test_budget_is_kept_across_runs(self):
+        path = os.path.join(self.tmpdir, 'rate_budget.db')
+        budget = RateBudget(path)
+        budget.acquire(10)
+        budget.close()
+
+        # The call of the first run still fills the minute
+        self.now += 15
+        RateBudget(path).acquire(10)
+        self.assertEqual(self.sleeps, [45.0])
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_hitting_a_limit_holds_every_request_back(self, mock_stdout):
+        limited = Exception({'error': True, 'reason': RATE_LIMIT_ERROR})
+        with patch_api([limited, [], []]) as weather_api:
+            call_weather_api(ARCHIVE_URL, build_params(
+                '1', '2', ['temperature_2m_max'], '2000-01-01', '2000-01-01'))
+            call_weather_api(ARCHIVE_URL, build_params(
+                '1', '2', ['temperature_2m_max'], '2000-01-02', '2000-01-02'))
+
+        self.assertEqual(weather_api.call_count, 3)
+        self.assertEqual(self.sleeps, [60.0])
+        self.assertIn('API limit exceeded for this minute',
+                      mock_stdout.getvalue())
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_hourly_limit_fails_instead_of_waiting(self, mock_stdout):
+        limited = Exception({
+            'error': True,
+            'reason': 'Hourly API request limit exceeded. '
+                      'Please try again in the next hour.'})
+        params = build_params(
+            '1', '2', ['temperature_2m_max'], '2000-01-01', '2000-01-01')
+        with patch_api([limited, []]) as weather_api:
+            for _ in range(2):
+                with self.assertRaisesRegex(
+                        ValueError, 'resume in 60 minutes'):
+                    call_weather_api(ARCHIVE_URL, params)
+
+        self.assertEqual(weather_api.call_count, 1)
+        self.assertEqual(self.sleeps, [])
+        self.assertIn('API limit exceeded for this hour. Try again later.',
+                      mock_stdout.getvalue())
+
+
+class TestRateBudgetStandIn(TempDirTestCase):
+
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_paced_requests_never_hit_the_limit(self, mock_stdout):
+        server = StandInServer(rate_limit=1, rate_window=0.3)
+        with server, use_stand_in(server, self.tmpdir), \
+                patch('ClimaGraph.API_RATE_LIMITS', {'minute': (0.3, 1)}), \
+                patch('ClimaGraph.API_RATE_HEADROOM', 1.0):
+            for city in ['Oslo', 'Bergen', 'Lima']:
+                cities_dict, failures = update_cities(
+                    ClimaGraph.ARCHIVE_URL, ['temperature_2m_max'],
+                    [city], '2000-01-01', '2000-01-10')
+                self.assertEqual(failures, {})
+            # Answers from the HTTP cache are not paced
+            started = time.monotonic()
+            fetch_cities(
+                ClimaGraph.ARCHIVE_URL, ['temperature_2m_max'],
+                ['Oslo'], '2000-01-01', '2000-01-10')
+            self.assertLess(time.monotonic() - started, 0.3)
+
+        self.assertEqual(server.counts['weather'], 3)
+        self.assertEqual(server.counts['limited'], 0)
+        self.assertNotIn('API limit exceeded', mock_stdout.getvalue())
+
+
+class TestStoreWriter(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conn = connect_database()
+        self.addCleanup(self.conn.close)
+
+    def chunk(self, city, start, days=10):
+        return {city: pd.DataFrame({
+            'date': pd.date_range(start, periods=days, tz='UTC'),
+            'temperature_2m_max': np.arange(days, dtype=np.float32),
+        })}
+
+    # Rows another connection sees, as a run reading the file would
+    def committed(self):
+        reader = sqlite3.connect(self.db_path)
+        try:
+            return reader.execute(
+                "SELECT COUNT(*) FROM observations").fetchone()[0]
+        finally:
+            reader.close()
+
+    def test_commits_in_batches_of_rows(self):
+        with StoreWriter(self.conn, batch_rows=20,
+                         batch_seconds=60) as writer:
+            for n in range(5):
+                writer.put(self.chunk('Oslo', f'2000-0{n + 1}-01'))
+        self.assertEqual(writer.commits, 3)
+        self.assertEqual(self.committed(), 50)
+
+    def test_commits_pending_rows_after_batch_seconds(self):
+        writer = StoreWriter(self.conn, batch_rows=1000, batch_seconds=0.05)
+        self.addCleanup(writer.close)
+        writer.put(self.chunk('Oslo', '2000-01-01'))
+        deadline = time.monotonic() + 5
+        while not self.committed() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.committed(), 10)
+        self.assertTrue(writer.thread.is_alive())
+
+    def test_failed_write_keeps_what_came_before(self):
+        storage = get_backend()
+        with patch.object(storage, 'write',
+                          side_effect=[None, sqlite3.OperationalError()]):
+            writer = StoreWriter(self.conn, batch_rows=1000, batch_seconds=60)
+            writer.put(self.chunk('Oslo', '2000-01-01'))
+            writer.put(self.chunk('Bergen', '2000-01-01'))
+            with self.assertRaises(sqlite3.OperationalError):
+                writer.close()
+
+        c = self.conn.cursor()
+        self.assertIsNotNone(find_location(c, 'Oslo'))
+        self.assertIsNone(find_location(c, 'Bergen'))
+        self.assertEqual(
+            stored_variables(c, find_location(c, 'Oslo')),
+            ['temperature_2m_max'])
+
+    def test_update_keeps_chunks_fetched_before_a_crash(self):
+        # The first year arrives, then the run is interrupted
+        def crashing_api(url, params, method='GET'):
+            if params['start_date'] != '1998-01-01':
+                time.sleep(0.2)
+                raise KeyboardInterrupt
+            return fake_api(url, params)
+
+        with patch('ClimaGraph.geocode', side_effect=fake_geocode), \
+                patch_api(crashing_api), \
+                self.assertRaises(KeyboardInterrupt):
+            update_cities(ARCHIVE_URL, ['temperature_2m_max'], ['Oslo'],
+                          '1998-01-01', '2000-12-31')
+
+        self.assertEqual(self.committed(), 365)
+
+
+class TestQueryCities(TempDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.conn = connect_database()
+        self.addCleanup(self.conn.close)
+        self.c = self.conn.cursor()
+
+    def write(self, city, start, values, backend=None):
+        write_to_file({city: pd.DataFrame({
+            'date': pd.date_range(start, periods=len(values), tz='UTC'),
+            'temperature_2m_max': values,
+            'precipitation_sum': [0.5] * len(values),
+        })}, backend=backend)
+
+    def query(self, cities, variables=('temperature_2m_max',),
+              backend=None):
+        col_names, batches = query_cities(
+            self.c, [find_location(self.c, city) for city in cities],
+            list(variables), '2000-01-02', '2000-01-03', backend)
+        return col_names, [row for rows in batches for row in rows]
+
+    def test_cities_are_queried_together(self):
+        for backend in ['sqlite', 'columnar']:
+            self.write('Oslo', '2000-01-01', [1.0, 2.0, 3.0], backend)
+            self.write('Bergen', '2000-01-02', [4.0, 5.0, 6.0], backend)
+            col_names, rows = self.query(['Bergen', 'Oslo'], backend=backend)
+            self.assertEqual(
+                col_names, ['location', 'date', 'temperature_2m_max'])
+            self.assertEqual(rows, [
+                ('Oslo', '2000-01-02', 2.0), ('Oslo', '2000-01-03', 3.0),
+                ('Bergen', '2000-01-02', 4.0), ('Bergen', '2000-01-03', 5.0),
+            ])
+
+        with self.assertRaises(ValueError):
+            self.query(['Oslo'], ['snowfall_sum'])
+
+    def test_results_are_cached_until_their_locations_change(self):
+        self.write('Oslo', '2000-01-01', [1.0, 2.0, 3.0])
+        self.write('Bergen', '2000-01-01', [4.0, 5.0, 6.0])
+        self.query(['Oslo', 'Bergen'])
+        self.query(['Oslo'])
+        _, rows = self.query(['Bergen', 'Oslo'])
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(ClimaGraph.metrics.counters['query_cache_hits'], 1)
+
+        # New Bergen data only invalidates the results holding Bergen
+        self.write('Bergen', '2000-01-03', [9.0])
+        _, rows = self.query(['Oslo', 'Bergen'])
+        self.assertIn(('Bergen', '2000-01-03', 9.0), rows)
+        self.query(['Oslo'])
+        self.assertEqual(ClimaGraph.metrics.counters['query_cache_hits'], 2)
+        self.assertEqual(ClimaGraph.metrics.counters['query_cache_misses'], 3)
+        self.assertEqual(len(ClimaGraph.query_cache.entries), 2)
+
+    def test_databases_do_not_share_cached_results(self):
+        self.write('Oslo', '2000-01-01', [1.0, 2.0, 3.0])
+        self.query(['Oslo'])
+
+        # Same location id and version, other values
+        other = os.path.join(self.tmpdir, 'other.db')
+        with patch('ClimaGraph.DATABASE_FILE', other):
+            self.write('Oslo', '2000-01-01', [7.0, 8.0, 9.0])
+            conn = connect_database()
+        self.addCleanup(conn.close)
+        self.c = conn.cursor()
+        _, rows = self.query(['Oslo'])
+        self.assertEqual(rows, [
+            ('Oslo', '2000-01-02', 8.0), ('Oslo', '2000-01-03', 9.0)])
+        self.assertNotIn('query_cache_hits', ClimaGraph.metrics.counters)
+
+    def test_query_command_takes_several_cities(self):
+        self.write('Oslo', '2000-01-01', [1.0, 2.0, 3.0])
+        self.write('Bergen', '2000-01-01', [4.0, 5.0, 6.0])
+
+        with patch('sys.stdout', new_callable=StringIO) as mock_stdout:
+            status = run_cli([
+                'query', 'Oslo', 'Bergen', '--start', '2000-01-03',
+                '--end', '2000-01-03', '--variables', 'precipitation_sum'])
+        self.assertEqual(status, 0)
+        self.assertEqual(mock_stdout.getvalue().splitlines(), [
+            'location,date,precipitation_sum',
+            'Oslo,2000-01-03,0.5',
+            'Bergen,2000-01-03,0.5',
+        ])
+
+    @patch('builtins.print')
+    def test_query_database_exports_several_cities(self, mock_print):
+        self.write('Oslo', '2000-01-01', [1.0, 2.0, 3.0])
+        self.write('Bergen', '2000-01-01', [4.0, 5.0, 6.0])
+        self.work_in_tmpdir()
+
+        with patch('builtins.input', side_effect=[
+                'Oslo, Bergen', '2000-01-03', '2000-01-03']):
+            query_database(conn=self.conn)
+
+        with open('Oslo_Bergen_weather_data_2000-01-03_to_2000-01-03.csv') \
+                as file:
+            self.assertEqual(file.read().splitlines(), [
+                'location,date,temperature_2m_max,precipitation_sum',
+                'Oslo,2000-01-03,3.0,0.5',
+                'Bergen,2000-01-03,6.0,0.5',
+            ])
+
+    @patch('builtins.print')
+    def test_query_database_exports_several_cities_to_parquet(
+            self, mock_print):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        self.write('Oslo', '2000-01-01', [1.0, 2.0, 3.0])
+        self.write('Bergen', '2000-01-01', [4.0, 5.0, 6.0])
+        self.work_in_tmpdir()
+
+        with patch('builtins.input', side_effect=[
+                'Oslo, Bergen', '2000-01-02', '2000-01-03']):
+            query_database('parquet', conn=self.conn)
+
+        table = pq.read_table(
+            'Oslo_Bergen_weather_data_2000-01-02_to_2000-01-03.parquet')
+        self.assertEqual(table.schema.field('location').type, pa.string())
+        self.assertEqual(table.schema.field('date').type, pa.date32())
+        self.assertEqual(table.column('location').to_pylist(),
+                         ['Oslo', 'Oslo', 'Bergen', 'Bergen'])
+        self.assertEqual(table.column('temperature_2m_max').to_pylist(),
+                         [2.0, 3.0, 5.0, 6.0])
+
+    def test_failed_columnar_export_removes_the_file(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        filename = os.path.join(self.tmpdir, 'broken.parquet')
+        batches = [[('2000-01-01', 1.0)], [('not a date', 2.0)]]
+
+        with self.assertRaises(ValueError):
+            export_rows(batches, ['date', 'temperature_2m_max'], filename,
+                        'parquet')
+        self.assertFalse(os.path.exists(filename))
+
+
+class TestPyramid(TempDirTestCase):
+
+    def store(self, start, end, values):
+        write_to_file({'Oslo': pd.DataFrame({
+            'date': pd.date_range(start, end).strftime('%Y-%m-%d'),
+            'temperature_2m_max': values,
+        })})
+
+    def read(self, start, end, points, **kwargs):
+        conn = connect_database()
+        result = read_pyramid(
+            conn.cursor(), 1, 'temperature_2m_max', start, end, points,
+            **kwargs)
+        conn.commit()
+        conn.close()
+        return result
+
+    def test_period_starts(self):
+        days = ['2024-01-03', '2024-05-15', '2023-12-31']
+        self.assertEqual(pyramid_starts(days, 'week').astype(str).tolist(),
+                         ['2024-01-01', '2024-05-13', '2023-12-25'])
+        self.assertEqual(
+            pyramid_starts(days, 'quarter').astype(str).tolist(),
+            ['2024-01-01', '2024-04-01', '2023-10-01'])
+        self.assertEqual(pyramid_starts(days, 'year').astype(str).tolist(),
+                         ['2024-01-01', '2024-01-01', '2023-01-01'])
+        self.assertEqual(
+            [str(day) for day in pyramid_period('2024-02-10', 'quarter')],
+            ['2024-01-01', '2024-03-31'])
+
+    def test_levels_match_pandas_after_incremental_writes(self):
+        dates = pd.date_range('2000-01-01', '2002-12-31')
+        values = np.sin(np.arange(len(dates)) / 10) * 20
+        values[100:110] = np.nan
+        # Split inside a week, a month and a quarter
+        self.store('2000-01-01', '2001-05-16', values[:502])
+        self.store('2001-05-17', '2002-12-31', values[502:])
+
+        frame = pd.Series(values, index=dates)
+        for level, rule, points in [
+                ('week', 'W-MON', 200), ('month', 'MS', 37),
+                ('quarter', 'QS', 13), ('year', 'YS', 4)]:
+            result, _, rows = self.read('2000-01-01', '2002-12-31', points)
+            self.assertEqual(result, level)
+            expected = frame.resample(
+                rule, label='left', closed='left').agg(
+                ['mean', 'min', 'max', 'count'])
+            expected = expected[expected['count'] > 0]
+            self.assertEqual(
+                [row[0] for row in rows],
+                expected.index.strftime('%Y-%m-%d').tolist(), level)
+            np.testing.assert_allclose(
+                [row[1:4] for row in rows],
+                expected[['mean', 'min', 'max']].to_numpy(), rtol=1e-6)
+            self.assertEqual([row[4] for row in rows],
+                             expected['count'].tolist())
+
+    def test_reads_pick_the_finest_level_within_points(self):
+        self.store('2000-01-01', '2009-12-31', np.arange(3653.0))
+        self.assertEqual(self.read('1940-01-01', '2024-01-01', 4000)[0],
+                         'day')
+        for points, level, count in [
+                (1000, 'week', 523), (200, 'month', 120),
+                (50, 'quarter', 40), (5, 'year', 10)]:
+            result, col_names, rows = self.read(
+                '1940-01-01', '2024-01-01', points)
+            self.assertEqual(result, level)
+            self.assertEqual(col_names, PYRAMID_COLUMNS)
+            self.assertEqual(len(rows), count)
+
+        level, _, rows = self.read('2005-02-10', '2005-03-20', 20)
+        self.assertEqual(level, 'week')
+        self.assertEqual(rows[0][0], '2005-02-07')
+        self.assertEqual(self.read('2005-02-10', '2005-02-11', 20)[2], [
+            ('2005-02-10', 1867.0, 1867.0, 1867.0, 1),
+            ('2005-02-11', 1868.0, 1868.0, 1868.0, 1),
+        ])
+
+    def test_read_builds_the_pyramid_of_older_databases(self):
+        self.store('2000-01-01', '2001-12-31', np.ones(731))
+        conn = connect_database()
+        conn.execute("DELETE FROM weeks")
+        conn.execute("DELETE FROM rollups")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(
+            self.read('2000-01-01', '2001-12-31', 100, backfill=False)[2],
+            [])
+        level, _, rows = self.read('2000-01-01', '2001-12-31', 100)
+        self.assertEqual(level, 'month')
+        self.assertEqual(len(rows), 24)
+        level, _, rows = self.read('2000-01-01', '2001-12-31', 200)
+        self.assertEqual(level, 'week')
+        self.assertEqual(len(rows), 106)
+
+    def test_writes_read_back_once(self):
+        with patch('ClimaGraph.read_observations',
+                   wraps=read_observations) as read:
+            self.store('2000-12-30', '2001-01-02', np.ones(4))
+        # The touched years and the week across them, in one read
+        read.assert_called_once()
+        self.assertEqual(read.call_args.args[3:5],
+                         ('2000-01-01', '2001-12-31'))
+
+    def test_overview_series_draws_min_and_max_of_periods(self):
+        self.store('2000-01-01', '2001-12-31', np.arange(731.0))
+        conn = connect_database()
+        series = overview_series(
+            conn.cursor(), ['Oslo'], 'temperature_2m_max',
+            '2000-01-01', '2001-12-31', points=2)
+        conn.close()
+
+        dates, values = series.line('Oslo', 'temperature_2m_max')
+        self.assertEqual(dates.strftime('%Y-%m-%d').tolist(), [
+            '2000-01-01', '2000-07-01', '2001-01-01', '2001-07-02'])
+        self.assertEqual(values.tolist(), [0, 365, 366, 730])
+
+    def test_service_overview(self):
+        self.store('2000-01-01', '2009-12-31', np.arange(3653.0))
+        app = create_app(pool_size=1)
+        self.addCleanup(app.extensions['climagraph']['pool'].close)
+        client = app.test_client()
+
+        response = client.get('/locations/Oslo/overview?'
+                              'variable=temperature_2m_max&points=12')
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body['level'], 'year')
+        self.assertEqual(body['columns'], PYRAMID_COLUMNS)
+        self.assertEqual(body['rows'][0], ['2000-01-01', 182.5, 0, 365, 366])
+
+        response = client.get('/locations/Oslo/overview?points=12')
+        self.assertEqual(response.status_code, 400)
+        response = client.get('/locations/Oslo/overview?'
+                              'variable=temperature_2m_max&points=x')
+        self.assertEqual(response.status_code, 400)
+
+
 # if __name__ == '__main__':
 #     unittest.main()